@@ -0,0 +1,82 @@
+"""Admission control of the commands an executor server runs
+
+Each command takes a share of the server: its pinned cores (1 if it's
+unpinned) and the memory it declared, if any. At most `slots` cores and
+`mem` bytes are handed out at a time, over all clients; commands beyond
+that wait in one queue, first come first served, so no client forks more
+than the host can take however far ahead of its slots it gets.
+
+A command asking for more than the whole budget still runs, alone, once
+nothing else does, rather than never.
+"""
+
+import asyncio
+import collections
+
+class AdmissionQueue:
+    def __init__(self, slots, mem=None):
+        """slots: cores commands may use at once
+        mem: bytes of declared memory commands may use at once, None for no limit
+        """
+        self.slots = slots
+        self.mem = mem
+        self.used_slots = 0
+        self.used_mem = 0
+        self.running = 0
+        # (cores, mem, future) of the commands waiting, in order of arrival
+        self.waiting = collections.deque()
+
+    def __len__(self):
+        """The queue depth"""
+        return len(self.waiting)
+
+    def fits(self, cores, mem):
+        if self.running == 0:
+            return True
+        return self.used_slots + cores <= self.slots \
+            and (self.mem is None or self.used_mem + mem <= self.mem)
+
+    def admit(self, cores, mem=0):
+        """Queue a command for cores and mem
+        returns a future done once it may start, which the command
+        leaves the queue by cancelling; release() its share when it ends
+        """
+        future = asyncio.get_running_loop().create_future()
+        entry = (cores, mem, future)
+        self.waiting.append(entry)
+        future.add_done_callback(lambda f: f.cancelled() and self.withdraw(entry))
+        self.pump()
+        return future
+
+    def withdraw(self, entry):
+        self.waiting.remove(entry)
+        # whatever queued behind it may fit now
+        self.pump()
+
+    def release(self, cores, mem=0):
+        self.used_slots -= cores
+        self.used_mem -= mem
+        self.running -= 1
+        self.pump()
+
+    def pump(self):
+        """Start commands from the head of the queue while they fit"""
+        while len(self.waiting) > 0:
+            cores, mem, future = self.waiting[0]
+            if not self.fits(cores, mem):
+                break
+            self.waiting.popleft()
+            self.used_slots += cores
+            self.used_mem += mem
+            self.running += 1
+            future.set_result(None)
+
+    def info(self):
+        return {
+            'slots': self.slots,
+            'mem': self.mem,
+            'running': self.running,
+            'queued': len(self.waiting),
+            'used_slots': self.used_slots,
+            'used_mem': self.used_mem
+        }
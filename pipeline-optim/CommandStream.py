@@ -0,0 +1,103 @@
+"""Output of a running command, chunk by chunk as it is produced
+
+    stream = await executor.execute_stream(cmd)
+    async for stream_id, data in stream:
+        ...
+    stream.returncode
+
+Rather than holding a chatty prepsubband's whole stdout in memory until it
+exits, both LocalExecutor and ExecutorClient hand it over in chunks of at
+most STREAM_CHUNK_SIZE bytes. At most max_buffered chunks wait to be
+consumed; beyond that the producer stops reading the command's pipes, so
+the command blocks on its writes until the consumer catches up.
+"""
+
+import asyncio
+
+STDOUT = 1
+STDERR = 2
+
+STREAM_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_BUFFERED = 16
+
+class CommandStream:
+    def __init__(self, max_buffered=DEFAULT_MAX_BUFFERED):
+        # (stream id, bytes) per chunk, (None, returncode) at the end or
+        # (None, exception) if the command couldn't be run to the end
+        self.frames = asyncio.Queue(max_buffered)
+        # set once the iteration ended
+        self.returncode = None
+        # the asyncio task feeding a local stream
+        self.producer = None
+        # called by cancel() to kill the command
+        self.canceller = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.returncode is not None:
+            raise StopAsyncIteration
+        stream_id, data = await self.frames.get()
+        if stream_id is None:
+            if isinstance(data, BaseException):
+                raise data
+            self.returncode = data
+            raise StopAsyncIteration
+        return stream_id, data
+
+    async def put_chunk(self, stream_id, data):
+        await self.frames.put((stream_id, data))
+
+    async def put_end(self, returncode):
+        await self.frames.put((None, returncode))
+
+    def fail(self, error):
+        """End the stream with error, raised to the consumer; doesn't
+        wait for room as the producer may be gone
+        """
+        while self.frames.full():
+            self.frames.get_nowait()
+        self.frames.put_nowait((None, error))
+
+    def cancel(self):
+        """Kill the command; the stream then ends with its status"""
+        if self.canceller is not None and self.returncode is None:
+            self.canceller()
+
+    async def read_all(self):
+        """returns (returncode, stdout bytes, stderr bytes)"""
+        outputs = {STDOUT: [], STDERR: []}
+        async for stream_id, data in self:
+            outputs[stream_id].append(data)
+        return self.returncode, b''.join(outputs[STDOUT]), b''.join(outputs[STDERR])
+
+def exit_status(returncode):
+    """A subprocess returncode as an unsigned exit status, using the
+    shell's convention for commands killed by a signal
+    """
+    return returncode if returncode >= 0 else 128 - returncode
+
+async def pump(pipe, stream_id, forward):
+    """Read pipe until EOF, await forward(stream_id, chunk) for each chunk"""
+    while True:
+        data = await pipe.read(STREAM_CHUNK_SIZE)
+        if len(data) == 0:
+            break
+        await forward(stream_id, data)
+
+async def run_streamed(cmd, forward, started=None):
+    """Run shell command cmd in a process group of its own, forwarding
+    its stdout and stderr chunks; started(proc) is called once it was spawned
+    returns its exit status
+    """
+    proc = await asyncio.create_subprocess_shell(
+        cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+    if started is not None:
+        started(proc)
+    await asyncio.gather(pump(proc.stdout, STDOUT, forward), pump(proc.stderr, STDERR, forward))
+    return exit_status(await proc.wait())
@@ -0,0 +1,108 @@
+"""CPU / NUMA topology of this host and core pinning of shell commands
+
+Both LocalExecutor and ExecutorServer pin commands through pin_command(),
+so the NUMA layout used is always the one of the host running the command.
+"""
+
+import os, glob, shlex, shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+_cpu_nodes = None
+
+def parse_cpulist(cpulist):
+    """"0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]"""
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus.extend(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def format_cpulist(cpus):
+    return ",".join(str(cpu) for cpu in sorted(cpus))
+
+def cpu_nodes():
+    """key: cpu id, value: NUMA node id; all cpus on node 0 if unknown"""
+    global _cpu_nodes
+    if _cpu_nodes is None:
+        _cpu_nodes = {}
+        for node_dir in glob.glob("/sys/devices/system/node/node[0-9]*"):
+            node = int(os.path.basename(node_dir)[4:])
+            try:
+                with open(os.path.join(node_dir, "cpulist"), "r") as f:
+                    for cpu in parse_cpulist(f.read()):
+                        _cpu_nodes[cpu] = node
+            except OSError:
+                continue
+    return _cpu_nodes
+
+def node_of(cpu):
+    return cpu_nodes().get(cpu, 0)
+
+def pin_command(cmd, cores):
+    """Wrap a shell command so it runs on cores, with memory on their NUMA nodes
+
+    Uses numactl if installed (cpu + memory binding), else taskset (cpu only).
+    cmd may be str or bytes; the same type is returned.
+    """
+    if not cores:
+        return cmd
+
+    is_bytes = isinstance(cmd, bytes)
+    if is_bytes:
+        cmd = cmd.decode('utf-8')
+
+    # a hostfile listing more cpus than this host has shouldn't fail the task
+    allowed = os.sched_getaffinity(0)
+    usable = [core for core in cores if core in allowed]
+    if len(usable) < len(cores):
+        logger.warning(f"Cores {sorted(set(cores) - allowed)} not usable on this host")
+    if len(usable) == 0:
+        return cmd.encode('utf-8') if is_bytes else cmd
+
+    cpulist = format_cpulist(usable)
+    if shutil.which('numactl') is not None:
+        nodes = format_cpulist(set(node_of(core) for core in usable))
+        wrapped = f"numactl --physcpubind={cpulist} --membind={nodes} sh -c {shlex.quote(cmd)}"
+    elif shutil.which('taskset') is not None:
+        wrapped = f"taskset -c {cpulist} sh -c {shlex.quote(cmd)}"
+    else:
+        logger.warning(f"Neither numactl nor taskset found, running unpinned: {cmd}")
+        wrapped = cmd
+
+    return wrapped.encode('utf-8') if is_bytes else wrapped
+
+def pick_cores(available_cores, affinity_priority, count):
+    """Choose count cores out of available_cores for one task
+
+    Prefers, in order:
+    1. a run of count consecutive entries of affinity_priority, all free
+       and on the same NUMA node (e.g. adjacent cores sharing caches)
+    2. count free cores on a single NUMA node, in priority order
+    3. the first count free cores in priority order
+    returns a list, or None if fewer than count cores are free
+    """
+    free = [core for core in affinity_priority if core in available_cores]
+    if len(free) < count:
+        return None
+
+    for start in range(0, len(affinity_priority) - count + 1):
+        window = affinity_priority[start:start + count]
+        if all(core in available_cores for core in window) \
+                and len(set(node_of(core) for core in window)) == 1:
+            return list(window)
+
+    by_node = {}
+    for core in free:
+        by_node.setdefault(node_of(core), []).append(core)
+    for cores in by_node.values():
+        if len(cores) >= count:
+            return cores[:count]
+
+    return free[:count]
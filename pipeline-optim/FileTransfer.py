@@ -0,0 +1,127 @@
+"""Files moved between hosts over the executor protocol
+
+PUT, GET and STAT let intermediate files and results be staged between
+nodes, and node-local scratch be used, without a shared NFS mount. The
+sending side hands FILE_CHUNK_SIZE pieces to loop.sendfile(), so file
+contents never pass through user space there; the receiving side writes
+them to <path>.part and renames it into place once complete.
+
+With a checksum, the sender's sha256 of the file travels ahead of the
+data and the receiver hashes what it got before accepting it. Hashing on
+the sending side reads the file once more, so checksums are optional.
+"""
+
+import hashlib
+import os
+import shutil
+
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# status of a PUT, GET or STAT
+FILE_OK = 0
+FILE_ERROR = 1
+FILE_NOT_FOUND = 2
+FILE_CHECKSUM_MISMATCH = 3
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def error_status(error):
+    return FILE_NOT_FOUND if isinstance(error, FileNotFoundError) else FILE_ERROR
+
+def stat_file(path, checksum=False):
+    """returns dict of size, mtime_ns and sha256 (None without checksum),
+    None if path doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return {
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'sha256': sha256_file(path) if checksum else None
+    }
+
+def copy_file(src, dst, checksum=False):
+    """The local PUT / GET: copy src to dst like IncomingFile would
+    returns the size copied
+    """
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    shutil.copyfile(src, dst + ".part")
+    if checksum and sha256_file(src) != sha256_file(dst + ".part"):
+        os.remove(dst + ".part")
+        raise Exception(f"Checksum mismatch copying {src} to {dst}")
+    os.replace(dst + ".part", dst)
+    return os.path.getsize(dst)
+
+class IncomingFile:
+    """A file received chunk by chunk
+    digest: expected sha256 hex digest, None not to check
+    """
+    def __init__(self, path, size, digest=None):
+        self.path = path
+        self.part_path = path + ".part"
+        self.size = size
+        self.digest = digest
+        self.received = 0
+        self.hasher = hashlib.sha256() if digest else None
+        self.file = None
+        # (status, message) once something went wrong; later chunks are
+        # still taken, and dropped, to keep the connection in step
+        self.error = None
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.file = open(self.part_path, "wb")
+        except OSError as e:
+            self.error = (error_status(e), str(e))
+
+    def complete(self):
+        return self.received >= self.size
+
+    def write(self, data):
+        self.received += len(data)
+        if self.error is not None:
+            return
+        try:
+            self.file.write(data)
+        except OSError as e:
+            self.discard(error_status(e), str(e))
+            return
+        if self.hasher is not None:
+            self.hasher.update(data)
+
+    def discard(self, status, message):
+        self.error = (status, message)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            try:
+                os.remove(self.part_path)
+            except OSError:
+                pass
+
+    def finish(self):
+        """Check and move the file into place
+        returns (status, message)
+        """
+        if self.error is not None:
+            return self.error
+        if self.received != self.size:
+            self.discard(FILE_ERROR, f"Got {self.received} of {self.size} bytes of {self.path}")
+            return self.error
+        if self.hasher is not None and self.hasher.hexdigest() != self.digest:
+            self.discard(FILE_CHECKSUM_MISMATCH, f"Checksum mismatch receiving {self.path}")
+            return self.error
+        try:
+            self.file.close()
+            self.file = None
+            os.replace(self.part_path, self.path)
+        except OSError as e:
+            self.discard(error_status(e), str(e))
+            return self.error
+        return FILE_OK, ""
@@ -3,15 +3,25 @@ import asyncio, logging
 from functools import reduce
 from RemoteExecutor import ExecutorClient
 from LocalExecutor import LocalExecutor
+from Resources import ResourceVector, parse_size
 
 logger = logging.getLogger(__name__)
 
 class HostManager:
-    def __init__(self):
+    def __init__(self, bind_core=True, metrics=None):
+        """bind_core: pin every task to cores picked from the host's affinity list
+        metrics: a Metrics.MetricsRegistry for the remote executors' traffic
+        """
+        self.bind_core = bind_core
+        self.metrics = metrics
         self.remote_executors = []
         self.local_executors = []
         self.executor_slots = {}
         self.executor_priorities = {}
+        self.executor_capacities = {}
+        # remote executors whose affinity is the default one, which follows
+        # the slot count their server reports
+        self.default_affinity = set()
 
     def all_executors(self):
         return self.remote_executors + self.local_executors
@@ -22,25 +32,41 @@ class HostManager:
     def get_dispatch_hint(self, executor):
         return {
             "affinity_priority": self.executor_priorities[executor],
-            "bind_core": True
+            "bind_core": self.bind_core,
+            "capacity": self.executor_capacities[executor]
             }
 
     def total_slots(self):
         return reduce(lambda x, y: x + y, self.executor_slots.values())
 
-    def add_local(self, slots, affinity):
-        logger.info(f"Added local executor, slots={slots}")
-        executor = LocalExecutor()
+    def get_capacity(self, executor):
+        return self.executor_capacities[executor]
+
+    def add_local(self, slots, affinity=None, mem=None, io=None, measure_usage=False):
+        """mem: bytes of memory for tasks, io: total io weight; None for unlimited
+        measure_usage: record the CPU, memory and I/O of every command, at
+                       the cost of an interpreter start per command
+        """
+        if affinity is None:
+            affinity = list(range(0, slots))
+        logger.info(f"Added local executor, slots={slots}, affinity={affinity}, mem={mem}, io={io}")
+        executor = LocalExecutor(measure_usage)
         self.local_executors.append(executor)
         self.executor_slots[executor] = slots
         self.executor_priorities[executor] = affinity
+        self.executor_capacities[executor] = ResourceVector.capacity(slots, mem, io)
 
-    def add_remote(self, host, port, slots, affinity):
-        logger.info(f"Added remote executor, host={host}, port={port}, slots={slots}, affinity={affinity}")
-        executor = ExecutorClient(host, port)
+    def add_remote(self, host, port, slots, affinity=None, mem=None, io=None, measure_usage=False):
+        """slots and mem are replaced by what the server admits once connected"""
+        executor = ExecutorClient(host, port, self.metrics, measure_usage=measure_usage)
+        if affinity is None:
+            affinity = list(range(0, slots))
+            self.default_affinity.add(executor)
+        logger.info(f"Added remote executor, host={host}, port={port}, slots={slots}, affinity={affinity}, mem={mem}, io={io}")
         self.remote_executors.append(executor)
         self.executor_slots[executor] = slots
         self.executor_priorities[executor] = affinity
+        self.executor_capacities[executor] = ResourceVector.capacity(slots, mem, io)
 
     def get_base_executor(self):
         if len(self.local_executors) > 0:
@@ -54,6 +80,29 @@ class HostManager:
         await asyncio.gather(
             *map(lambda x: x.connect(), self.remote_executors)
         )
+        await asyncio.gather(
+            *map(self.adopt_server_limits, self.remote_executors)
+        )
+
+    async def adopt_server_limits(self, executor):
+        """Take the slot count the server admits commands for, and its
+        memory budget if that's tighter, over what the hostfile said
+        """
+        info = await executor.info()
+        slots = info['slots']
+        if executor not in self.default_affinity and len(self.executor_priorities[executor]) < slots:
+            # no more cores to pin to than the affinity list has
+            slots = len(self.executor_priorities[executor])
+        if slots != self.executor_slots[executor]:
+            logger.warning(f"{executor.host} admits {slots} slots, not {self.executor_slots[executor]}; using {slots}")
+        if executor in self.default_affinity:
+            self.executor_priorities[executor] = list(range(0, slots))
+        self.executor_slots[executor] = slots
+
+        capacity = self.executor_capacities[executor]
+        mem = capacity.mem if info['mem'] is None else min(capacity.mem, info['mem'])
+        self.executor_capacities[executor] = ResourceVector(slots, mem, capacity.io)
+        logger.info(f"Remote executor {executor.host}: slots={slots}, mem={mem}, queued={info['queued']}")
 
     async def close_remote(self):
         await asyncio.gather(
@@ -62,20 +111,83 @@ class HostManager:
 
 
     @staticmethod
-    def from_hostfile(filename):
-        mgr = HostManager()
+    def parse_affinity(token):
+        """'0:2:4' -> [0, 2, 4]"""
+        return [int(i) for i in token.split(':')]
+
+    @staticmethod
+    def parse_options(tokens):
+        """Split 'key=value' capacity (and usage) options from positional tokens"""
+        positional = [token for token in tokens if '=' not in token]
+        options = dict(token.split('=', 1) for token in tokens if '=' in token)
+
+        capacity = {}
+        if 'mem' in options:
+            capacity['mem'] = parse_size(options.pop('mem'))
+        if 'io' in options:
+            capacity['io'] = float(options.pop('io'))
+        if 'usage' in options:
+            capacity['measure_usage'] = options.pop('usage') == '1'
+        if len(options) > 0:
+            raise Exception(f"Unknown host options: {options}")
+
+        return positional, capacity
+
+    @staticmethod
+    def parse_hostfile(filename):
+        """Lines are
+        remote host port slots [affinity] [mem=<size>] [io=<weight>] [usage=1]
+        local slots [affinity] [mem=<size>] [io=<weight>] [usage=1]
+        where affinity is a ':' separated cpu list, in order of preference,
+        defaulting to 0:1:...:slots-1; mem (e.g. 256G) and io bound the sum
+        of what concurrent tasks declare, and are unlimited if left out.
+        For a remote host, slots (and mem, if it's larger) only stand until
+        connect_remote() learns what its server admits. usage=1 measures
+        the CPU, memory and I/O of every command, which costs an interpreter
+        start per command.
+
+        returns a list of dicts: kind ('remote' / 'local'), host, port,
+        slots, affinity (None: default) and capacity (mem / io /
+        measure_usage keywords)
+        """
+        entries = []
         with open(filename, "r") as f:
             lines = f.readlines()
             for line in lines:
                 stripped = line.strip()
-                if stripped[0] == '#':
+                if len(stripped) == 0 or stripped[0] == '#':
                     continue
                 
-                tokens = stripped.split(' ')
+                tokens, capacity = HostManager.parse_options(stripped.split())
                 if tokens[0] == 'remote':
-                    mgr.add_remote(tokens[1], int(tokens[2]), int(tokens[3]), [int(i) for i in tokens[4].split(':')])
+                    entries.append({
+                        'kind': 'remote',
+                        'host': tokens[1],
+                        'port': int(tokens[2]),
+                        'slots': int(tokens[3]),
+                        'affinity': HostManager.parse_affinity(tokens[4]) if len(tokens) > 4 else None,
+                        'capacity': capacity
+                    })
                 elif tokens[0] == 'local':
-                    mgr.add_local(int(tokens[1]), [int(i) for i in tokens[2].split(':')])
+                    entries.append({
+                        'kind': 'local',
+                        'host': 'localhost',
+                        'port': None,
+                        'slots': int(tokens[1]),
+                        'affinity': HostManager.parse_affinity(tokens[2]) if len(tokens) > 2 else None,
+                        'capacity': capacity
+                    })
                 else:
                     raise Exception(f"Unknown host type: '{tokens[0]}'")
-        return mgr
\ No newline at end of file
+        return entries
+
+    @staticmethod
+    def from_hostfile(filename, bind_core=True, metrics=None):
+        """See parse_hostfile() for the format"""
+        mgr = HostManager(bind_core, metrics)
+        for entry in HostManager.parse_hostfile(filename):
+            if entry['kind'] == 'remote':
+                mgr.add_remote(entry['host'], entry['port'], entry['slots'], entry['affinity'], **entry['capacity'])
+            else:
+                mgr.add_local(entry['slots'], entry['affinity'], **entry['capacity'])
+        return mgr
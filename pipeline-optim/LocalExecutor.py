@@ -2,29 +2,129 @@
 
 import asyncio
 import logging
+import ProcessUsage
+from CpuTopology import pin_command
+from CommandStream import CommandStream, DEFAULT_MAX_BUFFERED, run_streamed
+from ProcessGroup import CommandSet, TIMEOUT_STATUS
+import FileTransfer
 
 logger = logging.getLogger(__name__)
 
 class LocalExecutor:
-    def __init__(self):
-        pass
-
-    async def execute(self, cmd):
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=None
-        )
-
-        stdout, _ = await proc.communicate()
-        return (proc.returncode, stdout.decode('utf-8'))
-    
-    async def execute_no_output(self, cmd):
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=None
-        )
-
-        await proc.wait()
-        return proc.returncode
\ No newline at end of file
+    host = 'localhost'
+
+    def __init__(self, measure_usage=False):
+        """measure_usage: run commands of execute_with_usage() under the
+        ProcessUsage wrapper, which costs an interpreter start each
+        """
+        self.measure_usage = measure_usage
+        # commands running, so they can be killed
+        self.commands = CommandSet()
+        self.next_key = 0
+
+    def expect_command(self, timeout):
+        key = self.next_key
+        self.next_key += 1
+        self.commands.expect(key, timeout)
+        return key
+
+    async def run_command(self, run, timeout):
+        """await run(started) of a command, killing its process group if
+        it runs longer than timeout seconds or the caller is cancelled
+        returns (what run returned, whether it ran out of time)
+        """
+        key = self.expect_command(timeout)
+        try:
+            result = await run(lambda proc: self.commands.started(key, proc))
+        except asyncio.CancelledError:
+            self.commands.cancel(key)
+            await self.commands.wait_killed(key)
+            raise
+        finally:
+            reason = self.commands.finished(key)
+        return result, reason == 'timeout'
+
+    async def execute(self, cmd, cores=None, timeout=None):
+        """cores: list of cpu ids to pin the command to, None for unpinned
+        timeout: seconds after which the command is killed, and reports
+                 TIMEOUT_STATUS; None for no limit
+        """
+        async def run(started):
+            proc = await asyncio.create_subprocess_shell(
+                pin_command(cmd, cores),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None,
+                start_new_session=True
+            )
+            started(proc)
+            stdout, _ = await proc.communicate()
+            return proc.returncode, stdout
+
+        (retcode, stdout), timed_out = await self.run_command(run, timeout)
+        return (TIMEOUT_STATUS if timed_out else retcode, stdout.decode('utf-8'))
+
+    async def execute_with_usage(self, cmd, cores=None, timeout=None, mem=None):
+        """Like execute(), but also returns the resource usage of the command
+        mem: ignored, the runner's capacity already bounds what runs here
+        returns (retcode, stdout, usage), usage as reported by ProcessUsage,
+        None unless measure_usage
+        """
+        if not self.measure_usage:
+            retcode, stdout = await self.execute(cmd, cores, timeout)
+            return retcode, stdout, None
+        (retcode, stdout, usage), timed_out = await self.run_command(
+            lambda started: ProcessUsage.execute(pin_command(cmd, cores), started), timeout)
+        return (TIMEOUT_STATUS if timed_out else retcode, stdout.decode('utf-8'), usage)
+
+    async def execute_stream(self, cmd, cores=None, max_buffered=DEFAULT_MAX_BUFFERED, timeout=None):
+        """Like execute(), but stdout and stderr are handed over as they
+        are produced, at most max_buffered chunks ahead of the consumer
+        returns a CommandStream, whose cancel() kills the command
+        """
+        stream = CommandStream(max_buffered)
+        key = self.expect_command(timeout)
+        async def produce():
+            try:
+                retcode = await run_streamed(
+                    pin_command(cmd, cores), stream.put_chunk, lambda proc: self.commands.started(key, proc))
+            except BaseException as e:
+                self.commands.cancel(key)
+                try:
+                    await self.commands.wait_killed(key)
+                finally:
+                    self.commands.finished(key)
+                stream.fail(e)
+                if not isinstance(e, Exception):
+                    raise
+                return
+            if self.commands.finished(key) == 'timeout':
+                retcode = TIMEOUT_STATUS
+            await stream.put_end(retcode)
+        stream.canceller = lambda: self.commands.cancel(key)
+        stream.producer = asyncio.create_task(produce())
+        return stream
+
+    async def put_file(self, local_path, path, checksum=False):
+        """Same as ExecutorClient.put_file(), a plain copy here"""
+        return await asyncio.to_thread(FileTransfer.copy_file, local_path, path, checksum)
+
+    async def get_file(self, path, local_path, checksum=False):
+        return await asyncio.to_thread(FileTransfer.copy_file, path, local_path, checksum)
+
+    async def stat_file(self, path, checksum=False):
+        return await asyncio.to_thread(FileTransfer.stat_file, path, checksum)
+
+    async def execute_no_output(self, cmd, cores=None, timeout=None):
+        async def run(started):
+            proc = await asyncio.create_subprocess_shell(
+                pin_command(cmd, cores),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None,
+                start_new_session=True
+            )
+            started(proc)
+            await proc.wait()
+            return proc.returncode
+
+        retcode, timed_out = await self.run_command(run, timeout)
+        return TIMEOUT_STATUS if timed_out else retcode
\ No newline at end of file
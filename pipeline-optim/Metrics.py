@@ -0,0 +1,193 @@
+"""Counters, gauges and histograms served in Prometheus text format
+
+    registry = MetricsRegistry()
+    tasks = registry.counter('tasks_total', 'Tasks completed', ['tool'])
+    tasks.inc(tool='realfft')
+    await MetricsServer(registry, port=9464).start()
+
+then scrape http://localhost:9464/metrics. Gauges may be given a
+function instead, evaluated on every scrape, for values that already
+live elsewhere (e.g. the length of the ready queue).
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PORT = 9464
+# seconds, from a PING round trip up to a long prepsubband
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600]
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels.keys(), escaped)) + "}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    def __init__(self, name, help, label_names=None, function=None):
+        """function: returns the value, or a dict of label values tuple -> value"""
+        self.name = name
+        self.help = help
+        self.label_names = label_names or []
+        self.function = function
+        # key: tuple of label values
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels.keys()) != set(self.label_names):
+            raise Exception(f"Metric {self.name} takes labels {self.label_names}, got {list(labels.keys())}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def labels_of(self, key):
+        return dict(zip(self.label_names, key))
+
+    def samples(self):
+        """[(suffix, labels, value)]"""
+        if self.function is None:
+            return [("", self.labels_of(key), value) for key, value in self.values.items()]
+        value = self.function()
+        if isinstance(value, dict):
+            return [("", self.labels_of(key), v) for key, v in value.items()]
+        return [("", {}, value)]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, label_names=None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = sorted(buckets) + [float('inf')]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        entry = self.values[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry['counts'][i] += 1
+        entry['sum'] += value
+        entry['count'] += 1
+
+    def samples(self):
+        samples = []
+        for key, entry in self.values.items():
+            labels = self.labels_of(key)
+            for bound, count in zip(self.buckets, entry['counts']):
+                samples.append(("_bucket", dict(labels, le=format_value(bound)), count))
+            samples.append(("_sum", labels, entry['sum']))
+            samples.append(("_count", labels, entry['count']))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """Add metric; one of the same name, type and labels (e.g. from
+        another ExecutorClient) is shared instead
+        """
+        known = self.metrics.get(metric.name)
+        if known is not None:
+            if type(known) != type(metric) or known.label_names != metric.label_names or metric.function is not None:
+                raise Exception(f"Metric {metric.name} registered twice")
+            return known
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, label_names=None, function=None):
+        return self.register(Counter(name, help, label_names, function))
+
+    def gauge(self, name, help, label_names=None, function=None):
+        return self.register(Gauge(name, help, label_names, function))
+
+    def histogram(self, name, help, label_names=None, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, label_names, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+class MetricsServer:
+    """Serves GET /metrics of registry over plain HTTP/1.0"""
+    def __init__(self, registry, host='127.0.0.1', port=DEFAULT_METRICS_PORT):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            # skip the headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            if len(request_line) >= 2 and request_line[0] == 'GET' and request_line[1].split('?')[0] == '/metrics':
+                status, body = "200 OK", self.registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def parse_metrics_port(args):
+    """Remove "--metrics-port <port>" from args, returns the port or None"""
+    if '--metrics-port' not in args:
+        return None
+    i = args.index('--metrics-port')
+    if i + 1 >= len(args):
+        raise Exception("--metrics-port needs a port number")
+    metrics_port = int(args[i + 1])
+    del args[i:i + 2]
+    return metrics_port
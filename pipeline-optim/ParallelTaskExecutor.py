@@ -1,25 +1,118 @@
 import asyncio
+import concurrent.futures
 import logging
-from functools import reduce
+import heapq
 from LocalExecutor import LocalExecutor
+from RemoteExecutor import ExecutorDisconnected
+from ProcessGroup import TIMEOUT_STATUS
+from TaskPriority import get_policy
+from TaskHistory import CostModel, task_tool
+from CpuTopology import pick_cores
+from Resources import ResourceVector
+from RetryPolicy import NO_RETRY
+from ProcessUsage import merge_usage
+from TaskBatch import batch_command, parse_batch_output
 
 logger = logging.getLogger(__name__)
 
+class TaskFailed(Exception):
+    """A task failed for good, or was dropped because a dependency did"""
+    def __init__(self, message, retcode=None, failed_task=None):
+        """retcode: exit code of the failed action, if it ran
+        failed_task: for a cancelled task, the failed task it depended on
+        """
+        super().__init__(message)
+        self.retcode = retcode
+        self.failed_task = failed_task
+
 class ParallelTask:
     PENDING = 1
     WORKING = 2
     FINISHED = 3
+    # gave up after its last attempt failed
+    FAILED = 4
+    # never ran, as a task it depends on failed, or cancelled by cancel_task()
+    CANCELLED = 5
 
-    def __init__(self, uuid, name, deps, actions, slots_required):
+    def __init__(self, uuid, name, deps, actions, slots_required, cost=1.0, resources=None, on_complete=None,
+                 retry_policy=NO_RETRY, input_files=None, output_files=None, max_slots=None, widen=None,
+                 coalesce=False, timeout=None):
         self.uuid = uuid
         self.status = ParallelTask.PENDING
         self.name = name
         self.deps = deps
         self.actions = actions
         self.successors = []
-        self.slots_required = slots_required
-        
+        # resources.cores is what used to be the only dimension, the slots
+        self.resources = resources if resources is not None else ResourceVector(slots_required)
+        self.slots_required = self.resources.cores
+        # estimated run time, in arbitrary but consistent units
+        self.cost = cost
+        # whether cost is in seconds: predicted by the CostModel, or the
+        # executor's caller passes seconds
+        self.cost_in_seconds = False
+
+        # a malleable task may run with up to max_slots threads when cores
+        # would idle otherwise; widen(action, threads) gives the action for
+        # that many threads. resources / slots_required are of the current run
+        self.base_resources = self.resources
+        self.max_slots = max(max_slots or 0, self.slots_required)
+        self.widen = widen
+        self.threads = self.slots_required
+        # when the executor first held the task back for more cores
+        self.held_since = None
+        # short enough to share one execution with other such tasks
+        self.coalesce = coalesce
+        # seconds each action may run before it's killed, None for no limit
+        self.timeout = timeout
+
+        # number of deps not yet FINISHED, maintained by the executor
+        self.remaining_deps = 0
+
         self.running_core = None
+        self.start_time = None
+        # when the winning copy finished; None if it didn't run here
+        self.finish_time = None
+        # when it was last handed to a runner
+        self.dispatch_time = None
+        # every attempt and speculative copy: runner, host, cores, queued /
+        # dispatched / start / end times, (cmd, start, end, retcode, usage)
+        # per action and their summed usage, for TaskTrace
+        self.runs = []
+        # ProcessUsage figures of the winning copy, None if not measured
+        self.usage = None
+
+        # called with (uuid, outputs) once the task finished, may add tasks
+        self.on_complete = on_complete
+        # stdout of each action, of the copy that finished first
+        self.outputs = None
+
+        self.retry_policy = retry_policy
+        # runs started, not counting speculative copies
+        self.attempts = 0
+        # hosts an attempt failed on, avoided by other_host retries
+        self.failed_hosts = set()
+        # runners not to be given the task (again)
+        self.excluded_runners = set()
+        # TaskFailed of the last failed attempt, or why it was cancelled
+        self.error = None
+
+        # files read and written, paths as seen from here, for the journal
+        self.input_files = input_files if input_files is not None else []
+        self.output_files = output_files if output_files is not None else []
+        # StageCache key, None if the task isn't cached
+        self.cache_key = None
+
+        # where the task ran, i.e. where its outputs were written
+        self.runner_uuid = None
+        self.host = None
+        # runners currently running a copy of the task (>1 when speculating)
+        self.running_on = set()
+
+        # ready queue bookkeeping, see ReadyQueue
+        self.queued = False
+        self.ready_time = None
+        self.preferred_runners = set()
 
     def __repr__(self):
         return f"Task #{self.uuid}"
@@ -27,6 +120,21 @@ class ParallelTask:
     def add_successor(self, successor_task):
         self.successors.append(successor_task)
 
+    def is_malleable(self):
+        return self.max_slots > self.base_resources.cores and self.widen is not None
+
+    def set_threads(self, threads):
+        """Size the next run for threads cores"""
+        self.threads = threads
+        self.resources = ResourceVector(threads, self.base_resources.mem, self.base_resources.io)
+        self.slots_required = threads
+
+    def run_actions(self):
+        """The actions, adapted to the threads granted"""
+        if self.threads == self.base_resources.cores:
+            return self.actions
+        return [self.widen(action, self.threads) for action in self.actions]
+
 class ParallelRunner:
     def __init__(self, uuid, task_executor, notify_ev, dispatch_hint, executor_inst, num_slots):
         self.uuid = uuid
@@ -39,19 +147,84 @@ class ParallelRunner:
         self.dispatch_hint = dispatch_hint
         self.executor_inst = executor_inst
         self.num_slots = num_slots
+        # the host advertises its other dimensions through the dispatch hint
+        if dispatch_hint and 'capacity' in dispatch_hint:
+            capacity = dispatch_hint['capacity']
+            self.capacity = ResourceVector(num_slots, capacity.mem, capacity.io)
+        else:
+            self.capacity = ResourceVector.capacity(num_slots)
 
-        self.used_slots = 0
+        self.used = ResourceVector()
         self.task_insts = {}
         self.async_task_insts = {}
 
         self.closing = False
+        # taken out of the executor as its host is gone, see remove_runner()
+        self.lost = False
 
-        self.available_cores = set([i for i in range(0, self.num_slots)])
-        print(f"available_cores: {self.available_cores}")
+        # seconds from start_runners() until all slots were first in use
+        self.full_occupancy_time = None
+        # commands started and not yet returned
+        self.commands_in_flight = 0
+
+        # dispatch_hint may be empty, in which case nothing is pinned
+        self.bind_core = bool(dispatch_hint) and dispatch_hint['bind_core']
+        if self.bind_core:
+            self.available_cores = set(self.dispatch_hint['affinity_priority'])
+            assert(len(self.available_cores) >= self.num_slots)
+        else:
+            self.available_cores = set()
+        logger.debug(f"Runner {self.uuid} available_cores: {self.available_cores}")
 
     def __repr__(self):
         return f"Runner #{self.uuid}"
 
+    @property
+    def host(self):
+        return getattr(self.executor_inst, 'host', 'localhost')
+
+    async def execute_action(self, cmd, cores, run=None, timeout=None, mem=0):
+        """Execute cmd pinned to cores (None: unpinned),
+        recording its run time and resource usage into the executor's
+        history, and into run['actions'] if given
+        timeout: seconds until the command is killed, None for no limit
+        mem: bytes of memory it declares to the executor's admission control
+        """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        # executors without timeouts are fine for tasks without one
+        limit = {'timeout': timeout} if timeout is not None else {}
+        self.commands_in_flight += 1
+        try:
+            if hasattr(self.executor_inst, 'execute_with_usage'):
+                declared = {'mem': mem} if mem else {}
+                retcode, stdout, usage = await self.executor_inst.execute_with_usage(cmd, cores, **limit, **declared)
+            else:
+                retcode, stdout = await self.executor_inst.execute(cmd, cores, **limit)
+                usage = None
+        finally:
+            self.commands_in_flight -= 1
+
+        end_time = loop.time()
+        if run is not None:
+            run['actions'].append((cmd, start_time, end_time, retcode, usage))
+            run['usage'] = merge_usage(run['usage'], usage)
+        self.task_executor.record_run(self, cmd, end_time - start_time, usage)
+        return retcode, stdout
+
+    @property
+    def used_slots(self):
+        return self.used.cores
+
+    def free_resources(self):
+        return self.capacity - self.used
+
+    def is_up(self):
+        """Whether tasks may be given to it: not lost, and connected
+        unless its executor is local
+        """
+        return not self.lost and getattr(self.executor_inst, 'connected', True)
+
     def is_available(self):
         """Whether this runner have spare slots left"""
         return self.used_slots < self.num_slots
@@ -60,31 +233,139 @@ class ParallelRunner:
         """Return the slots available"""
         return self.num_slots - self.used_slots
 
+    def start_run(self, task_inst):
+        """Take cores for task_inst and open its run record
+        returns (cores, run)
+        """
+        # the cores are held for the whole task, so all of its actions
+        # stay on the same cores (and NUMA node)
+        cores = None
+        if self.bind_core:
+            cores = pick_cores(self.available_cores, self.dispatch_hint['affinity_priority'], task_inst.slots_required)
+            assert(cores is not None)
+            self.available_cores.difference_update(cores)
+        task_inst.running_core = cores
+
+        task_inst.start_time = asyncio.get_running_loop().time()
+        run = {
+            'runner': self.uuid,
+            'host': self.host,
+            'cores': cores,
+            'queued': task_inst.ready_time,
+            'dispatched': task_inst.dispatch_time,
+            'start': task_inst.start_time,
+            'end': None,
+            'actions': [],
+            'usage': None,
+            'status': 'failed',
+            'threads': task_inst.threads
+        }
+        task_inst.runs.append(run)
+        self.task_executor.observe_start(task_inst, run)
+        return cores, run
+
+    def end_run(self, task_inst, cores, run):
+        run['end'] = asyncio.get_running_loop().time()
+        self.task_executor.observe_end(task_inst, run)
+        if cores is not None:
+            self.available_cores.update(cores)
+
     async def run_task(self, task_inst):
         """
         task_inst: ParallelTask
+        returns the stdout of every action
         """
-        core = None
-        if self.dispatch_hint['bind_core']:
-            for possible_guess in self.dispatch_hint['affinity_priority']:
-                if possible_guess in self.available_cores:
-                    self.available_cores.remove(possible_guess)
-                    core = possible_guess
-                    break
-        assert(core is not None)
-
-        for action in task_inst.actions:
-            if self.dispatch_hint['bind_core']:
-                # cmdExecuted = f"taskset -c {core} bash -c '{action}'"
-                # retcode, stdout = await self.executor_inst.execute(cmdExecuted)
-                cmdExecuted = f"{action}"
-                retcode, stdout = await self.executor_inst.execute(cmdExecuted)
-                self.available_cores.add(core)
-            else:
-                cmdExecuted = action
-                retcode, stdout = await self.executor_inst.execute(cmdExecuted)
+        cores, run = self.start_run(task_inst)
+        outputs = []
+        try:
+            for action in task_inst.run_actions():
+                retcode, stdout = await self.execute_action(
+                    action, cores, run, task_inst.timeout, task_inst.resources.mem)
+                logger.debug(f"[{action}] on cores {cores}, retcode={retcode}, output={stdout}")
+                if retcode != 0:
+                    raise TaskFailed(f"[{action}] {self.failure(retcode, task_inst.timeout)} on {self.host}", retcode)
+                outputs.append(stdout)
+            run['status'] = 'ok'
+            return outputs
+        except asyncio.CancelledError:
+            # its command was killed as the task isn't needed any more
+            run['status'] = 'cancelled'
+            raise
+        finally:
+            self.end_run(task_inst, cores, run)
 
-            logger.debug(f"[{cmdExecuted}], retcode={retcode}, output={stdout}")
+    @staticmethod
+    def failure(retcode, timeout):
+        if timeout is not None and retcode == TIMEOUT_STATUS:
+            return f"timed out after {timeout}s"
+        return f"exited with {retcode}"
+
+    def cancel_task(self, task_uuid):
+        """Cancel the run of a task here, killing its command
+        returns whether it was running here
+        """
+        for async_task, uuid in self.async_task_insts.items():
+            if uuid == task_uuid:
+                async_task.cancel()
+                return True
+        return False
+
+    async def run_batch(self, tasks):
+        """Run the single action of each of tasks, all in one execution
+        on the union of their cores (see TaskBatch); their resource usage
+        isn't measured. With a timeout for each, the batch gets the longest.
+        returns (retcode, stdout) per task, None if the batch didn't report it
+        """
+        started = [self.start_run(task) for task in tasks]
+        cmds = [task.run_actions()[0] for task in tasks]
+        batch_cores = [core for cores, _ in started for core in cores] if self.bind_core else None
+        script, marker = batch_command(cmds)
+        timeouts = [task.timeout for task in tasks]
+        limit = {'timeout': max(timeouts)} if None not in timeouts else {}
+
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        self.commands_in_flight += len(tasks)
+        try:
+            retcode, stdout = await self.executor_inst.execute(script, batch_cores, **limit)
+            end_time = loop.time()
+            results = parse_batch_output(stdout, marker, len(tasks))
+            logger.debug(f"Batch of {len(tasks)} on cores {batch_cores}, retcode={retcode}, results={results}")
+            for cmd, (cores, run), result in zip(cmds, started, results):
+                if result is None:
+                    continue
+                # they ran side by side, each gets the batch's wall time
+                run['actions'].append((cmd, start_time, end_time, result[0], None))
+                self.task_executor.record_run(self, cmd, end_time - start_time, None)
+                if result[0] == 0:
+                    run['status'] = 'ok'
+            return results
+        finally:
+            self.commands_in_flight -= len(tasks)
+            for task, (cores, run) in zip(tasks, started):
+                self.end_run(task, cores, run)
+
+    async def run_batched_task(self, task_inst, batch, index, waiting):
+        """task_inst's share of batch, an asyncio task of run_batch()
+        waiting: uuids of the batch's tasks still waiting for it, shared by them
+        returns its outputs like run_task()
+        """
+        try:
+            result = (await asyncio.shield(batch))[index]
+        except asyncio.CancelledError:
+            # the others still get their results; the batch's command is
+            # only killed once none of its tasks wants it any more
+            waiting.discard(task_inst.uuid)
+            if len(waiting) == 0:
+                batch.cancel()
+            raise
+        action = task_inst.run_actions()[0]
+        if result is None:
+            raise TaskFailed(f"[{action}] got no result from its batch on {self.host}")
+        retcode, stdout = result
+        if retcode != 0:
+            raise TaskFailed(f"[{action}] {self.failure(retcode, task_inst.timeout)} on {self.host}", retcode)
+        return [stdout]
 
     async def wait_for_event_helper(self):
         await self.notification_event.wait()
@@ -106,23 +387,42 @@ class ParallelRunner:
             # logger.debug(f"Runner {self.uuid} done={done}")
             if event_wait_task in done:
                 # logger.debug(f"Runner {self.uuid} got event_wait_task")
-                if not self.task_executor.unallocated_tasks_available:
-                    # Message for leaving!
-                    self.closing = True
-                    if len(self.task_insts) == 0:
-                        logger.debug(f"Runner {self.uuid} have completed. Exiting")
-                        break
+                if self.lost or len(self.task_executor.runner_allocated_task[self.uuid]) == 0:
+                    # an open executor may still get tasks submitted; a lost
+                    # runner only waits for the tasks it runs to fail
+                    if self.lost or (self.task_executor.closed and not self.task_executor.work_remaining):
+                        # Message for leaving!
+                        self.closing = True
+                        if len(self.task_insts) == 0:
+                            logger.debug(f"Runner {self.uuid} have completed. Exiting")
+                            break
                 else:
-                    task = self.task_executor.get_task(self)
-                    self.task_insts[task.uuid] = task
-                    async_task = asyncio.create_task(
-                        self.run_task(task),
-                        name=f"Runner_{self.uuid}_task_{task.uuid}"
-                    )
-                    self.async_task_insts[async_task] = task.uuid
+                    # take every task reserved for us in one wake-up
+                    tasks = self.task_executor.get_tasks(self)
+                    # short tasks arriving together share one execution
+                    batched = {}
+                    for batch_tasks in self.task_executor.coalesce(tasks):
+                        batch = asyncio.create_task(
+                            self.run_batch(batch_tasks),
+                            name=f"Runner_{self.uuid}_batch_{batch_tasks[0].uuid}"
+                        )
+                        waiting = {task.uuid for task in batch_tasks}
+                        for index, task in enumerate(batch_tasks):
+                            batched[task.uuid] = self.run_batched_task(task, batch, index, waiting)
+
+                    for task in tasks:
+                        self.task_insts[task.uuid] = task
+                        async_task = asyncio.create_task(
+                            batched[task.uuid] if task.uuid in batched else self.run_task(task),
+                            name=f"Runner_{self.uuid}_task_{task.uuid}"
+                        )
+                        self.async_task_insts[async_task] = task.uuid
 
-                    self.used_slots += task.slots_required
-                    awaitables.add(async_task)
+                        self.used = self.used + task.resources
+                        awaitables.add(async_task)
+
+                    if self.full_occupancy_time is None and self.used_slots >= self.num_slots:
+                        self.full_occupancy_time = asyncio.get_running_loop().time() - self.task_executor.start_time
 
                 self.notification_event.clear()
                 done.remove(event_wait_task)
@@ -141,8 +441,14 @@ class ParallelRunner:
             for async_task in done:
                 # logger.debug(f"Processing async task {async_task}")
                 task_uuid = self.async_task_insts[async_task]
-                self.used_slots -= self.task_insts[task_uuid].slots_required
-                self.task_executor.mark_complete(self.uuid, task_uuid)
+                self.used = self.used - self.task_insts[task_uuid].resources
+                self.task_executor.account_release(self.task_insts[task_uuid])
+                # a copy killed once the task settled, or a task cancelled
+                error = async_task.exception() if not async_task.cancelled() else TaskFailed(f"cancelled on {self.host}")
+                if error is None:
+                    self.task_executor.mark_complete(self.uuid, task_uuid, async_task.result())
+                else:
+                    self.task_executor.mark_failed(self.uuid, task_uuid, error)
                 del self.task_insts[task_uuid]
                 del self.async_task_insts[async_task]
                 awaitables.remove(async_task)
@@ -152,17 +458,194 @@ class ParallelRunner:
 
 
 
+class ReadyQueue:
+    """Ready tasks ordered by priority key, plus one heap per runner holding
+    the ready tasks whose inputs were produced on that runner.
+
+    A task sits in the global heap and in the heaps of its preferred
+    runners; whichever takes it first wins and the other entries are
+    dropped lazily when they surface. Until it waited locality_wait seconds,
+    a task with preferred runners sits in a heap by that deadline instead
+    of the global one, so other runners don't go over it on every pop().
+    """
+    def __init__(self, policy, locality_wait):
+        self.policy = policy
+        self.locality_wait = locality_wait
+        # keys of a dynamic policy change as tasks start; entries are
+        # re-keyed when they surface
+        self.dynamic = getattr(policy, 'dynamic', False)
+        self.heap = []
+        self.local_heaps = {}
+        # (deadline, seq, task) of tasks held for their preferred runners
+        self.delayed = []
+        self.next_seq = 0
+        self.size = 0
+        # cores the queued tasks need at least
+        self.cores = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, task, now):
+        entry = (self.policy.key(task), self.next_seq, task)
+        self.next_seq += 1
+
+        task.queued = True
+        task.ready_time = now
+        if len(task.preferred_runners) > 0:
+            heapq.heappush(self.delayed, (now + self.locality_wait, entry[1], task))
+        else:
+            heapq.heappush(self.heap, entry)
+        for runner_uuid in task.preferred_runners:
+            heapq.heappush(self.local_heaps.setdefault(runner_uuid, []), entry)
+        self.size += 1
+        self.cores += task.slots_required
+
+    def release_delayed(self, now):
+        """Move the tasks which waited long enough for their preferred
+        runners into the global heap
+        returns seconds until the next one has, None if none is held
+        """
+        while len(self.delayed) > 0:
+            deadline, seq, task = self.delayed[0]
+            if not task.queued or deadline != task.ready_time + self.locality_wait:
+                # taken by a preferred runner meanwhile (and maybe queued again)
+                heapq.heappop(self.delayed)
+                continue
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(self.delayed)
+            heapq.heappush(self.heap, (self.policy.key(task), seq, task))
+        return None
+
+    def rekey(self):
+        """Recompute every key after the policy has been re-prepared"""
+        def rebuilt(heap):
+            heap = [(self.policy.key(task), seq, task) for _, seq, task in heap if task.queued]
+            heapq.heapify(heap)
+            return heap
+
+        self.heap = rebuilt(self.heap)
+        for runner_uuid in self.local_heaps:
+            self.local_heaps[runner_uuid] = rebuilt(self.local_heaps[runner_uuid])
+
+    def _take_from(self, heap, accept):
+        """Pop the best queued task of heap for which accept(task) holds"""
+        skipped = []
+        found = None
+        while len(heap) > 0:
+            entry = heapq.heappop(heap)
+            task = entry[2]
+            if not task.queued:
+                # already taken through another heap
+                continue
+            if self.dynamic:
+                key = self.policy.key(task)
+                if key != entry[0]:
+                    heapq.heappush(heap, (key, entry[1], task))
+                    continue
+            if accept(task):
+                found = task
+                break
+            skipped.append(entry)
+
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+
+        if found is not None:
+            found.queued = False
+            self.size -= 1
+            self.cores -= found.slots_required
+        return found
+
+    def pop(self, runner_uuid, free, now, hold=None):
+        """Take the best task for runner whose resources fit into free
+
+        Tasks produced on this runner come first. Tasks whose inputs live on
+        other runners are only given away once they waited locality_wait
+        seconds (delay scheduling).
+        hold(task): seconds task should still wait for more free cores, <= 0
+                    to take it now
+        returns (task or None, seconds until a delayed task becomes eligible)
+        """
+        next_eligible = [self.release_delayed(now)]
+        def delay(wait_left):
+            if next_eligible[0] is None or wait_left < next_eligible[0]:
+                next_eligible[0] = wait_left
+            return False
+
+        def accept_here(task):
+            if not task.resources.fits(free) or runner_uuid in task.excluded_runners:
+                return False
+            if hold is not None:
+                wait_left = hold(task)
+                if wait_left > 0:
+                    return delay(wait_left)
+            return True
+
+        local_heap = self.local_heaps.get(runner_uuid)
+        if local_heap:
+            task = self._take_from(local_heap, accept_here)
+            if task is not None:
+                return task, None
+
+        return self._take_from(self.heap, accept_here), next_eligible[0]
+
+    def discard(self, task):
+        """Drop a queued task, its heap entries are skipped lazily"""
+        if task.queued:
+            task.queued = False
+            self.size -= 1
+            self.cores -= task.slots_required
+
 class ParallelTaskExecutor:
     RUNNER_IDLE = 0
     RUNNER_WORKING = 1  # working, but have slots left
     RUNNER_BUSY = 2
 
-    def __init__(self):
+    def __init__(self, priority_policy=None, history=None, locality_wait=2.0,
+                 speculation=False, speculation_ratio=1.5, speculation_min_time=60.0,
+                 retry_policy=NO_RETRY, journal=None, cache=None, metrics=None, malleable_wait=0.5,
+                 max_batch=16, cost_in_seconds=False):
+        """priority_policy: a TaskPriority policy or its name, FIFO by default
+        history: a TaskHistory to record run times into and predict costs from
+        locality_wait: seconds a ready task is held back for the runner that
+                       produced its inputs before other runners may take it
+        speculation: let idle runners start backup copies of straggling
+                     tasks, the first copy to finish wins; only for tasks
+                     which may safely run twice at once
+        speculation_ratio, speculation_min_time: a task is a straggler once
+                     it ran longer than both speculation_min_time seconds and
+                     speculation_ratio times its cost as predicted from the
+                     history; tasks without one aren't backed up
+        retry_policy: RetryPolicy of tasks added without one, no retries by default
+        journal: a TaskJournal to record completed tasks into; tasks found
+                 in it with unchanged inputs and outputs are not run again.
+                 It is keyed by task name, so names must be unique
+        cache: a StageCache; tasks with output_files whose key is found
+               there get their outputs linked in instead of running
+        metrics: a Metrics.MetricsRegistry to export the executor's state
+                 and timings through
+        malleable_wait: at a stage's tail, when the ready tasks can't keep
+                 every core busy, a malleable task waits up to this fraction
+                 of its predicted cost for a fair share of the cores, then
+                 starts with whatever is free; one without a prediction
+                 starts right away
+        cost_in_seconds: the costs tasks are added with are seconds (e.g.
+                 simulated durations), as good as predictions for the above
+        max_batch: most coalesce=True tasks run as one execution
+        """
         self.task_insts = {}
         self.registered_runners = {}
+        # runners removed as their host died, key: runner.uuid
+        self.lost_runners = {}
+        # tasks run again as their runner's connection was lost
+        self.requeued_tasks = 0
 
-        # tasks to be given to the runners
+        # tasks to be given to the runners, key: runner.uuid value: List[task]
         self.runner_allocated_task = {}
+        # sum of resources over runner_allocated_task[runner.uuid]
+        self.runner_allocated_resources = {}
 
         # asyncio.Events() for each runner
         # set if they've got works to do
@@ -174,12 +657,142 @@ class ParallelTaskExecutor:
 
         # key: task.uuid value: task in task_insts
         self.pending_tasks = {}
+        # running totals, kept by add_pending() / remove_pending() and
+        # add_runner() / remove_runner(), so tail_spare_cores() is O(1)
+        self.pending_cores = 0
+        self.total_slots = 0
         self.working_tasks = {}
         self.finished_tasks = {}
+        self.failed_tasks = {}
+        self.cancelled_tasks = {}
+
+        # pending tasks whose deps are all finished and which have not been
+        # handed to any runner yet
+        self.priority_policy = get_policy(priority_policy)
+        self.ready_tasks = ReadyQueue(self.priority_policy, locality_wait)
+        # graph changed since the policy last looked at it
+        self.priority_dirty = True
+        # a dynamic policy's keys dropped since the queue was last keyed
+        self.keys_stale = False
+        self.last_rekey = None
+        # seconds between re-keys for dropped keys; until then tasks whose
+        # keys dropped may wait behind others
+        self.rekey_interval = 1.0
 
-        self.unallocated_tasks_available = False
+        # some task is not finished yet; runners keep listening until it's
+        # false, as idle runners may still steal or run speculative copies
+        self.work_remaining = False
 
         self.async_runner_tasks = []
+        self.start_time = None
+
+        # loop the runners run on, submit() from other threads goes through it
+        self.loop = None
+        # no more submit() once closed, runners exit when the work drained
+        self.closed = False
+        # key: task.uuid value: asyncio.Future of a submit()ted task
+        self.task_futures = {}
+        # key: future returned by submit() value: task.uuid
+        self.future_tasks = {}
+
+        self.history = history
+        self.cost_model = CostModel(history) if history is not None else None
+        self.eta_report_interval = 30.0
+        self.last_eta_report = None
+
+        self.locality_wait = locality_wait
+        # pending call to update_alloc, for delayed or speculative decisions
+        self.alloc_timer = None
+
+        self.speculation = speculation
+        self.speculation_ratio = speculation_ratio
+        self.speculation_min_time = speculation_min_time
+        self.stolen_tasks = 0
+        self.speculative_copies = 0
+        self.speculative_wins = 0
+        # reads of a dep's outputs on the host that produced them, or not
+        self.local_reads = 0
+        self.remote_reads = 0
+
+        self.retry_policy = retry_policy
+        self.retried_attempts = 0
+
+        self.journal = journal
+        self.resumed_tasks = 0
+
+        self.cache = cache
+        # key: output file, value: the cached task writing it
+        self.cache_producers = {}
+
+        self.malleable_wait = malleable_wait
+        self.cost_in_seconds = cost_in_seconds
+        self.widened_tasks = 0
+        # cores left over for malleable tasks in the current update_alloc()
+        self.spare_cores = 0
+
+        self.max_batch = max_batch
+        self.batches = 0
+        self.batched_tasks = 0
+
+        self.metrics = metrics
+        if metrics is not None:
+            self.register_metrics(metrics)
+
+    def register_metrics(self, metrics):
+        """Gauges read the executor's state on every scrape, the histograms
+        are fed by observe_start() / observe_end() / record_run()
+        """
+        def task_counts():
+            # reserved for a runner but not picked up yet: still ready
+            allocated = sum(1 for tasks in self.runner_allocated_task.values()
+                            for task in tasks if task.status == ParallelTask.PENDING)
+            ready = len(self.ready_tasks) + allocated
+            return {
+                ('pending',): len(self.pending_tasks) - ready,
+                ('ready',): ready,
+                ('running',): len(self.working_tasks),
+                ('finished',): len(self.finished_tasks),
+                ('failed',): len(self.failed_tasks),
+                ('cancelled',): len(self.cancelled_tasks)
+            }
+        def per_runner(value):
+            return lambda: {(str(runner.uuid), runner.host): value(runner) for runner in self.registered_runners.values()}
+
+        metrics.gauge('pipeline_tasks', "Tasks by state; pending ones wait for deps", ['state'], task_counts)
+        metrics.gauge('pipeline_runner_slots', "Slots of each runner", ['runner', 'host'],
+                      per_runner(lambda runner: runner.num_slots))
+        metrics.gauge('pipeline_runner_slots_used', "Slots in use on each runner", ['runner', 'host'],
+                      per_runner(lambda runner: runner.used_slots))
+        metrics.gauge('pipeline_commands_in_flight', "Commands running on each runner", ['runner', 'host'],
+                      per_runner(lambda runner: runner.commands_in_flight))
+        metrics.counter('pipeline_retried_attempts_total', "Failed attempts retried", function=lambda: self.retried_attempts)
+        metrics.counter('pipeline_stolen_tasks_total', "Tasks stolen by idle runners", function=lambda: self.stolen_tasks)
+        metrics.counter('pipeline_speculative_copies_total', "Speculative copies started", function=lambda: self.speculative_copies)
+        metrics.counter('pipeline_requeued_tasks_total', "Tasks re-queued as their host's connection was lost",
+                        function=lambda: self.requeued_tasks)
+        metrics.gauge('pipeline_lost_runners', "Runners removed as their host died", function=lambda: len(self.lost_runners))
+
+        self.queue_wait_metric = metrics.histogram(
+            'pipeline_queue_wait_seconds', "From ready to handed to a runner")
+        self.dispatch_latency_metric = metrics.histogram(
+            'pipeline_dispatch_latency_seconds', "From handed to a runner to started")
+        self.task_duration_metric = metrics.histogram(
+            'pipeline_task_duration_seconds', "Run time of each task run", ['tool', 'status'])
+        self.command_duration_metric = metrics.histogram(
+            'pipeline_command_duration_seconds', "Run time of each command", ['tool', 'host'])
+
+    def observe_start(self, task, run):
+        if self.metrics is None:
+            return
+        if run['queued'] is not None and run['dispatched'] is not None:
+            self.queue_wait_metric.observe(run['dispatched'] - run['queued'])
+        if run['dispatched'] is not None:
+            self.dispatch_latency_metric.observe(run['start'] - run['dispatched'])
+
+    def observe_end(self, task, run):
+        if self.metrics is None:
+            return
+        self.task_duration_metric.observe(run['end'] - run['start'], tool=task_tool(task.actions), status=run['status'])
 
     def alloc_task_uuid(self):
         ret = self.next_task_uuid
@@ -196,30 +809,170 @@ class ParallelTaskExecutor:
     def get_task_by_uuid(self, uuid):
         return self.task_insts[uuid]
     
-    def add_task(self, name, deps, actions, slots_required):
+    def add_task(self, name, deps, actions, slots_required, cost=1.0, resources=None, on_complete=None,
+                 retry_policy=None, input_files=None, output_files=None, max_slots=None, widen=None,
+                 coalesce=False, timeout=None):
         """Construct a parallel task.
         name: name of the task
         deps: List[UUID]
         actions: List[Coroutine], actions to complete this goal
+        cost: estimated run time, used by the priority policy;
+              superseded by the cost model's prediction when there is history
+        resources: ResourceVector needed (cores, memory, io);
+                   defaults to slots_required cores and nothing else
+        on_complete: called as on_complete(uuid, outputs) when the task
+                     finished, outputs being the stdout of each action;
+                     it may add further tasks, e.g. depending on this one
+        retry_policy: RetryPolicy, the executor's one if None
+        input_files, output_files: paths the task reads and writes; with a
+                     journal, the task is skipped if its inputs and outputs
+                     are as they were when it last completed
+        max_slots, widen: a malleable task can also run on up to max_slots
+                     cores, with widen(action, threads) run instead of each
+                     action, e.g. TaskHistory.set_ncpus
+        coalesce: the task (a single, short action) may run in one
+                     execution with other such tasks handed to the same
+                     runner at once, saving a shell and a round trip each
+        timeout: seconds each action may run; a hung one is killed, along
+                     with its process group, and the attempt fails
 
         **Need to call update_alloc() manually after adding all tasks & runners**
+        (or use submit(), which does so)
 
         returns the task uuid created.
         """
-        new_task = ParallelTask(self.alloc_task_uuid(), name, deps, actions, slots_required)
+        predicted = self.cost_model.predict(actions) if self.cost_model is not None else None
+        if retry_policy is None:
+            retry_policy = self.retry_policy
+        new_task = ParallelTask(self.alloc_task_uuid(), name, deps, actions, slots_required,
+                                cost if predicted is None else predicted, resources, on_complete,
+                                retry_policy, input_files, output_files, max_slots, widen, coalesce, timeout)
+        new_task.cost_in_seconds = predicted is not None or self.cost_in_seconds
+        failed_dep = None
         for dep_task in deps:
-            self.task_insts[dep_task].add_successor(new_task)
+            dep_inst = self.task_insts[dep_task]
+            dep_inst.add_successor(new_task)
+            if dep_inst.status in (ParallelTask.FAILED, ParallelTask.CANCELLED):
+                failed_dep = dep_inst
+            elif dep_inst.status != ParallelTask.FINISHED:
+                new_task.remaining_deps += 1
 
         self.task_insts[new_task.uuid] = new_task
-        self.pending_tasks[new_task.uuid] = new_task
+        self.add_pending(new_task)
+        self.priority_dirty = True
+        if failed_dep is not None:
+            # nothing would ever produce its inputs
+            self.cancel_subtree(new_task, failed_dep)
+        elif new_task.remaining_deps == 0:
+            self.task_ready(new_task)
 
-        self.unallocated_tasks_available = True
+        self.work_remaining = True
         
-        logger.debug(f"Added Task {new_task.uuid}: deps={deps}, actions={actions}, slots_required={slots_required}")
+        logger.debug(f"Added Task {new_task.uuid}: deps={deps}, actions={actions}, resources={new_task.resources}")
         return new_task.uuid
 
         # See if we have spare runners
 
+    def submit(self, name, deps, actions, slots_required, cost=1.0, resources=None, on_complete=None,
+               retry_policy=None, input_files=None, output_files=None, max_slots=None, widen=None,
+               coalesce=False, timeout=None, update=True):
+        """Add a task to a (possibly running) executor and schedule it at once
+        Safe to call from other coroutines and, once the runners were
+        started, from other threads.
+        deps: List of task uuids or of futures returned by submit()
+        update: schedule at once; submitting many tasks in a row, pass
+                False and call update_alloc() after the last one
+        other arguments as in add_task()
+
+        returns a future resolving to the task's outputs, or raising TaskFailed
+        if it failed or was cancelled: an asyncio.Future
+        on the runners' loop, a concurrent.futures.Future from other threads.
+        Cancelling either future cancels the task, see cancel_task()
+        """
+        args = (name, deps, actions, slots_required, cost, resources, on_complete, retry_policy, input_files, output_files,
+                max_slots, widen, coalesce, timeout, update)
+        if self.loop is None or not self.loop.is_running() or self.in_loop_thread():
+            return self._submit(*args)
+
+        future = concurrent.futures.Future()
+        def submit_in_loop():
+            if future.cancelled():
+                return
+            try:
+                task_future = self._submit(*args)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            self.future_tasks[future] = self.future_tasks[task_future]
+            def done(task_future):
+                try:
+                    if task_future.exception() is not None:
+                        future.set_exception(task_future.exception())
+                    else:
+                        future.set_result(task_future.result())
+                except concurrent.futures.InvalidStateError:
+                    # cancelled from its thread, cancel_in_loop() follows
+                    pass
+            task_future.add_done_callback(done)
+        def cancel_in_loop():
+            # runs after submit_in_loop(); nothing to do if that saw it cancelled
+            if future in self.future_tasks:
+                self.cancel_task(self.future_tasks[future])
+        future.add_done_callback(lambda future: self.loop.call_soon_threadsafe(cancel_in_loop) if future.cancelled() else None)
+        self.loop.call_soon_threadsafe(submit_in_loop)
+        return future
+
+    def in_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _submit(self, name, deps, actions, slots_required, cost, resources, on_complete, retry_policy,
+                input_files, output_files, max_slots, widen, coalesce, timeout, update):
+        if self.closed:
+            raise Exception(f"Cannot submit '{name}' to a closed executor")
+
+        deps = [
+            self.future_tasks[dep] if isinstance(dep, (asyncio.Future, concurrent.futures.Future)) else dep
+            for dep in deps
+        ]
+        task_uuid = self.add_task(name, deps, actions, slots_required, cost, resources, on_complete, retry_policy,
+                                  input_files, output_files, max_slots, widen, coalesce, timeout)
+
+        future = (self.loop or asyncio.get_event_loop()).create_future()
+        self.future_tasks[future] = task_uuid
+        self.task_futures[task_uuid] = future
+        future.add_done_callback(lambda future: self.cancel_task(task_uuid) if future.cancelled() else None)
+        task = self.task_insts[task_uuid]
+        if task.status in (ParallelTask.FINISHED, ParallelTask.CANCELLED):
+            # resumed from the journal, or a dep had failed already
+            self.settle_future(task)
+        if self.loop is not None and update:
+            self.update_alloc()
+        return future
+
+    def close(self):
+        """No more submit(); runners exit once every task has finished
+        Tasks may still be added by on_complete callbacks meanwhile.
+        """
+        if self.loop is not None and self.loop.is_running() and not self.in_loop_thread():
+            self.loop.call_soon_threadsafe(self.close)
+            return
+
+        self.closed = True
+        # wake idle runners so they notice
+        for ev in self.runner_notifications.values():
+            ev.set()
+
+    def add_pending(self, task):
+        self.pending_tasks[task.uuid] = task
+        self.pending_cores += task.base_resources.cores
+
+    def remove_pending(self, task):
+        del self.pending_tasks[task.uuid]
+        self.pending_cores -= task.base_resources.cores
+
     def add_runner(self, dispatch_hint, executor_inst, num_slots):
         """
         **Need to call update_alloc() manually after adding all tasks & runners**
@@ -234,9 +987,59 @@ class ParallelTaskExecutor:
             num_slots
         )
         self.registered_runners[runner.uuid] = runner
+        self.total_slots += num_slots
         self.runner_notifications[runner.uuid] = ev
+        self.runner_allocated_task[runner.uuid] = []
+        self.runner_allocated_resources[runner.uuid] = ResourceVector()
+        # a remote executor tells when it lost its connection, got it back or died
+        if hasattr(executor_inst, 'state_listeners'):
+            executor_inst.state_listeners.append(lambda executor: self.runner_state_changed(runner))
+
+    def runner_by_uuid(self, runner_uuid):
+        """A registered runner, or a lost one still reporting its tasks"""
+        if runner_uuid in self.registered_runners:
+            return self.registered_runners[runner_uuid]
+        return self.lost_runners[runner_uuid]
+
+    def runner_state_changed(self, runner):
+        if runner.lost:
+            return
+        if getattr(runner.executor_inst, 'dead', False):
+            self.remove_runner(runner.uuid)
+        # a runner back up can take tasks again
+        self.update_alloc()
+
+    def remove_runner(self, runner_uuid):
+        """Take out a runner whose host is gone: the tasks reserved for it
+        go back to the ready queue, those it was running fail with
+        ExecutorDisconnected and are re-queued by mark_failed()
+        """
+        runner = self.registered_runners.pop(runner_uuid)
+        self.total_slots -= runner.num_slots
+        runner.lost = True
+        self.lost_runners[runner_uuid] = runner
+        logger.error(f"Removed Runner #{runner_uuid} ({runner.host}) with {len(runner.task_insts)} tasks running")
+
+        for task in self.runner_allocated_task.pop(runner_uuid):
+            self.account_release(task)
+            if task.status == ParallelTask.WORKING:
+                # a speculative copy which never started
+                task.running_on.discard(runner_uuid)
+                continue
+            self.push_ready_task(task)
+        del self.runner_allocated_resources[runner_uuid]
+        # wake it, it exits once its tasks are gone
+        self.runner_notifications.pop(runner_uuid).set()
+
+        if len(self.registered_runners) == 0:
+            logger.error(f"Every runner was lost, giving up on the remaining tasks")
+            for task in list(self.pending_tasks.values()):
+                if task.status == ParallelTask.PENDING and task.remaining_deps == 0:
+                    self.fail_task(task, TaskFailed(f"no runner left to run it on"))
 
     def start_runners(self):
+        self.loop = asyncio.get_running_loop()
+        self.start_time = self.loop.time()
         for runner in self.registered_runners.values():
             self.async_runner_tasks.append(
                 asyncio.create_task(
@@ -246,84 +1049,647 @@ class ParallelTaskExecutor:
             )
         
     async def wait_until_finish(self):
+        """Close the executor and wait until the runners drained all work"""
+        self.close()
         await asyncio.gather(*self.async_runner_tasks)
+        if self.alloc_timer is not None:
+            self.alloc_timer.cancel()
+            self.alloc_timer = None
+        self.report_occupancy()
+        self.report_locality()
+        self.report_failures()
+        if self.resumed_tasks > 0:
+            logger.info(f"Resumed tasks: {self.resumed_tasks} completed in an earlier run, not run again")
+        if self.cache is not None:
+            logger.info(f"Stage cache: {self.cache.hits} tasks reused, {self.cache.stores} stored")
+        if self.batches > 0:
+            logger.info(f"Coalesced tasks: {self.batched_tasks} in {self.batches} batches")
+        if self.widened_tasks > 0:
+            logger.info(f"Malleable tasks run with extra threads: {self.widened_tasks}")
+        if self.stolen_tasks > 0 or self.speculative_copies > 0:
+            logger.info(f"Stolen tasks: {self.stolen_tasks}, speculative copies: {self.speculative_copies} ({self.speculative_wins} won)")
+        if self.requeued_tasks > 0 or len(self.lost_runners) > 0:
+            logger.warning(f"Lost runners: {len(self.lost_runners)}, tasks re-queued after losing their connection: {self.requeued_tasks}")
+
+    def report_locality(self):
+        total_reads = self.local_reads + self.remote_reads
+        if total_reads > 0:
+            logger.info(f"Locality: {self.local_reads}/{total_reads} dependency reads local ({self.local_reads / total_reads * 100:.1f}%), {self.remote_reads} remote")
+
+    def report_failures(self):
+        """Log every task which failed for good and what it took down with it"""
+        if self.retried_attempts > 0:
+            logger.info(f"Retried attempts: {self.retried_attempts}")
+        if len(self.failed_tasks) == 0:
+            return
+
+        logger.error(f"{len(self.failed_tasks)} tasks failed, {len(self.cancelled_tasks)} dependent tasks cancelled:")
+        for task in self.failed_tasks.values():
+            cancelled = [t.name for t in self.cancelled_tasks.values() if t.error.failed_task is task]
+            if len(cancelled) > 10:
+                cancelled = cancelled[:10] + ['...']
+            logger.error(f"  {task.name} (#{task.uuid}) after {task.attempts} attempts: {task.error}"
+                         + (f"; cancelled {', '.join(cancelled)}" if len(cancelled) > 0 else ""))
 
-    def mark_complete(self, runner_uuid, task_uuid):
-        """Mark runner completed working on task"""
-        self.task_insts[task_uuid].status = ParallelTask.FINISHED
+    def report_occupancy(self):
+        """Log how long each runner took to get all of its slots busy"""
+        for runner in self.registered_runners.values():
+            if runner.full_occupancy_time is None:
+                logger.info(f"Runner #{runner.uuid} never reached full occupancy ({runner.num_slots} slots)")
+            else:
+                logger.info(f"Runner #{runner.uuid} reached full occupancy ({runner.num_slots} slots) in {runner.full_occupancy_time * 1000:.2f} msec")
+
+    def mark_complete(self, runner_uuid, task_uuid, outputs=None):
+        """Mark runner completed working on task
+        With speculation several copies may report; the first one wins.
+        """
+        task = self.task_insts[task_uuid]
+        task.running_on.discard(runner_uuid)
+        if task.status != ParallelTask.WORKING:
+            logger.debug(f"mark_complete: Runner #{runner_uuid} finished a redundant copy of {task_uuid}, ignored")
+            return
+        # the other copies lost
+        self.stop_copies(task)
+
+        if runner_uuid != task.runner_uuid:
+            # a backup copy beat the original
+            self.speculative_wins += 1
+        task.runner_uuid = runner_uuid
+        task.host = self.runner_by_uuid(runner_uuid).host
+        task.finish_time = asyncio.get_running_loop().time()
+        task.usage = next((run['usage'] for run in reversed(task.runs) if run['runner'] == runner_uuid), None)
         logger.debug(f"mark_complete: Runner #{runner_uuid} reported the completion of {task_uuid}")
 
         self.finished_tasks[task_uuid] = self.working_tasks[task_uuid]
         del self.working_tasks[task_uuid]
+        if self.journal is not None:
+            self.journal.record(task.name, task.actions, task.input_files, task.output_files, outputs)
+        if task.cache_key is not None:
+            self.cache.store(task.cache_key, task.output_files, outputs)
+
+        self.complete_task(task, outputs)
+
+        if self.cost_model is not None:
+            now = asyncio.get_running_loop().time()
+            if self.last_eta_report is None or now - self.last_eta_report >= self.eta_report_interval:
+                self.last_eta_report = now
+                logger.info(f"{len(self.finished_tasks)}/{len(self.task_insts)} tasks done, ETA {self.eta():.1f}s")
+
+    def complete_task(self, task, outputs):
+        """Settle a task which finished, here or in an earlier run"""
+        task.status = ParallelTask.FINISHED
+        task.outputs = outputs
+
+        # only the successors can become ready because of this completion
+        for successor in task.successors:
+            successor.remaining_deps -= 1
+            if successor.remaining_deps == 0 and successor.status == ParallelTask.PENDING:
+                self.task_ready(successor)
+
+        # the graph may grow here; new tasks keep the runners alive
+        if task.on_complete is not None:
+            task.on_complete(task.uuid, outputs)
+
+        self.settle_future(task)
+
+    def task_ready(self, task):
+        """All deps of task finished: queue it, unless the journal shows it
+        already completed with the same inputs and outputs, or the cache
+        has its outputs
+        """
+        if self.cache is not None:
+            task.cache_key = self.cache_key(task)
+
+        if self.journal is not None:
+            entry = self.journal.lookup(task.name, task.actions, task.input_files, task.output_files)
+            if entry is not None:
+                logger.debug(f"Resumed {task.name} (#{task.uuid}) from the journal")
+                self.resumed_tasks += 1
+                self.skip_task(task, entry['outputs'])
+                return
+
+        if task.cache_key is not None:
+            outputs = self.cache.restore(task.cache_key, task.output_files)
+            if outputs is not None:
+                logger.debug(f"Reused the cached outputs of {task.name} (#{task.uuid})")
+                if self.journal is not None:
+                    self.journal.record(task.name, task.actions, task.input_files, task.output_files, outputs)
+                self.skip_task(task, outputs)
+                return
+            self.cache.detach(task.output_files)
+
+        self.push_ready_task(task)
+
+    def skip_task(self, task, outputs):
+        """Finish a ready task without running it"""
+        self.remove_pending(task)
+        self.finished_tasks[task.uuid] = task
+        self.complete_task(task, outputs)
+
+    def cache_key(self, task):
+        """StageCache key of a ready task, None if it or a dep isn't cached
+        Outputs of deps, and of earlier cached tasks further up, are covered
+        by their producers' keys, other inputs by content.
+        """
+        if len(task.output_files) == 0:
+            return None
+        dep_keys = set()
+        dep_outputs = set()
+        for dep in task.deps:
+            dep_inst = self.task_insts[dep]
+            if dep_inst.cache_key is None:
+                return None
+            dep_keys.add(dep_inst.cache_key)
+            dep_outputs.update(dep_inst.output_files)
+
+        external_inputs = []
+        for path in task.input_files:
+            if path in dep_outputs:
+                continue
+            producer = self.cache_producers.get(path)
+            if producer is not None and producer.uuid in self.finished_tasks:
+                dep_keys.add(producer.cache_key)
+            else:
+                external_inputs.append(path)
+        key = self.cache.key(task.actions, dep_keys, external_inputs)
+        if key is not None:
+            for path in task.output_files:
+                self.cache_producers[path] = task
+        return key
+
+    def mark_failed(self, runner_uuid, task_uuid, error):
+        """Runner's attempt at task failed with error (TaskFailed or any
+        exception raised by the executor): retry it or give up on it
+        """
+        task = self.task_insts[task_uuid]
+        task.running_on.discard(runner_uuid)
+        if task.status != ParallelTask.WORKING:
+            logger.debug(f"mark_failed: copy of {task_uuid} on Runner #{runner_uuid} failed after the task was settled, ignored")
+            return
+        if isinstance(error, ExecutorDisconnected) and len(self.registered_runners) > 0:
+            # not the task's fault: the attempt doesn't count; only the
+            # first copy counted one, speculative copies don't
+            logger.warning(f"Task {task.name} (#{task_uuid}) lost with the connection of Runner #{runner_uuid}: {error}")
+            if runner_uuid == task.runner_uuid:
+                task.attempts -= 1
+            if len(task.running_on) > 0:
+                return
+            del self.working_tasks[task_uuid]
+            task.status = ParallelTask.PENDING
+            task.runner_uuid = None
+            task.start_time = None
+            self.add_pending(task)
+            self.requeued_tasks += 1
+            self.push_ready_task(task)
+            return
+        if not isinstance(error, TaskFailed):
+            error = TaskFailed(f"{type(error).__name__}: {error}")
+
+        host = self.runner_by_uuid(runner_uuid).host
+        logger.warning(f"Task {task.name} (#{task_uuid}) attempt {task.attempts} failed on Runner #{runner_uuid}: {error}")
+        task.error = error
+        task.failed_hosts.add(host)
+        if len(task.running_on) > 0:
+            # a speculative copy is still going and may yet succeed
+            return
+
+        del self.working_tasks[task_uuid]
+        if task.retry_policy.should_retry(task.attempts):
+            task.status = ParallelTask.PENDING
+            task.runner_uuid = None
+            task.start_time = None
+            self.add_pending(task)
+            if task.retry_policy.other_host:
+                excluded = set(
+                    runner.uuid for runner in self.registered_runners.values()
+                    if runner.host in task.failed_hosts
+                )
+                # a single host is better than none
+                if len(excluded) < len(self.registered_runners):
+                    task.excluded_runners = excluded
+
+            delay = task.retry_policy.delay(task.attempts)
+            self.retried_attempts += 1
+            logger.info(f"Retrying {task.name} (#{task_uuid}) in {delay:.1f}s")
+            def retry():
+                # unless it was cancelled meanwhile
+                if task.status != ParallelTask.PENDING:
+                    return
+                self.push_ready_task(task)
+                self.update_alloc()
+            asyncio.get_running_loop().call_later(delay, retry)
+            return
+
+        self.fail_task(task, error)
+
+    def fail_task(self, task, error):
+        """Give up on task for good and cancel what depends on it"""
+        if task.status == ParallelTask.PENDING:
+            self.ready_tasks.discard(task)
+            self.remove_pending(task)
+        task.status = ParallelTask.FAILED
+        task.error = error
+        self.failed_tasks[task.uuid] = task
+        logger.error(f"Task {task.name} (#{task.uuid}) failed after {task.attempts} attempts: {error}")
+        self.settle_future(task)
+        for successor in task.successors:
+            self.cancel_subtree(successor, task)
+
+    def cancel_subtree(self, task, failed_task):
+        """Drop task, which depends on failed_task, and everything depending on it"""
+        if failed_task.status == ParallelTask.CANCELLED:
+            failed_task = failed_task.error.failed_task
+        # cancel_task() roots are their own failed_task
+        why = "was cancelled" if failed_task.status == ParallelTask.CANCELLED else "failed"
+        stack = [task]
+        while len(stack) > 0:
+            task = stack.pop()
+            if task.status != ParallelTask.PENDING:
+                continue
+
+            task.status = ParallelTask.CANCELLED
+            task.error = TaskFailed(f"cancelled, as {failed_task.name} (#{failed_task.uuid}) {why}", failed_task=failed_task)
+            self.ready_tasks.discard(task)
+            self.remove_pending(task)
+            self.cancelled_tasks[task.uuid] = task
+            logger.debug(f"Cancelled {task.name} (#{task.uuid}): {task.error}")
+            self.settle_future(task)
+            stack.extend(task.successors)
+
+    def cancel_task(self, task_uuid):
+        """Drop a task nobody needs any more, and everything depending on
+        it; its running copies are killed, process groups and all
+        returns whether it hadn't settled yet
+        """
+        task = self.task_insts[task_uuid]
+        if task.status not in (ParallelTask.PENDING, ParallelTask.WORKING):
+            return False
+        self.stop_copies(task)
+        if task.status == ParallelTask.WORKING:
+            del self.working_tasks[task_uuid]
+        else:
+            self.ready_tasks.discard(task)
+            self.remove_pending(task)
+
+        task.status = ParallelTask.CANCELLED
+        task.error = TaskFailed("cancelled", failed_task=task)
+        self.cancelled_tasks[task_uuid] = task
+        logger.info(f"Cancelled {task.name} (#{task_uuid})")
+        self.settle_future(task)
+        for successor in task.successors:
+            self.cancel_subtree(successor, task)
+        self.update_alloc()
+        return True
+
+    def stop_copies(self, task):
+        """Kill the runs of task still going, and take back those
+        reserved for runners which didn't start them yet
+        """
+        for runner_uuid, allocated in self.runner_allocated_task.items():
+            if task in allocated:
+                allocated.remove(task)
+                self.runner_allocated_resources[runner_uuid] = self.runner_allocated_resources[runner_uuid] - task.resources
+                self.account_release(task)
+                # a speculative copy counts as running once reserved
+                task.running_on.discard(runner_uuid)
+        for runner_uuid in list(task.running_on):
+            self.runner_by_uuid(runner_uuid).cancel_task(task.uuid)
+
+    def forget_tasks(self, task_uuids):
+        """Drop settled tasks nothing else depends on any more, so a
+        long-lived executor (see SchedulerDaemon) doesn't keep every task
+        it ever ran
+        returns the uuids kept as a copy of them is still running
+        """
+        kept = []
+        forgotten = set()
+        for uuid in task_uuids:
+            task = self.task_insts[uuid]
+            if task.status in (ParallelTask.PENDING, ParallelTask.WORKING):
+                raise Exception(f"Cannot forget {task.name} (#{uuid}), it hasn't settled")
+            if len(task.running_on) > 0:
+                # a losing speculative copy, its runner still refers to it
+                kept.append(uuid)
+                continue
+            del self.task_insts[uuid]
+            for settled in (self.finished_tasks, self.failed_tasks, self.cancelled_tasks):
+                settled.pop(uuid, None)
+            forgotten.add(uuid)
+
+        for future in [future for future, uuid in self.future_tasks.items() if uuid in forgotten]:
+            del self.future_tasks[future]
+        self.priority_dirty = True
+        return kept
+
+    def settle_future(self, task):
+        """Resolve the future submit() returned for task, if any"""
+        future = self.task_futures.pop(task.uuid, None)
+        if future is None or future.cancelled():
+            return
+        if task.status == ParallelTask.FINISHED:
+            future.set_result(task.outputs)
+        else:
+            future.set_exception(task.error)
+
+    def record_run(self, runner, cmd, wall_time, usage):
+        if self.metrics is not None:
+            self.command_duration_metric.observe(wall_time, tool=task_tool([cmd]), host=runner.host)
+        if self.history is not None:
+            cpu_time = None if usage is None else usage['utime'] + usage['stime']
+            self.history.record(cmd, wall_time, cpu_time, runner.host, usage)
+
+    def eta(self):
+        """Estimated seconds until all tasks finish
+        remaining predicted work spread evenly over every slot,
+        but never less than the longest remaining running task
+        """
+        now = asyncio.get_running_loop().time()
+        remaining_work = sum(task.cost for task in self.pending_tasks.values())
+        longest_running = 0.0
+        for task in self.working_tasks.values():
+            left = max(task.cost - (now - task.start_time), 0.0) if task.start_time is not None else task.cost
+            remaining_work += left
+            longest_running = max(longest_running, left)
+
+        return max(remaining_work / max(self.total_slots, 1), longest_running)
+
+    def push_ready_task(self, task):
+        # back to its minimal size, widened again only if still worth it
+        task.set_threads(task.base_resources.cores)
+        task.held_since = None
+        # prefer the runners which produced this task's inputs
+        task.preferred_runners = set(
+            self.task_insts[dep].runner_uuid for dep in task.deps
+            if self.task_insts[dep].runner_uuid is not None
+        )
+        self.ready_tasks.push(task, asyncio.get_event_loop().time())
+
+    def reprioritize(self):
+        """Let the policy look at the current graph and re-key the ready queue"""
+        self.priority_policy.prepare(self.task_insts)
+        self.ready_tasks.rekey()
+        self.priority_dirty = False
+        self.keys_stale = False
+        self.last_rekey = asyncio.get_event_loop().time()
+
+    def account_dispatch(self, task):
+        """A run of task was given cores, tell a dynamic policy"""
+        if self.ready_tasks.dynamic:
+            self.priority_policy.dispatched(task)
+
+    def account_release(self, task):
+        """A run of task gave its cores back"""
+        if self.ready_tasks.dynamic:
+            self.priority_policy.released(task)
+            # keys only grow as they surface, drops need a re-key
+            self.keys_stale = True
+
+    def schedule_update_alloc(self, delay):
+        """Run update_alloc again after delay seconds, e.g. once a task held
+        back for locality may move, or to look for stragglers
+        """
+        loop = asyncio.get_event_loop()
+        when = loop.time() + delay
+        if self.alloc_timer is not None:
+            if self.alloc_timer.when() <= when:
+                return
+            self.alloc_timer.cancel()
+
+        def fire():
+            self.alloc_timer = None
+            self.update_alloc()
+        self.alloc_timer = loop.call_at(when, fire)
+
+    def allocate(self, runner, task):
+        logger.debug(f"Assigned task {task.uuid} to {runner.uuid}")
+        self.runner_allocated_task[runner.uuid].append(task)
+        self.runner_allocated_resources[runner.uuid] = self.runner_allocated_resources[runner.uuid] + task.resources
+
+    def steal_tasks(self, thief, free):
+        """Move tasks reserved for other runners, but not yet taken, to thief"""
+        stolen = False
+        for victim_uuid, victim_tasks in self.runner_allocated_task.items():
+            # only from busier runners, else two idle ones pass tasks back
+            # and forth; a runner which lost its connection can't take any
+            victim = self.registered_runners[victim_uuid]
+            if victim_uuid == thief.uuid or (victim.is_up() and victim.used_slots <= thief.used_slots):
+                continue
+            for task in reversed(list(victim_tasks)):
+                if free.cores <= 0:
+                    return free, stolen
+                # speculative copies stay where they were meant to run
+                if task.status == ParallelTask.WORKING or not task.resources.fits(free) \
+                        or thief.uuid in task.excluded_runners:
+                    continue
+
+                victim_tasks.remove(task)
+                self.runner_allocated_resources[victim_uuid] = self.runner_allocated_resources[victim_uuid] - task.resources
+                logger.debug(f"Runner #{thief.uuid} stole task {task.uuid} from Runner #{victim_uuid}")
+                self.allocate(thief, task)
+                free = free - task.resources
+                self.stolen_tasks += 1
+                stolen = True
+        return free, stolen
+
+    def find_straggler(self, runner, free, now):
+        """The running task most behind its estimate that runner could back up"""
+        straggler = None
+        worst_ratio = 0.0
+        for task in self.working_tasks.values():
+            if task.start_time is None or len(task.running_on) != 1 or runner.uuid in task.running_on \
+                    or runner.uuid in task.excluded_runners:
+                continue
+            if not task.resources.fits(free):
+                continue
+
+            # the caller's cost may be in any unit, not to hold against seconds
+            if not task.cost_in_seconds:
+                continue
+            elapsed = now - task.start_time
+            ratio = elapsed / max(task.cost, 1e-9)
+            if elapsed >= self.speculation_min_time and ratio >= self.speculation_ratio and ratio > worst_ratio:
+                straggler = task
+                worst_ratio = ratio
+        return straggler
 
     def update_alloc(self):
         """Hook to give latest allocations"""
-        # only consider runners with remaining slots
-        available_runners = [runner for runner in self.registered_runners.values()
-                                    if runner.is_available()]
-        
-        # logger.debug(f"available_runners={available_runners}")
-        for runner in available_runners:
-            # atmost one task waiting to be taken for one runner
-            if runner.uuid in self.runner_allocated_task:
+        now = asyncio.get_event_loop().time()
+        if self.priority_dirty:
+            self.reprioritize()
+        elif self.keys_stale:
+            # re-keying is O(ready tasks), so not on every release
+            wait_left = self.last_rekey + self.rekey_interval - now
+            if wait_left <= 0:
+                self.ready_tasks.rekey()
+                self.keys_stale = False
+                self.last_rekey = now
+            else:
+                self.schedule_update_alloc(wait_left)
+
+        self.spare_cores = self.tail_spare_cores()
+
+        for runner in self.registered_runners.values():
+            if len(self.ready_tasks) == 0:
+                break
+            if not runner.is_up():
                 continue
-            
-            # Find possible allocation plan
-            available_slots = runner.available_slots()
-            candidate_tasks = [task for task in self.pending_tasks.values()
-                                    if task.slots_required <= available_slots]
-            # print(f"{candidate_tasks}")
-            candidate_tasks = [task for task in candidate_tasks
-                                    if task not in self.runner_allocated_task.values()]
-            # print(f"{candidate_tasks}")
-            # Find tasks whose dependencies have been met
-            candidate_tasks = [task for task in candidate_tasks
-                                    if reduce(
-                                        lambda m, n: m+n,
-                                        map(
-                                            lambda x: (1 if self.task_insts[x].status < ParallelTask.FINISHED else 0),
-                                            task.deps
-                                        ),
-                                        0
-                                    ) == 0]
-            # print(f"{candidate_tasks}")
-
-            # TODO: sort out the most suitable using the dispatch hint
-            if len(candidate_tasks) > 0:
-                logger.debug(f"Assigned task {candidate_tasks[0].uuid} to {runner.uuid}")
-                self.runner_allocated_task[runner.uuid] = candidate_tasks[0]
+
+            # fill the runner in one pass, packing against every resource
+            # dimension; tasks it has not picked up yet count as used
+            free = runner.free_resources() - self.runner_allocated_resources[runner.uuid]
+            assigned = False
+            while free.cores > 0:
+                hold = None
+                if self.spare_cores > 0:
+                    hold = lambda task: self.hold_malleable(task, runner, free, now)
+                task, next_eligible = self.ready_tasks.pop(runner.uuid, free, now, hold)
+                if next_eligible is not None:
+                    self.schedule_update_alloc(next_eligible)
+                if task is None:
+                    break
+
+                if self.spare_cores > 0 and task.is_malleable():
+                    self.widen_task(task, runner, free)
+                self.allocate(runner, task)
+                self.account_dispatch(task)
+                free = free - task.resources
+                assigned = True
+
+            if assigned:
                 self.runner_notifications[runner.uuid].set()
-        
-        self.unallocated_tasks_available = False
-        for task in self.pending_tasks.values():
-            if task.uuid not in self.runner_allocated_task:
-                self.unallocated_tasks_available = True
-                break
 
-        if not self.unallocated_tasks_available:
+        if len(self.ready_tasks) == 0:
+            self.balance_idle_runners(now)
+
+        self.work_remaining = len(self.pending_tasks) + len(self.working_tasks) > 0
+
+        if not self.work_remaining:
             # notify others
             for ev in self.runner_notifications.values():
                 ev.set()
         
-        # logger.debug(f"unallocated_tasks_available={self.unallocated_tasks_available} {self.runner_notifications}")
+        # logger.debug(f"work_remaining={self.work_remaining} {self.runner_notifications}")
+
+    def tail_spare_cores(self):
+        """Cores of the cluster no task yet to start needs: more than 0
+        only at the tail, when the ready tasks and those about to become
+        ready can't keep it busy
+        """
+        if len(self.ready_tasks) == 0:
+            return 0
+        return max(self.total_slots - self.pending_cores, 0)
+
+    def tail_width(self, task, runner, sharing):
+        """Cores for a malleable task: its part of the spare cores, split
+        between the sharing tasks
+        """
+        base = task.base_resources.cores
+        extra = -(-self.spare_cores // sharing)
+        return min(base + extra, task.max_slots, runner.capacity.cores)
+
+    def hold_malleable(self, task, runner, free, now):
+        """Seconds a malleable task should still wait for its share of
+        runner's cores to become free, as running tasks finish
+        """
+        if not task.is_malleable() or free.cores >= self.tail_width(task, runner, len(self.ready_tasks)):
+            return 0
+        # a cost in the caller's units says nothing about how long to wait
+        if not task.cost_in_seconds:
+            return 0
+        if task.held_since is None:
+            task.held_since = now
+        return task.held_since + self.malleable_wait * task.cost - now
+
+    def widen_task(self, task, runner, free):
+        # it has left the queue already
+        threads = min(self.tail_width(task, runner, len(self.ready_tasks) + 1), free.cores)
+        if threads > task.base_resources.cores:
+            logger.debug(f"Running {task.name} (#{task.uuid}) with {threads} threads on Runner #{runner.uuid}")
+            task.set_threads(threads)
+            self.spare_cores -= threads - task.base_resources.cores
+            self.widened_tasks += 1
+
+    def balance_idle_runners(self, now):
+        """Nothing is ready: let runners with free slots steal reserved
+        tasks, then (optionally) back up the worst stragglers
+        """
+        for runner in self.registered_runners.values():
+            free = runner.free_resources() - self.runner_allocated_resources[runner.uuid]
+            if free.cores <= 0 or not runner.is_up():
+                continue
+
+            free, assigned = self.steal_tasks(runner, free)
 
-    def get_task(self, runner):
-        """Get task on behalf of runner
+            while self.speculation and free.cores > 0:
+                straggler = self.find_straggler(runner, free, now)
+                if straggler is None:
+                    break
+                logger.info(f"Runner #{runner.uuid} starts a speculative copy of {straggler.uuid} ({straggler.name})")
+                self.allocate(runner, straggler)
+                self.account_dispatch(straggler)
+                # counts as a second copy from now on
+                straggler.running_on.add(runner.uuid)
+                free = free - straggler.resources
+                self.speculative_copies += 1
+                assigned = True
+
+            if assigned:
+                self.runner_notifications[runner.uuid].set()
+
+        if self.speculation and len(self.working_tasks) > 0:
+            # stragglers emerge without any event, so look again later
+            self.schedule_update_alloc(max(self.speculation_min_time / 4, 1.0))
+
+    def coalesce(self, tasks):
+        """Batches of the coalescible tasks among tasks, which a runner
+        took at once; the others, and lone ones, run on their own
+        """
+        candidates = [
+            task for task in tasks
+            # speculative copies run on their own
+            if task.coalesce and len(task.actions) == 1 and len(task.running_on) == 1
+        ]
+        batches = [candidates[i:i + self.max_batch] for i in range(0, len(candidates), self.max_batch)]
+        batches = [batch for batch in batches if len(batch) > 1]
+        self.batches += len(batches)
+        self.batched_tasks += sum(len(batch) for batch in batches)
+        return batches
+
+    def get_tasks(self, runner):
+        """Get all tasks allocated to runner on behalf of it
         only call this when you are called
         Notice: this function shall not update_alloc
         """
 
-        assert(runner.uuid in self.runner_allocated_task)
-        task = self.runner_allocated_task[runner.uuid]
+        tasks = self.runner_allocated_task[runner.uuid]
+        assert(len(tasks) > 0)
 
-        del self.runner_allocated_task[runner.uuid]
+        self.runner_allocated_task[runner.uuid] = []
+        self.runner_allocated_resources[runner.uuid] = ResourceVector()
         self.runner_notifications[runner.uuid].clear()
 
-        task.status = ParallelTask.WORKING
-        self.working_tasks[task.uuid] = self.pending_tasks[task.uuid]
-        del self.pending_tasks[task.uuid]
+        now = asyncio.get_running_loop().time()
+        for task in tasks:
+            task.running_on.add(runner.uuid)
+            task.dispatch_time = now
+            if task.status == ParallelTask.WORKING:
+                # speculative copy of a task already running elsewhere
+                continue
+
+            task.runner_uuid = runner.uuid
+            task.attempts += 1
+            for dep in task.deps:
+                if self.task_insts[dep].host == runner.host:
+                    self.local_reads += 1
+                else:
+                    self.remote_reads += 1
+
+            task.status = ParallelTask.WORKING
+            self.working_tasks[task.uuid] = task
+            self.remove_pending(task)
 
-        return task
+        return tasks
 
 async def test():
     logging.basicConfig(
@@ -345,6 +1711,11 @@ async def test():
     task_executor.update_alloc()
     task_executor.start_runners()
 
+    # more work can be submitted while the runners are live, also from threads
+    task_e = task_executor.submit("task_e", [task_c], ['echo -n "E"'], 1)
+    task_f = await asyncio.to_thread(task_executor.submit, "task_f", [task_d, task_e], ['echo -n "F"'], 1)
+    logger.info(f"task_e: {await task_e}, task_f: {await asyncio.wrap_future(task_f)}")
+
     # await asyncio.sleep(1)
     await task_executor.wait_until_finish()
 
@@ -4,9 +4,13 @@ from RemoteExecutor import ExecutorClient
 from LocalExecutor import LocalExecutor
 from HostManager import HostManager
 from ParallelTaskExecutor import ParallelTaskExecutor
+from TaskHistory import set_ncpus
 
 import sys, os, glob
 
+# searches left over at the end get the idle cores as extra threads
+ACCEL_MAX_THREADS = 8
+
 async def evaluate(host_manager, workdir, input_ffts, zmax):
     task_executor = ParallelTaskExecutor()
     for executor in host_manager.all_executors():
@@ -17,7 +21,8 @@ async def evaluate(host_manager, workdir, input_ffts, zmax):
         )
 
     for input_fft in input_ffts:
-        task_executor.add_task("accel_{}", [], [f"cd {workdir} && accelsearch -zmax {zmax} {input_fft} >> accelsearch.log"], 1)
+        task_executor.add_task("accel_{}", [], [f"cd {workdir} && accelsearch -zmax {zmax} {input_fft} >> accelsearch.log"], 1,
+                               max_slots=ACCEL_MAX_THREADS, widen=set_ncpus)
 
     task_executor.update_alloc()
     task_executor.start_runners()
@@ -4,6 +4,8 @@ from RemoteExecutor import ExecutorClient
 from LocalExecutor import LocalExecutor
 from HostManager import HostManager
 from ParallelTaskExecutor import ParallelTaskExecutor
+from TaskHistory import set_ncpus
+from Resources import ResourceVector, parse_size
 
 import sys, os, glob, time
 
@@ -16,6 +18,12 @@ Tres = 0.5 #ms
 zmax = 200
 wmax = 100
 
+# -zmax 200 -wmax 100 jerk searches keep large kernel tables resident;
+# rough RSS estimate so hosts with mem= in the hostfile don't swap
+ACCEL_JERK_TASK = ResourceVector(cores=1, mem=parse_size('4G'))
+# searches left over at the end get the idle cores as extra threads
+ACCEL_MAX_THREADS = 8
+
 # cwd = os.getcwd()
 
 # if not os.access('fft', os.F_OK):
@@ -50,7 +58,8 @@ async def evaluate(host_manager, workdir, input_ffts, zmax):
         )
 
     for input_fft in input_ffts:
-        task_executor.add_task("accel_{}", [], [f"cd {workdir} && accelsearch -zmax 200 -wmax 100 {input_fft} >> accelsearch.log"], 1)
+        task_executor.add_task("accel_{}", [], [f"cd {workdir} && accelsearch -zmax 200 -wmax 100 {input_fft} >> accelsearch.log"], 1, resources=ACCEL_JERK_TASK,
+                               max_slots=ACCEL_MAX_THREADS, widen=set_ncpus)
 
     task_executor.update_alloc()
     task_executor.start_runners()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Throughput of accelsearch with and without core pinning
+
+Usage: PrestoAffinityBench.py workdir hostfile bind|nobind [rounds]
+Searches every *.fft in workdir `rounds` times and prints tasks/s.
+"""
+import asyncio, logging
+from HostManager import HostManager
+from ParallelTaskExecutor import ParallelTaskExecutor
+
+import sys, os, glob, time
+
+async def evaluate(host_manager, workdir, input_ffts, rounds):
+    task_executor = ParallelTaskExecutor()
+    for executor in host_manager.all_executors():
+        task_executor.add_runner(
+            host_manager.get_dispatch_hint(executor),
+            executor,
+            host_manager.get_slot(executor)
+        )
+
+    for i in range(0, rounds):
+        for input_fft in input_ffts:
+            task_executor.add_task(f"accel_{i}", [], [f"cd {workdir} && accelsearch -zmax 0 {input_fft} > /dev/null"], 1)
+
+    start = time.perf_counter()
+    task_executor.update_alloc()
+    task_executor.start_runners()
+
+    await task_executor.wait_until_finish()
+    end = time.perf_counter()
+
+    return len(task_executor.finished_tasks) / (end - start)
+
+async def main():
+    workdir = sys.argv[1]
+    hostfile = sys.argv[2]
+    bind_core = sys.argv[3] == 'bind'
+    rounds = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    input_ffts = [os.path.realpath(d) for d in glob.glob(f"{workdir}/*.fft")]
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO
+    )
+
+    host_manager = HostManager.from_hostfile(hostfile, bind_core)
+    await host_manager.connect_remote()
+
+    throughput = await evaluate(host_manager, workdir, input_ffts, rounds)
+    print(f"{'pinned' if bind_core else 'unpinned'}: {throughput:.3f} tasks/s")
+
+    await host_manager.close_remote()
+
+if __name__ == '__main__':
+    asyncio.run(main())
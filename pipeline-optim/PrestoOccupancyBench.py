@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Time for each runner to fill all of its slots at the start of a stage
+
+Usage: PrestoOccupancyBench.py hostfile [rounds] [duration] [fake]
+Queues twice as many independent `sleep duration` tasks as the cluster
+has slots, `rounds` times, and prints per runner the time from
+start_runners() to its last slot getting a command, median over rounds.
+With fake, runners get in-process executors which only sleep, so the
+figures are the scheduler's alone, without spawning processes.
+
+Commands are timed as the executors get them, not through the runners,
+so the same script measures any version of ParallelTaskExecutor: copy it
+next to an older one to get the numbers from before a change.
+"""
+import asyncio, logging
+from HostManager import HostManager
+from ParallelTaskExecutor import ParallelTaskExecutor
+
+import sys, time, statistics
+
+class TimedExecutor:
+    """An executor noting when each command reaches it"""
+    def __init__(self, executor):
+        self.executor = executor
+        self.starts = []
+        self.execute = self.timed(executor.execute)
+        # runners use execute_with_usage only where the executor has it
+        if hasattr(executor, 'execute_with_usage'):
+            self.execute_with_usage = self.timed(executor.execute_with_usage)
+
+    def timed(self, call):
+        async def run(*args, **kwargs):
+            self.starts.append(time.perf_counter())
+            return await call(*args, **kwargs)
+        return run
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+class FakeExecutor:
+    def __init__(self, duration):
+        self.duration = duration
+
+    async def execute(self, cmd, cores=None, timeout=None):
+        await asyncio.sleep(self.duration)
+        return 0, ""
+
+async def evaluate(host_manager, duration, fake):
+    """returns [(runner, seconds to full occupancy or None if it never got there)]"""
+    task_executor = ParallelTaskExecutor()
+    timed = []
+    for executor in host_manager.all_executors():
+        slots = host_manager.get_slot(executor)
+        timed.append((TimedExecutor(FakeExecutor(duration) if fake else executor), slots))
+        task_executor.add_runner(host_manager.get_dispatch_hint(executor), timed[-1][0], slots)
+
+    total_slots = sum(slots for _, slots in timed)
+    for i in range(0, 2 * total_slots):
+        task_executor.add_task(f"sleep_{i}", [], [f"sleep {duration}"], 1)
+
+    start = time.perf_counter()
+    task_executor.update_alloc()
+    task_executor.start_runners()
+    await task_executor.wait_until_finish()
+
+    return [
+        (f"{getattr(executor.executor, 'host', 'localhost')} #{i} ({slots} slots)",
+         executor.starts[slots - 1] - start if len(executor.starts) >= slots else None)
+        for i, (executor, slots) in enumerate(timed)
+    ]
+
+async def main():
+    hostfile = sys.argv[1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    duration = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+    fake = len(sys.argv) > 4 and sys.argv[4] == 'fake'
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.WARNING
+    )
+
+    host_manager = HostManager.from_hostfile(hostfile)
+    await host_manager.connect_remote()
+
+    results = [await evaluate(host_manager, duration, fake) for _ in range(0, rounds)]
+    for i, (runner, _) in enumerate(results[0]):
+        times = [result[i][1] for result in results]
+        if None in times:
+            print(f"{runner}: never fully occupied")
+        else:
+            print(f"{runner}: full occupancy in {statistics.median(times) * 1000:.2f} msec")
+
+    await host_manager.close_remote()
+
+if __name__ == '__main__':
+    asyncio.run(main())
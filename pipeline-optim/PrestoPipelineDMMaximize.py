@@ -13,9 +13,32 @@ from RemoteExecutor import ExecutorClient
 from LocalExecutor import LocalExecutor
 from HostManager import HostManager
 from ParallelTaskExecutor import ParallelTaskExecutor
+from TaskPriority import StagedPriority
+from TaskHistory import TaskHistory, CostModel, DEFAULT_HISTORY_FILE, set_ncpus
+from Resources import ResourceVector
+from RetryPolicy import RetryPolicy
+from TaskJournal import TaskJournal, JOURNAL_FILE, parse_resume
+from StageCache import StageCache, DEFAULT_CACHE_SIZE, parse_cache
+from TaskTrace import write_chrome_trace
+from Metrics import MetricsRegistry, MetricsServer, parse_metrics_port
+from SchedulerDaemon import SchedulerClient, parse_socket
 
 logger = logging.getLogger(__name__)
 
+# Rough relative run times of a command of each tool, used to rank tasks
+# for the scheduler until the task history has seen the tool; scaled to
+# seconds by the tools it has seen, so they compare with its predictions
+RELATIVE_COSTS = {'prepsubband': 8.0, 'realfft': 1.0, 'accelsearch': 2.0, 'prepfold': 4.0}
+
+# prepsubband, realfft and prepfold stream whole files over NFS, so they
+# take an io share each; hosts bound the total with io= in the hostfile
+STREAMING_TASK = ResourceVector(cores=1, io=1.0)
+# accelsearch is multi-threaded: at the tail of the search, when cores
+# would idle, the last ones run with up to this many threads (-ncpus)
+ACCELSEARCH_MAX_THREADS = 8
+# a crashed or killed task is tried again elsewhere before its subtree is dropped
+TASK_RETRY = RetryPolicy(max_attempts=3, backoff=10.0, other_host=True)
+
 def parse_readfile(output):
     header = {}
     for line in output.split('\n'):
@@ -65,23 +88,78 @@ def parse_ddplan(output):
 
     return ret
 
+def pipeline_stage(task):
+    """Which stage's priority policy applies to a task of the pipeline graph"""
+    return 'stage_2' if task.name.startswith('cand_') else 'stage_1'
+
 def parse_accel_sift(output):
     start = output.find("JSON_BEGIN") + len("JSON_BEGIN")
     end = output.find("JSON_END")
     return json.loads(output[start:end].strip())
 
-async def pipeline(fbfilename, hostfilename, workdir_prefix, rootname, maxDM, Nsub, Nint, Tres, zmax):
-
-    host_manager = HostManager.from_hostfile(hostfilename)
-    base_executor = host_manager.get_base_executor()
-    await host_manager.connect_remote()
+async def pipeline(fbfilename, hostfilename, workdir_prefix, rootname, maxDM, Nsub, Nint, Tres, zmax,
+                   stage_1_policy='upward_rank', stage_2_policy='longest_first',
+                   history_file=DEFAULT_HISTORY_FILE, resume_workdir=None, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                   metrics_port=None, scheduler_socket=None):
+    """stage_*_policy: TaskPriority policy (or its name) for the tasks of each stage
+    history_file: where task run times are kept across runs
+    resume_workdir: working directory of an interrupted run to continue;
+                    tasks its journal lists as done with unchanged files are skipped
+    cache_dir: StageCache shared by all runs, reusing the outputs of stages
+               whose inputs and parameters are unchanged; None to disable
+    cache_size: bytes the cache is shrunk to before and after the run
+    metrics_port: serve the scheduler's and remote executors' metrics
+                  at http://localhost:<metrics_port>/metrics while running
+    scheduler_socket: run every command through the SchedulerDaemon
+                  listening there, sharing its cluster with other runs,
+                  instead of on the hosts of hostfilename; no journal,
+                  cache or trace of the run then
+    """
+
+    metrics = None
+    metrics_server = None
+    if metrics_port is not None:
+        metrics = MetricsRegistry()
+        metrics_server = MetricsServer(metrics, port=metrics_port)
+        await metrics_server.start()
+
+    scheduler = None
+    if scheduler_socket is not None:
+        if resume_workdir is not None:
+            raise Exception("Runs through the scheduler keep no journal to resume from")
+        scheduler = SchedulerClient(
+            scheduler_socket, workdir_prefix,
+            policy=StagedPriority({'stage_1': stage_1_policy, 'stage_2': stage_2_policy}, pipeline_stage),
+            retry_policy=TASK_RETRY
+        )
+        await scheduler.connect()
+        base_executor = scheduler
+        cache_dir = None
+    else:
+        host_manager = HostManager.from_hostfile(hostfilename, metrics=metrics)
+        base_executor = host_manager.get_base_executor()
+        await host_manager.connect_remote()
+    history = TaskHistory(history_file)
+    # relative units still if the history has seen none of the tools
+    unit_seconds = CostModel(history).unit_seconds(RELATIVE_COSTS) or 1.0
+    costs = {tool: cost * unit_seconds for tool, cost in RELATIVE_COSTS.items()}
 
     # TODO: change all remote & local executor's working directory
-    workdir = "./" + workdir_prefix + "_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + "/"
-    ret, output = await base_executor.execute(f"mkdir {workdir}")
-    assert(ret == 0)
-    
-    logger.info(f"Created working directory {workdir}")
+    if resume_workdir is not None:
+        workdir = os.path.join(resume_workdir, "")
+        logger.info(f"Resuming in working directory {workdir}")
+    else:
+        workdir = "./" + workdir_prefix + "_" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + "/"
+        ret, output = await base_executor.execute(f"mkdir {workdir}")
+        assert(ret == 0)
+
+        logger.info(f"Created working directory {workdir}")
+    journal = TaskJournal(os.path.join(workdir, JOURNAL_FILE))
+    cache = StageCache(cache_dir, workdir, cache_size) if cache_dir is not None else None
+    if cache is not None:
+        await asyncio.to_thread(cache.evict)
+        # tasks get their cache keys as they are added, hash ahead of that
+        await cache.prime([fbfilename, "PrestoSifting.py"])
 
     ret, output = await base_executor.execute(f"readfile {fbfilename}")
     assert(ret == 0)
@@ -103,15 +181,27 @@ async def pipeline(fbfilename, hostfilename, workdir_prefix, rootname, maxDM, Ns
     ddplan = parse_ddplan(output)
     logger.info(f"ddplan: {ddplan}")
 
-    # prep, realfft & accelsearch
+    # prep, realfft, accelsearch, sifting & prepfold all go into one graph,
+    # run by one executor, so no stage has to drain the cluster first
     # Todo: figure out ddm decision.
-    stage_1_task_executor = ParallelTaskExecutor()
-    for executor in host_manager.all_executors():
-        stage_1_task_executor.add_runner(
-            host_manager.get_dispatch_hint(executor),
-            executor,
-            host_manager.get_slot(executor)
+    if scheduler is not None:
+        # the daemon's executor has the runners, and the history
+        task_executor = scheduler
+    else:
+        task_executor = ParallelTaskExecutor(
+            StagedPriority({'stage_1': stage_1_policy, 'stage_2': stage_2_policy}, pipeline_stage),
+            history,
+            retry_policy=TASK_RETRY,
+            journal=journal,
+            cache=cache,
+            metrics=metrics
         )
+        for executor in host_manager.all_executors():
+            task_executor.add_runner(
+                host_manager.get_dispatch_hint(executor),
+                executor,
+                host_manager.get_slot(executor)
+            )
     
     # prep tasks
     assert(len(ddplan) == 1)
@@ -179,80 +269,113 @@ async def pipeline(fbfilename, hostfilename, workdir_prefix, rootname, maxDM, Ns
             'filfile': fbfilename
             }
 
-        prep_task = stage_1_task_executor.add_task(f"prep_batch_{i}", [], [prepsubcmd], 1)
+        prep_task = task_executor.add_task(
+            f"prep_batch_{i}",
+            [],
+            [prepsubcmd],
+            1,
+            costs['prepsubband'],
+            STREAMING_TASK,
+            input_files=[fbfilename],
+            output_files=[os.path.join(workdir, f"{rootname}_DM{dm:.2f}.{ext}") for dm in dml for ext in ['dat', 'inf']]
+        )
         prep_task_uuid.append(prep_task)
 
         for dm in dml:
-            fft_task = stage_1_task_executor.add_task(
+            fft_task = task_executor.add_task(
                 f"realfft_dm{dm}",
                 [prep_task],
                 [f"cd {workdir} && realfft {rootname}_DM{dm:.2f}.dat"],
-                1
+                1,
+                costs['realfft'],
+                STREAMING_TASK,
+                input_files=[os.path.join(workdir, f"{rootname}_DM{dm:.2f}.dat")],
+                output_files=[os.path.join(workdir, f"{rootname}_DM{dm:.2f}.fft")]
             )
             fft_tasks[dm] = fft_task
         
-            accel_search_task = stage_1_task_executor.add_task(
+            accel_search_task = task_executor.add_task(
                 f"accelsearch_dm{dm}",
                 [fft_task],
-                [f"cd {workdir} && accelsearch -zmax 0 {rootname}_DM{dm:.2f}.fft"],
-                1
+                [f"cd {workdir} && accelsearch -zmax {zmax} {rootname}_DM{dm:.2f}.fft"],
+                1,
+                costs['accelsearch'],
+                input_files=[os.path.join(workdir, f"{rootname}_DM{dm:.2f}.{ext}") for ext in ['fft', 'inf']],
+                output_files=[os.path.join(workdir, f"{rootname}_DM{dm:.2f}_ACCEL_{zmax}{ext}") for ext in ['', '.cand']],
+                max_slots=ACCELSEARCH_MAX_THREADS,
+                widen=set_ncpus
             )
             accel_search_tasks[dm] = accel_search_task
         
 
-    stage_1_task_executor.update_alloc()
-    stage_1_task_executor.start_runners()
-
-    await stage_1_task_executor.wait_until_finish()
-
-    # sifting & prepfold
-    logger.info("Stage 1 done.")
-
-    ret, output = await base_executor.execute(f"cp PrestoSifting.py {workdir} && cd {workdir} && python3 PrestoSifting.py 0")
-    assert(ret == 0)
-    logger.debug(f"Sifting output: {output}")
-
-    cands = parse_accel_sift(output)
-    logger.info(f"Sifting cands: {cands}")
-
-    stage_2_task_executor = ParallelTaskExecutor()
-    for executor in host_manager.all_executors():
-        stage_2_task_executor.add_runner(
-            host_manager.get_dispatch_hint(executor),
-            executor,
-            host_manager.get_slot(executor)
-        )
+    def add_fold_tasks(sift_task, outputs):
+        # sifting prints the candidates, each of them gets folded
+        logger.info("Stage 1 done.")
+        logger.debug(f"Sifting output: {outputs[-1]}")
+
+        cands = parse_accel_sift(outputs[-1])
+        logger.info(f"Sifting cands: {cands}")
+
+        for i, cand in enumerate(cands):
+            # foldcmd = "cd %(workdir)s && prepfold -dm %(dm)f -accelcand %(candnum)d -accelfile %(accelfile)s %(datfile)s -noxwin" % {
+            #     'workdir': workdir,
+            #     'dm': cand['DM'],
+            #     'accelfile': cand['filename'] + '.cand',
+            #     'candnum': cand['candnum'],
+            #     'datfile': ('%s_DM%s.dat' % (rootname, cand['DMstr']))
+            # }
+
+            foldcmd = "cd %(workdir)s && prepfold -n %(Nint)d -nsub %(Nsub)d -dm %(dm)f -p %(period)f %(filfile)s -o %(outfile)s -noxwin -nodmsearch" % {
+                'workdir': workdir,
+                'Nint': Nint,
+                'Nsub': Nsub,
+                'dm': cand['DM'],
+                'period': cand['p'],
+                'filfile': f"../{fbfilename}",
+                'outfile': rootname + '_DM' + cand['DMstr']
+            }
 
-    for i, cand in enumerate(cands):
-        # foldcmd = "cd %(workdir)s && prepfold -dm %(dm)f -accelcand %(candnum)d -accelfile %(accelfile)s %(datfile)s -noxwin" % {
-        #     'workdir': workdir,
-        #     'dm': cand['DM'],
-        #     'accelfile': cand['filename'] + '.cand',
-        #     'candnum': cand['candnum'],
-        #     'datfile': ('%s_DM%s.dat' % (rootname, cand['DMstr']))
-        # }
+            task_executor.add_task(
+                f"cand_{i}",
+                [sift_task],
+                [foldcmd],
+                1,
+                costs['prepfold'],
+                STREAMING_TASK,
+                input_files=[fbfilename]
+            )
 
-        foldcmd = "cd %(workdir)s && prepfold -n %(Nint)d -nsub %(Nsub)d -dm %(dm)f -p %(period)f %(filfile)s -o %(outfile)s -noxwin -nodmsearch" % {
-            'workdir': workdir,
-            'Nint': Nint,
-            'Nsub': Nsub,
-            'dm': cand['DM'],
-            'period': cand['p'],
-            'filfile': f"../{fbfilename}",
-            'outfile': rootname + '_DM' + cand['DMstr']
-        }
+    task_executor.add_task(
+        "sifting",
+        list(accel_search_tasks.values()),
+        [f"cp PrestoSifting.py {workdir} && cd {workdir} && python3 PrestoSifting.py {zmax}"],
+        1,
+        on_complete=add_fold_tasks,
+        # its stdout is kept in the journal, so the folds are known on resume;
+        # the script holds the sifting thresholds
+        input_files=["PrestoSifting.py"] + [
+            os.path.join(workdir, f"{rootname}_DM{dm:.2f}_ACCEL_{zmax}") for dm in accel_search_tasks.keys()
+        ]
+    )
 
-        cand_task = stage_2_task_executor.add_task(f"cand_{i}", [], [foldcmd], 1)
-    
-    stage_2_task_executor.update_alloc()
-    stage_2_task_executor.start_runners()
+    task_executor.update_alloc()
+    task_executor.start_runners()
 
-    await stage_2_task_executor.wait_until_finish()
+    await task_executor.wait_until_finish()
+    if cache is not None:
+        await asyncio.to_thread(cache.evict)
 
-    # sifting & prepfold
     logger.info("Stage 2 done.")
+    if scheduler is not None:
+        await scheduler.close()
+    else:
+        write_chrome_trace(task_executor, os.path.join(workdir, "trace.json"))
+        await host_manager.close_remote()
+    if metrics_server is not None:
+        await metrics_server.close()
 
-    await host_manager.close_remote()
+    if len(task_executor.failed_tasks) > 0:
+        raise Exception(f"{len(task_executor.failed_tasks)} tasks failed, {len(task_executor.cancelled_tasks)} not run, see the summary above")
 
 def pretty(s):
     s = os.path.split(s)[-1]
@@ -260,16 +383,21 @@ def pretty(s):
     return m
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: PrestoPipeline.py filterbank_filename")
+    args = sys.argv[1:]
+    resume_workdir = parse_resume(args)
+    metrics_port = parse_metrics_port(args)
+    scheduler_socket = parse_socket(args)
+    cache_dir, cache_size = parse_cache(args)
+    if len(args) != 2:
+        print("Usage: PrestoPipelineDMMaximize.py [--resume workdir] [--metrics-port port] [--socket scheduler_socket] [--cache dir [--cache-size size]] filterbank_filename hostfile")
 
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
         level=logging.DEBUG
     )
 
-    filfile = sys.argv[1]
-    hfile = sys.argv[2]
+    filfile = args[0]
+    hfile = args[1]
     logger.info(f"Run with: filfile={filfile}")
     asyncio.run(pipeline(
         filfile,
@@ -280,5 +408,10 @@ if __name__ == '__main__':
         32,
         64,
         0.5,
-        0
+        0,
+        resume_workdir=resume_workdir,
+        metrics_port=metrics_port,
+        scheduler_socket=scheduler_socket,
+        cache_dir=cache_dir,
+        cache_size=cache_size
     ))
@@ -17,7 +17,9 @@ async def evaluate(host_manager, workdir, input_dats):
         )
 
     for input_dat in input_dats:
-        task_executor.add_task("fft_{}", [], [f"cd {workdir} && realfft {input_dat} -outdir .  >> fft.log"], 1)
+        # short and many: those handed to a runner together share one shell
+        task_executor.add_task("fft_{}", [], [f"cd {workdir} && realfft {input_dat} -outdir .  >> fft.log"], 1,
+                               coalesce=True)
 
     task_executor.update_alloc()
     task_executor.start_runners()
@@ -0,0 +1,145 @@
+"""Commands run in a process group of their own, so they can be killed as
+a whole: the shell, the tool it runs and whatever that started
+
+Executors spawn commands with start_new_session=True and keep them in a
+CommandSet, keyed by request. A command is killed when its timeout runs
+out, when it is cancelled, or, on a server, when its client leaves: SIGTERM
+to the group first, SIGKILL if its leader didn't exit KILL_GRACE seconds
+later. Whoever cancelled a command can wait_killed() for its exit.
+"""
+
+import asyncio
+import logging
+import os
+import signal
+
+logger = logging.getLogger(__name__)
+
+KILL_GRACE = 5.0
+# exit status of a command killed as it ran out of time, like timeout(1)
+TIMEOUT_STATUS = 124
+# returncode of a command cancelled before it was spawned, as if SIGTERM got it
+NOT_STARTED_RETURNCODE = -signal.SIGTERM
+
+async def kill_group(proc, grace=KILL_GRACE):
+    """SIGTERM the process group led by proc, SIGKILL it unless proc exited
+    within grace seconds, or at once if this is cancelled meanwhile (the
+    loop stops); returns once proc exited
+    """
+    def send(sig):
+        try:
+            os.killpg(proc.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+    send(signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        # once proc is reaped, its pid (the group's id) may be reused
+        if proc.returncode is None:
+            send(signal.SIGKILL)
+    await proc.wait()
+
+class CommandSet:
+    """Commands in flight, by key (e.g. a request id)
+
+    expect() a command when its request arrives, started() once it was
+    spawned and finished() when it exited; cancel() may come at any point
+    in between, even before it was spawned. A command queued for admission
+    (see Admission) is dropped from the queue by it.
+    """
+    def __init__(self, grace=KILL_GRACE):
+        self.grace = grace
+        # key: dict of proc (None until spawned), admission (future of its
+        # turn to start, if it queues for one), timeout, timer (of the
+        # timeout, once armed), reason (why it was killed, if it was) and
+        # killer (the kill_group() task, once it was killed)
+        self.commands = {}
+        # kill_group() tasks outlive finished()
+        self.killers = set()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def expect(self, key, timeout=None):
+        """timeout: seconds it may run, None for no limit"""
+        self.commands[key] = {'proc': None, 'admission': None, 'timeout': timeout, 'timer': None, 'reason': None,
+                              'killer': None}
+
+    def waiting(self, key, admission):
+        """The command queues until future admission is done"""
+        command = self.commands[key]
+        command['admission'] = admission
+        if command['reason'] is not None:
+            admission.cancel()
+
+    def started(self, key, proc):
+        command = self.commands[key]
+        command['proc'] = proc
+        if command['reason'] is not None:
+            # cancelled while it was being spawned
+            self.kill_proc(command)
+        elif command['timeout'] is not None:
+            self.arm(key, command['timeout'])
+
+    def arm(self, key, timeout):
+        command = self.commands[key]
+        if command['timer'] is not None:
+            command['timer'].cancel()
+        command['timer'] = asyncio.get_running_loop().call_later(timeout, self.kill, key, 'timeout')
+
+    def set_timeout(self, key, timeout):
+        """Limit a command to timeout seconds from now, or from its start if
+        it wasn't spawned yet; ignored if it's not in flight
+        """
+        if key not in self.commands:
+            return
+        if self.commands[key]['proc'] is None:
+            self.commands[key]['timeout'] = timeout
+        else:
+            self.arm(key, timeout)
+
+    def cancel(self, key):
+        """Kill a command, ignored if it's not in flight"""
+        if key in self.commands:
+            self.kill(key, 'cancelled')
+
+    def kill(self, key, reason):
+        command = self.commands[key]
+        if command['reason'] is not None:
+            return
+        command['reason'] = reason
+        if command['proc'] is not None:
+            logger.info(f"Killing command {key} ({reason})")
+            self.kill_proc(command)
+        elif command['admission'] is not None:
+            command['admission'].cancel()
+
+    def kill_proc(self, command):
+        killer = asyncio.create_task(kill_group(command['proc'], self.grace))
+        command['killer'] = killer
+        self.killers.add(killer)
+        killer.add_done_callback(self.killers.discard)
+
+    async def wait_killed(self, key):
+        """Wait until a killed command exited, if it was spawned; the kill
+        goes on if the waiter is cancelled
+        """
+        killer = self.commands[key]['killer']
+        if killer is not None:
+            await asyncio.shield(killer)
+
+    def kill_all(self, reason='cancelled'):
+        for key in list(self.commands.keys()):
+            self.kill(key, reason)
+
+    def finished(self, key):
+        """returns why the command was killed ('timeout' or 'cancelled'),
+        None if it wasn't
+        """
+        command = self.commands.pop(key)
+        if command['timer'] is not None:
+            command['timer'].cancel()
+        return command['reason']
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Run a shell command and report the resources used by its process tree
+
+Usage: ProcessUsage.py report_fd command
+
+Starting the wrapper costs a Python interpreter per command, so executors
+only measure with measure_usage set (usage=1 in the hostfile).
+
+The command's stdout/stderr are inherited untouched; once it has exited a
+JSON object with the usage figures is written to report_fd, and this
+wrapper exits with the command's return code.
+
+Figures, for the whole tree of waited-for descendants:
+    utime, stime: user / system CPU seconds
+    maxrss: peak resident set of the largest single process, bytes
+    inblock, oublock: block I/O operations (getrusage)
+    rchar, wchar: bytes read / written through syscalls, network
+                  filesystems such as NFS included
+    read_bytes, write_bytes: bytes that hit the block layer (local disks)
+The last four come from /proc/self/io and are missing where it is not
+readable.
+"""
+
+import os, sys, json, resource, subprocess
+
+IO_FIELDS = ['rchar', 'wchar', 'read_bytes', 'write_bytes']
+# summed when a task runs several commands, except maxrss (the peak)
+SUMMED_FIELDS = ['utime', 'stime', 'inblock', 'oublock'] + IO_FIELDS
+
+def wrap_command(report_fd, cmd):
+    """argv running cmd under this wrapper"""
+    if isinstance(cmd, bytes):
+        cmd = cmd.decode('utf-8')
+    return [sys.executable, os.path.realpath(__file__), str(report_fd), cmd]
+
+def parse_report(data):
+    if len(data) == 0:
+        return None
+    return json.loads(data.decode('utf-8'))
+
+def merge_usage(total, usage):
+    """Usage of two commands run one after the other"""
+    if total is None:
+        return usage
+    if usage is None:
+        return total
+    merged = {}
+    for key in set(total.keys()) | set(usage.keys()):
+        if key not in total or key not in usage:
+            merged[key] = total.get(key, usage.get(key))
+        elif key == 'maxrss':
+            merged[key] = max(total[key], usage[key])
+        else:
+            merged[key] = total[key] + usage[key]
+    return merged
+
+async def execute(cmd, started=None):
+    """Run shell command cmd under the wrapper, in a process group of its
+    own; started(proc) is called once it was spawned
+    returns (retcode, stdout bytes, usage or None)
+    """
+    # not at the top: the wrapper itself shouldn't pay for importing it
+    import asyncio
+    read_fd, write_fd = os.pipe()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *wrap_command(write_fd, cmd),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=None,
+            pass_fds=(write_fd,),
+            start_new_session=True
+        )
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    if started is not None:
+        started(proc)
+
+    try:
+        stdout, _ = await proc.communicate()
+    except BaseException:
+        os.close(read_fd)
+        raise
+    # the wrapper has exited, so the report is complete and this won't block
+    with os.fdopen(read_fd, 'rb') as f:
+        usage = parse_report(f.read())
+
+    return proc.returncode, stdout, usage
+
+def read_proc_io():
+    """/proc/self/io counters, accumulating over reaped children too"""
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(':', 1) for line in f.read().splitlines() if ':' in line)
+        return {field: int(counters[field]) for field in IO_FIELDS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+def main():
+    report_fd = int(sys.argv[1])
+    cmd = sys.argv[2]
+
+    # the wrapper's own I/O so far (starting python) isn't the command's
+    io_before = read_proc_io()
+    retcode = subprocess.call(cmd, shell=True)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_after = read_proc_io()
+
+    report = {
+        'utime': usage.ru_utime,
+        'stime': usage.ru_stime,
+        # kilobytes on Linux
+        'maxrss': usage.ru_maxrss * 1024,
+        'inblock': usage.ru_inblock,
+        'oublock': usage.ru_oublock
+    }
+    if io_before is not None and io_after is not None:
+        for field in IO_FIELDS:
+            report[field] = io_after[field] - io_before[field]
+
+    os.write(report_fd, json.dumps(report).encode('utf-8'))
+    os.close(report_fd)
+
+    # same convention as the shell for commands killed by a signal
+    sys.exit(retcode if retcode >= 0 else 128 - retcode)
+
+if __name__ == '__main__':
+    main()
@@ -4,27 +4,118 @@
 
 import asyncio, struct, time, sys
 import functools
+import json
 import logging
+import os
+import ProcessUsage
+from CpuTopology import pin_command
+from TaskHistory import task_tool
+from Metrics import MetricsRegistry, MetricsServer
+from CommandStream import CommandStream, DEFAULT_MAX_BUFFERED, exit_status, run_streamed
+from ProcessGroup import CommandSet, NOT_STARTED_RETURNCODE, TIMEOUT_STATUS
+from Admission import AdmissionQueue
+from Resources import parse_size
+from FileTransfer import FILE_CHUNK_SIZE, FILE_OK, FILE_ERROR, FILE_NOT_FOUND, IncomingFile, error_status, sha256_file, stat_file
 
 logger = logging.getLogger(__name__)
 
 PING = 1
 EXECUTE = 2
 EXECUTE_NO_OUTPUT = 3
+EXECUTE_PINNED = 4
+EXECUTE_USAGE = 5
+EXECUTE_STREAM = 6
+PUT = 7
+PUT_DATA = 8
+GET = 9
+STAT = 10
+CANCEL = 11
+EXECUTE_USAGE_MEM = 12
+INFO = 13
 
 PONG = 100
 EXECUTE_RESP = 101
 EXECUTE_NO_OUTPUT_RESP = 103
+EXECUTE_USAGE_RESP = 105
+EXECUTE_CHUNK = 106
+EXECUTE_END = 107
+PUT_RESP = 108
+GET_RESP = 109
+GET_DATA = 110
+STAT_RESP = 111
+INFO_RESP = 112
+
+# metric labels of the request types
+REQUEST_NAMES = {
+    PING: 'ping',
+    EXECUTE: 'execute',
+    EXECUTE_NO_OUTPUT: 'execute_no_output',
+    EXECUTE_PINNED: 'execute_pinned',
+    EXECUTE_USAGE: 'execute_usage',
+    EXECUTE_STREAM: 'execute_stream',
+    PUT: 'put',
+    PUT_DATA: 'put_data',
+    GET: 'get',
+    STAT: 'stat',
+    CANCEL: 'cancel',
+    EXECUTE_USAGE_MEM: 'execute_usage_mem',
+    INFO: 'info'
+}
+
+class ExecutorDisconnected(ConnectionError):
+    """The connection to an executor server was lost while a request was
+    in flight, or the server is gone for good (ExecutorClient.dead)
+    """
+    def __init__(self, message, host=None):
+        super().__init__(message)
+        self.host = host
 
 class ExecutorClient:
     """Usage:
     client = ExecutorClient('some_host')
     await client.connect()
     
+    metrics: a Metrics.MetricsRegistry to count bytes and time requests in
+    heartbeat_interval: seconds between PINGs, None for no heartbeats
+    heartbeat_timeout: the connection is given up once nothing was heard
+                       from the server for this long
+    reconnect_attempts, reconnect_backoff, reconnect_max_backoff: a lost
+                       connection is reopened up to reconnect_attempts
+                       times, waiting reconnect_backoff seconds before the
+                       first attempt and twice as long before each next
+                       one, up to reconnect_max_backoff; after that the
+                       client is dead
+
+    Requests in flight when the connection is lost raise
+    ExecutorDisconnected; those made while reconnecting wait for it.
+    state_listeners are called with the client when it lost its
+    connection, got it back, or died.
+
+    measure_usage: have the server run commands of execute_with_usage()
+    under the ProcessUsage wrapper, which costs an interpreter start each
     """
-    def __init__(self, host, port=11451):
+    def __init__(self, host, port=11451, metrics=None, heartbeat_interval=5.0, heartbeat_timeout=30.0,
+                 reconnect_attempts=5, reconnect_backoff=1.0, reconnect_max_backoff=30.0, measure_usage=False):
         self._host = host
+        self.measure_usage = measure_usage
         self._port = port
+        self._metrics = metrics
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat_timeout = heartbeat_timeout
+        self._reconnect_attempts = reconnect_attempts
+        self._reconnect_backoff = reconnect_backoff
+        self._reconnect_max_backoff = reconnect_max_backoff
+        if metrics is not None:
+            self._reconnects = metrics.counter(
+                'executor_client_reconnects_total', "Connections to executor servers reopened", ['host'])
+            self._bytes_sent = metrics.counter(
+                'executor_client_bytes_sent_total', "Bytes sent to executor servers", ['host'])
+            self._bytes_received = metrics.counter(
+                'executor_client_bytes_received_total', "Bytes received from executor servers", ['host'])
+            self._request_seconds = metrics.histogram(
+                'executor_client_request_seconds', "Round trip of requests, command run time included", ['host', 'type'])
+        # key: msgID, value: (msgType, time sent)
+        self._sent_at = {}
         self._client = None
         self._reader = None
         self._writer = None
@@ -33,43 +124,309 @@ class ExecutorClient:
         # - (In theory no await => no reschedule, but who knows?)
         self._write_lock = None
         self._waiting_msg = None
+        # key: msgID, value: CommandStream of an EXECUTE_STREAM
+        self._streams = {}
+        # key: msgID, value: dict of local_path, checksum, the IncomingFile
+        # once the GET_RESP came, and the future of (status, message, size)
+        self._downloads = {}
+
+        # set while connected, or once dead
+        self._ready = None
+        # bumped on every (re)connect, so a multi-frame request notices
+        self._generation = 0
+        self._handler_task = None
+        self._heartbeat_task = None
+        # loop time of the last frame read, or of the stream consumer
+        # catching up again
+        self._last_heard = None
+        # streams whose consumer holds up the connection at the moment
+        self._blocked_streams = 0
+        # ExecutorDisconnected in-flight requests of the lost connection raise
+        self._error = None
+        self._closing = False
+        self.dead = False
+        self.state_listeners = []
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def connected(self):
+        return self._ready is not None and self._ready.is_set() and not self.dead
 
     async def connect(self):
-        self._client = asyncio.open_connection(
-            self._host, self._port)
-        self._reader, self._writer = await self._client
         self._write_lock = asyncio.Lock()
         self._waiting_msg = dict()
         self._incoming_msg = dict()
+        self._ready = asyncio.Event()
+        await self._open()
+
+    async def _open(self):
+        self._client = asyncio.open_connection(
+            self._host, self._port)
+        self._reader, self._writer = await self._client
+        self._generation += 1
+        self._last_heard = asyncio.get_running_loop().time()
+        self._ready.set()
 
-        asyncio.create_task(self._queueHandler())
+        self._handler_task = asyncio.create_task(self._queueHandler())
+        if self._heartbeat_interval is not None:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
 
     async def _queueHandler(self):
         try:
             while True:
                 header = await self._reader.readexactly(10)
+                self._last_heard = asyncio.get_running_loop().time()
                 msgSize, msgType, msgID = struct.unpack('!IHI', header)
+                if msgType in (EXECUTE_CHUNK, EXECUTE_END):
+                    await self._stream_frame(msgSize, msgType, msgID)
+                    continue
+                if msgType in (GET_RESP, GET_DATA):
+                    await self._download_frame(msgSize, msgType, msgID)
+                    continue
                 assert(msgID not in self._incoming_msg.keys())
-                self._incoming_msg[msgID] = header + await self._reader.readexactly(msgSize - 10)
+                message = header + await self._reader.readexactly(msgSize - 10)
+                if self._metrics is not None:
+                    self._bytes_received.inc(msgSize, host=self._host)
+                if msgID not in self._waiting_msg:
+                    # its waiter gave up, e.g. a heartbeat PING
+                    continue
+                self._incoming_msg[msgID] = message
                 self._waiting_msg[msgID].set()
 
-        except asyncio.exceptions.IncompleteReadError as e:
-            logger.info(f"Connection to server closed.")
-            # TODO: escape
+        except (asyncio.exceptions.IncompleteReadError, ConnectionError) as e:
+            if self._closing:
+                logger.info(f"Connection to server closed.")
+            self._connection_lost(f"connection to {self._host}:{self._port} closed")
+
+    async def _heartbeat(self):
+        """PING every heartbeat_interval; give the connection up once
+        nothing was heard for heartbeat_timeout while we were listening
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._heartbeat_interval)
+            if self._blocked_streams == 0 and loop.time() - self._last_heard > self._heartbeat_timeout:
+                self._connection_lost(f"no heartbeat from {self._host}:{self._port} for {self._heartbeat_timeout}s")
+                return
+            asyncio.create_task(self._heartbeat_ping())
+
+    async def _heartbeat_ping(self):
+        try:
+            await asyncio.wait_for(self.ping(), self._heartbeat_timeout)
+        except (asyncio.TimeoutError, ExecutorDisconnected):
+            # the heartbeat task looks after it
+            pass
+
+    def _connection_lost(self, reason):
+        """Fail every request in flight, then reconnect unless closing"""
+        if not self._ready.is_set():
+            return
+        self._ready.clear()
+        for task in (self._handler_task, self._heartbeat_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._writer.close()
+        if not self._closing:
+            logger.warning(f"Lost executor {self._host}: {reason}")
+
+        error = ExecutorDisconnected(reason, self._host)
+        self._error = error
+        # their waiters see no message and raise
+        for waiter in self._waiting_msg.values():
+            waiter.set()
+        for msgID, stream in self._streams.items():
+            self._sent_at.pop(msgID, None)
+            stream.fail(error)
+        self._streams = {}
+        for msgID, download in self._downloads.items():
+            self._sent_at.pop(msgID, None)
+            if download['incoming'] is not None:
+                download['incoming'].discard(FILE_ERROR, reason)
+            download['future'].set_exception(error)
+        self._downloads = {}
+        self._blocked_streams = 0
+
+        if self._closing:
+            self.dead = True
+            self._ready.set()
+            return
+        self._notify_state()
+        asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self._reconnect_backoff
+        for attempt in range(1, self._reconnect_attempts + 1):
+            await asyncio.sleep(delay)
+            if self._closing:
+                self.dead = True
+                self._ready.set()
+                return
+            try:
+                await self._open()
+            except OSError as e:
+                logger.warning(f"Reconnecting to {self._host}:{self._port} failed ({attempt}/{self._reconnect_attempts}): {e}")
+                delay = min(delay * 2, self._reconnect_max_backoff)
+                continue
+            logger.info(f"Reconnected to {self._host}:{self._port}")
+            if self._metrics is not None:
+                self._reconnects.inc(host=self._host)
+            self._notify_state()
+            return
+
+        logger.error(f"Executor {self._host}:{self._port} is dead, gave up after {self._reconnect_attempts} attempts")
+        self.dead = True
+        # wake the requests waiting for the connection, they raise
+        self._ready.set()
+        self._notify_state()
+
+    def _notify_state(self):
+        for listener in self.state_listeners:
+            listener(self)
+
+    async def _connection_ready(self):
+        """Wait out a reconnect"""
+        if not self._ready.is_set():
+            await self._ready.wait()
+        if self.dead:
+            raise ExecutorDisconnected(f"executor {self._host}:{self._port} is dead", self._host)
+
+    async def _stream_frame(self, msgSize, msgType, msgID):
+        """Hand a frame of an EXECUTE_STREAM to its CommandStream
+        A full stream blocks this, and so every response on the connection,
+        until its consumer catches up: the server then stops reading the
+        command's output as the socket fills up.
+        """
+        body = await self._reader.readexactly(msgSize - 10)
+        if self._metrics is not None:
+            self._bytes_received.inc(msgSize, host=self._host)
+        stream = self._streams[msgID]
+        if msgType == EXECUTE_CHUNK:
+            streamID, dataLen = struct.unpack('!HI', body[:6])
+            assert(len(body) == 6 + dataLen)
+            if stream.frames.full():
+                # its consumer lags, don't count the wait against the server
+                self._blocked_streams += 1
+                try:
+                    await stream.put_chunk(streamID, body[6:])
+                finally:
+                    self._blocked_streams = max(self._blocked_streams - 1, 0)
+                    self._last_heard = asyncio.get_running_loop().time()
+                return
+            await stream.put_chunk(streamID, body[6:])
+            return
+
+        retCode, = struct.unpack('!I', body)
+        del self._streams[msgID]
+        self._observe_request(msgID)
+        await stream.put_end(retCode)
+
+    async def _download_frame(self, msgSize, msgType, msgID):
+        """Write a frame of a GET into its file, in a thread: the loop
+        keeps serving other requests meanwhile, frames stay in order
+        """
+        body = await self._reader.readexactly(msgSize - 10)
+        if self._metrics is not None:
+            self._bytes_received.inc(msgSize, host=self._host)
+        download = self._downloads[msgID]
+        if msgType == GET_RESP:
+            status, size, digestLen = struct.unpack('!IQI', body[:16])
+            digest = body[16:16 + digestLen].decode('utf-8')
+            message = body[20 + digestLen:].decode('utf-8')
+            if status != FILE_OK:
+                self._settle_download(msgID, (status, message, 0))
+                return
+            download['incoming'] = await asyncio.to_thread(
+                IncomingFile, download['local_path'], size, digest if download['checksum'] else None)
+        else:
+            dataLen, = struct.unpack('!I', body[:4])
+            assert(len(body) == 4 + dataLen)
+            await asyncio.to_thread(download['incoming'].write, body[4:])
+
+        incoming = download['incoming']
+        if incoming.complete():
+            status, message = await asyncio.to_thread(incoming.finish)
+            self._settle_download(msgID, (status, message, incoming.size))
+
+    def _settle_download(self, msgID, result):
+        download = self._downloads.pop(msgID)
+        self._observe_request(msgID)
+        download['future'].set_result(result)
+
+    def _observe_request(self, msgID):
+        msgType, sent_at = self._sent_at.pop(msgID)
+        if self._metrics is not None:
+            self._request_seconds.observe(
+                asyncio.get_running_loop().time() - sent_at, host=self._host, type=REQUEST_NAMES[msgType]
+            )
 
     async def _wait_message(self, expectedID):
         assert(expectedID not in self._waiting_msg)
         self._waiting_msg[expectedID] = asyncio.Event()
-        await self._waiting_msg[expectedID].wait()
+        try:
+            await self._waiting_msg[expectedID].wait()
+        finally:
+            #self._waiting_msg[expectedID].clear()
+            del self._waiting_msg[expectedID]
+            if expectedID not in self._incoming_msg:
+                # given up on, or the connection was lost before the response
+                self._sent_at.pop(expectedID, None)
 
-        msg = self._incoming_msg[expectedID]
+        if expectedID not in self._incoming_msg:
+            raise self._error
 
-        #self._waiting_msg[expectedID].clear()
-        del self._waiting_msg[expectedID]
+        msg = self._incoming_msg[expectedID]
         del self._incoming_msg[expectedID]
 
+        self._observe_request(expectedID)
+
         return msg
 
+    async def _send(self, msg, track=True):
+        """track: time the request until its response, not for a CANCEL,
+        which has the id of the request it's about
+        """
+        await self._connection_ready()
+        msgSize, msgType, msgID = struct.unpack('!IHI', msg[:10])
+        if track:
+            self._sent_at[msgID] = (msgType, asyncio.get_running_loop().time())
+        try:
+            async with self._write_lock:
+                self._writer.write(msg)
+                await self._writer.drain()
+        except ConnectionError as e:
+            if track:
+                self._sent_at.pop(msgID, None)
+            raise ExecutorDisconnected(f"sending to {self._host}:{self._port} failed: {e}", self._host)
+        if self._metrics is not None:
+            self._bytes_sent.inc(len(msg), host=self._host)
+
+    async def _cancel(self, msgID, timeout=0.0):
+        """Have the server kill the command of request msgID, at once or
+        once it ran timeout seconds
+        """
+        try:
+            await self._send(struct.pack('!IHId', 4 + 2 + 4 + 8, CANCEL, msgID, timeout), track=False)
+        except ExecutorDisconnected:
+            # the server kills the commands of a lost connection anyway
+            pass
+
+    async def _request(self, seq_num, msg, timeout):
+        """Send the request of a command and wait for its response; the
+        command is killed after timeout seconds (None: no limit), or if the
+        caller is cancelled
+        """
+        await self._send(msg)
+        if timeout is not None:
+            await self._cancel(seq_num, timeout)
+        try:
+            return await self._wait_message(seq_num)
+        except asyncio.CancelledError:
+            asyncio.create_task(self._cancel(seq_num))
+            raise
+
     async def ping(self):
         """Returns time spent in seconds, using float"""
         assert(self._client is not None)
@@ -80,11 +437,7 @@ class ExecutorClient:
         self._next_seq += 1
         # ---------------------------------
 
-        async with self._write_lock:
-            self._writer.write(
-                struct.pack('!IHI', 4 + 2 + 4, PING, seq_num)
-            )
-            await self._writer.drain()
+        await self._send(struct.pack('!IHI', 4 + 2 + 4, PING, seq_num))
 
         message = await self._wait_message(seq_num)
         msgSize, msgType, msgID = struct.unpack('!IHI', message)
@@ -93,8 +446,14 @@ class ExecutorClient:
         end_time = time.perf_counter()
         return end_time - start_time
 
-    async def execute(self, cmd):
-        logger.info(f"EXECUTE: {cmd}")
+    async def execute(self, cmd, cores=None, timeout=None):
+        """cores: list of cpu ids on the server to pin the command to,
+        the server applies its own NUMA binding for them
+        timeout: seconds after which the server kills the command's process
+                 group, which then reports TIMEOUT_STATUS; None for no limit
+        Cancelling the call kills the command too.
+        """
+        logger.info(f"EXECUTE: {cmd}, cores={cores}")
 
         # TODO: check proper encoding
         cmd = cmd.encode('utf-8')
@@ -104,51 +463,283 @@ class ExecutorClient:
         self._next_seq += 1
         # ---------------------------------
 
-        async with self._write_lock:
-            self._writer.write(
-                struct.pack(
-                    '!IHII',
-                    4 + 2 + 4 + 4 + len(cmd),
-                    EXECUTE,
-                    seq_num,
-                    len(cmd)
-                ) + cmd
-            )
-            await self._writer.drain()
+        if cores:
+            msg = struct.pack(
+                f'!IHII{len(cores)}II',
+                4 + 2 + 4 + 4 + 4 * len(cores) + 4 + len(cmd),
+                EXECUTE_PINNED,
+                seq_num,
+                len(cores),
+                *cores,
+                len(cmd)
+            ) + cmd
+        else:
+            msg = struct.pack(
+                '!IHII',
+                4 + 2 + 4 + 4 + len(cmd),
+                EXECUTE,
+                seq_num,
+                len(cmd)
+            ) + cmd
 
-        message = await self._wait_message(seq_num)
+        message = await self._request(seq_num, msg, timeout)
         msgSize, msgType, msgID, retCode, retLen = struct.unpack('!IHIII', message[:18])
         retStr = message[18:].decode('utf-8')
         assert(len(retStr) == retLen and msgType == EXECUTE_RESP and msgID == seq_num)
         return (retCode, retStr)
 
-    async def execute_no_output(self, cmd):
-        # TODO: check proper encoding
+    async def execute_with_usage(self, cmd, cores=None, timeout=None, mem=None):
+        """Like execute(), but the server measures the command's resource
+        usage if measure_usage is set
+        mem: bytes of memory the command declares, counted against the
+             server's memory budget; None for none
+        returns (retcode, stdout, usage), usage as reported by ProcessUsage
+        on the server (None if not measured, or it couldn't be)
+        """
+        if not self.measure_usage and not mem:
+            retCode, retStr = await self.execute(cmd, cores, timeout)
+            return (retCode, retStr, None)
+        logger.info(f"EXECUTE_USAGE: {cmd}, cores={cores}, mem={mem}")
+
+        cmd = cmd.encode('utf-8')
+        cores = cores or []
+
+        # -- naturally ensures atomicity --
+        seq_num = self._next_seq
+        self._next_seq += 1
+        # ---------------------------------
+
+        if mem:
+            msg = struct.pack(
+                f'!IHII{len(cores)}IQHI',
+                4 + 2 + 4 + 4 + 4 * len(cores) + 8 + 2 + 4 + len(cmd),
+                EXECUTE_USAGE_MEM,
+                seq_num,
+                len(cores),
+                *cores,
+                int(mem),
+                1 if self.measure_usage else 0,
+                len(cmd)
+            ) + cmd
+        else:
+            msg = struct.pack(
+                f'!IHII{len(cores)}II',
+                4 + 2 + 4 + 4 + 4 * len(cores) + 4 + len(cmd),
+                EXECUTE_USAGE,
+                seq_num,
+                len(cores),
+                *cores,
+                len(cmd)
+            ) + cmd
+
+        message = await self._request(seq_num, msg, timeout)
+        msgSize, msgType, msgID, retCode, usageLen = struct.unpack('!IHIII', message[:18])
+        assert(msgType == EXECUTE_USAGE_RESP and msgID == seq_num)
+        usage = ProcessUsage.parse_report(message[18:18 + usageLen])
+        retLen, = struct.unpack('!I', message[18 + usageLen:22 + usageLen])
+        retStr = message[22 + usageLen:].decode('utf-8')
+        assert(len(retStr) == retLen)
+        return (retCode, retStr, usage)
+
+    async def execute_stream(self, cmd, cores=None, max_buffered=DEFAULT_MAX_BUFFERED, timeout=None):
+        """Like execute(), but the server sends stdout and stderr as they
+        are produced instead of all of stdout at the end; at most
+        max_buffered chunks are held for the consumer
+        returns a CommandStream, whose cancel() kills the command
+        """
+        logger.info(f"EXECUTE_STREAM: {cmd}, cores={cores}")
+
         cmd = cmd.encode('utf-8')
+        cores = cores or []
+
+        # -- naturally ensures atomicity --
+        seq_num = self._next_seq
+        self._next_seq += 1
+        # ---------------------------------
+
+        stream = CommandStream(max_buffered)
+        self._streams[seq_num] = stream
+        await self._send(
+            struct.pack(
+                f'!IHII{len(cores)}II',
+                4 + 2 + 4 + 4 + 4 * len(cores) + 4 + len(cmd),
+                EXECUTE_STREAM,
+                seq_num,
+                len(cores),
+                *cores,
+                len(cmd)
+            ) + cmd
+        )
+        if timeout is not None:
+            await self._cancel(seq_num, timeout)
+        stream.canceller = lambda: asyncio.create_task(self._cancel(seq_num))
+        return stream
+
+    async def put_file(self, local_path, remote_path, checksum=False):
+        """Upload local_path to remote_path on the server (relative to its
+        working directory), in chunks sent with loop.sendfile()
+        checksum: have the server check the sha256 of what it received
+        returns the size uploaded
+        """
+        logger.info(f"PUT: {local_path} -> {self._host}:{remote_path}")
+        path = remote_path.encode('utf-8')
+        digest = (await asyncio.to_thread(sha256_file, local_path)).encode('utf-8') if checksum else b''
 
         # -- naturally ensures atomicity --
         seq_num = self._next_seq
         self._next_seq += 1
         # ---------------------------------
 
-        async with self._write_lock:
-            self._writer.write(
+        loop = asyncio.get_running_loop()
+        with open(local_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            await self._send(
                 struct.pack(
                     '!IHII',
-                    4 + 2 + 4 + 4 + len(cmd),
-                    EXECUTE_NO_OUTPUT,
+                    4 + 2 + 4 + 4 + len(path) + 8 + 4 + len(digest),
+                    PUT,
                     seq_num,
-                    len(cmd)
-                ) + cmd
+                    len(path)
+                ) + path + struct.pack('!QI', size, len(digest)) + digest
             )
-            await self._writer.drain()
+
+            # the rest must go over the same connection
+            generation = self._generation
+            offset = 0
+            while offset < size:
+                count = min(FILE_CHUNK_SIZE, size - offset)
+                # other requests go out between the chunks
+                async with self._write_lock:
+                    if self._generation != generation or not self._ready.is_set():
+                        self._sent_at.pop(seq_num, None)
+                        raise ExecutorDisconnected(f"connection to {self._host} lost while sending {local_path}", self._host)
+                    try:
+                        self._writer.write(struct.pack('!IHII', 4 + 2 + 4 + 4 + count, PUT_DATA, seq_num, count))
+                        sent = await loop.sendfile(self._writer.transport, f, offset, count)
+                    except (ConnectionError, RuntimeError) as e:
+                        self._sent_at.pop(seq_num, None)
+                        raise ExecutorDisconnected(f"sending {local_path} to {self._host} failed: {e}", self._host)
+                if sent != count:
+                    raise Exception(f"{local_path} shrank while being sent to {self._host}")
+                if self._metrics is not None:
+                    self._bytes_sent.inc(4 + 2 + 4 + 4 + count, host=self._host)
+                offset += count
+
+        message = await self._wait_message(seq_num)
+        msgSize, msgType, msgID, status, msgLen = struct.unpack('!IHIII', message[:18])
+        assert(msgType == PUT_RESP and msgID == seq_num)
+        if status != FILE_OK:
+            raise Exception(f"PUT of {local_path} to {self._host}:{remote_path} failed: {message[18:].decode('utf-8')}")
+        return size
+
+    async def get_file(self, remote_path, local_path, checksum=False):
+        """Download remote_path from the server into local_path, which
+        the server sends with loop.sendfile()
+        checksum: check the sha256 the server computes for the file
+        returns the size downloaded
+        """
+        logger.info(f"GET: {self._host}:{remote_path} -> {local_path}")
+        path = remote_path.encode('utf-8')
+
+        # -- naturally ensures atomicity --
+        seq_num = self._next_seq
+        self._next_seq += 1
+        # ---------------------------------
+
+        future = asyncio.get_running_loop().create_future()
+        self._downloads[seq_num] = {'local_path': local_path, 'checksum': checksum, 'incoming': None, 'future': future}
+        await self._send(
+            struct.pack(
+                '!IHII',
+                4 + 2 + 4 + 4 + len(path) + 2,
+                GET,
+                seq_num,
+                len(path)
+            ) + path + struct.pack('!H', 1 if checksum else 0)
+        )
+
+        status, message, size = await future
+        if status != FILE_OK:
+            raise Exception(f"GET of {self._host}:{remote_path} to {local_path} failed: {message}")
+        return size
+
+    async def stat_file(self, remote_path, checksum=False):
+        """returns dict of size, mtime_ns and sha256 (None without
+        checksum) of remote_path on the server, None if it doesn't exist
+        """
+        path = remote_path.encode('utf-8')
+
+        # -- naturally ensures atomicity --
+        seq_num = self._next_seq
+        self._next_seq += 1
+        # ---------------------------------
+
+        await self._send(
+            struct.pack(
+                '!IHII',
+                4 + 2 + 4 + 4 + len(path) + 2,
+                STAT,
+                seq_num,
+                len(path)
+            ) + path + struct.pack('!H', 1 if checksum else 0)
+        )
+
+        message = await self._wait_message(seq_num)
+        msgSize, msgType, msgID, status, size, mtime, digestLen = struct.unpack('!IHIIQQI', message[:34])
+        assert(msgType == STAT_RESP and msgID == seq_num)
+        if status == FILE_NOT_FOUND:
+            return None
+        if status != FILE_OK:
+            raise Exception(f"STAT of {self._host}:{remote_path} failed: {message[38 + digestLen:].decode('utf-8')}")
+        return {
+            'size': size,
+            'mtime_ns': mtime,
+            'sha256': message[34:34 + digestLen].decode('utf-8') if digestLen > 0 else None
+        }
+
+    async def info(self):
+        """returns dict of what the server admits at once: slots (cores)
+        and mem (bytes, None for no limit); how much of that is in use:
+        running, used_slots and used_mem; its queue depth (queued) and cpus
+        """
+        # -- naturally ensures atomicity --
+        seq_num = self._next_seq
+        self._next_seq += 1
+        # ---------------------------------
+
+        await self._send(struct.pack('!IHI', 4 + 2 + 4, INFO, seq_num))
 
         message = await self._wait_message(seq_num)
+        msgSize, msgType, msgID, infoLen = struct.unpack('!IHII', message[:14])
+        assert(msgType == INFO_RESP and msgID == seq_num)
+        return json.loads(message[14:14 + infoLen].decode('utf-8'))
+
+    async def execute_no_output(self, cmd, timeout=None):
+        # TODO: check proper encoding
+        cmd = cmd.encode('utf-8')
+
+        # -- naturally ensures atomicity --
+        seq_num = self._next_seq
+        self._next_seq += 1
+        # ---------------------------------
+
+        msg = struct.pack(
+            '!IHII',
+            4 + 2 + 4 + 4 + len(cmd),
+            EXECUTE_NO_OUTPUT,
+            seq_num,
+            len(cmd)
+        ) + cmd
+
+        message = await self._request(seq_num, msg, timeout)
         msgSize, msgType, msgID, retCode = struct.unpack('!IHII', message)
         assert(msgType == EXECUTE_NO_OUTPUT_RESP and msgID == seq_num)
         return retCode
 
     async def close(self):
+        self._closing = True
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
         self._writer.close()
         self._client = None
         await self._writer.wait_closed()
@@ -171,6 +762,56 @@ class ExecutorServer:
     - EXECUTE_NO_OUTPUT: MessageType = 3
         U32 CommandLength
         String Command
+    - EXECUTE_PINNED: MessageType = 4, answered by EXECUTE_RESP
+        U32 CoreCount
+        U32[CoreCount] Cores
+        U32 CommandLength
+        String Command
+    - EXECUTE_USAGE: MessageType = 5, answered by EXECUTE_USAGE_RESP
+        U32 CoreCount   # 0 for unpinned
+        U32[CoreCount] Cores
+        U32 CommandLength
+        String Command
+    - EXECUTE_STREAM: MessageType = 6, answered by any number of
+      EXECUTE_CHUNK, then EXECUTE_END, all with its MessageID
+        U32 CoreCount   # 0 for unpinned
+        U32[CoreCount] Cores
+        U32 CommandLength
+        String Command
+    - PUT: MessageType = 7, followed by PUT_DATA until Size bytes were
+      sent, then answered by PUT_RESP
+        U32 PathLength
+        String Path     # relative to the server's working directory
+        U64 Size
+        U32 DigestLength    # 0 not to check
+        String Digest   # sha256 hex digest
+    - PUT_DATA: MessageType = 8, with the MessageID of its PUT
+        U32 DataLength  # at most FILE_CHUNK_SIZE
+        String Data
+    - GET: MessageType = 9, answered by GET_RESP, then GET_DATA until
+      Size bytes were sent if it's FILE_OK
+        U32 PathLength
+        String Path
+        U16 Checksum    # 1 to have Digest computed
+    - STAT: MessageType = 10, answered by STAT_RESP
+        U32 PathLength
+        String Path
+        U16 Checksum
+    - CANCEL: MessageType = 11, with the MessageID of a command's request
+      (EXECUTE* types), not answered; the command's process group is
+      killed, and its response reports the exit status of that
+        F64 Timeout     # 0: kill it now, else once it ran this many
+                        # seconds, making its status TIMEOUT_STATUS
+    - EXECUTE_USAGE_MEM: MessageType = 12, answered by EXECUTE_USAGE_RESP
+        U32 CoreCount   # 0 for unpinned
+        U32[CoreCount] Cores
+        U64 Memory      # bytes it declares, counted against the server's
+                        # memory budget
+        U16 Measure     # 0 to run it without measuring its usage
+        U32 CommandLength
+        String Command
+    - INFO: MessageType = 13, answered by INFO_RESP
+        <No extra content>
 
     Response <Payload>:
     - PONG: MessageType = 100
@@ -181,16 +822,87 @@ class ExecutorServer:
         String Result
     - EXECUTE_NO_OUTPUT_RESP: MessageType = 102
         U32 ResultReturnCode
-    
+    - EXECUTE_USAGE_RESP: MessageType = 105
+        U32 ResultReturnCode
+        U32 UsageLength # 0 if not measured
+        String Usage    # JSON object, see ProcessUsage
+        U32 ResultLength
+        String Result
+    - EXECUTE_CHUNK: MessageType = 106
+        U16 Stream      # 1: stdout, 2: stderr
+        U32 DataLength  # at most STREAM_CHUNK_SIZE
+        String Data
+    - EXECUTE_END: MessageType = 107
+        U32 ResultReturnCode    # 128 + signal if killed
+    - PUT_RESP: MessageType = 108
+        U32 Status      # FILE_OK, FILE_ERROR, ... of FileTransfer
+        U32 MessageLength
+        String Message
+    - GET_RESP: MessageType = 109
+        U32 Status
+        U64 Size
+        U32 DigestLength
+        String Digest
+        U32 MessageLength
+        String Message
+    - GET_DATA: MessageType = 110
+        U32 DataLength
+        String Data
+    - STAT_RESP: MessageType = 111
+        U32 Status      # FILE_NOT_FOUND if it doesn't exist
+        U64 Size
+        U64 MtimeNs
+        U32 DigestLength
+        String Digest
+        U32 MessageLength
+        String Message
+    - INFO_RESP: MessageType = 112
+        U32 InfoLength
+        String Info     # JSON object, see ExecutorClient.info()
+
+    Commands run in process groups of their own; those of a client which
+    disconnects are killed.
+
+    Commands of all clients together are admitted up to slots cores (1 per
+    unpinned command) and mem bytes of declared memory, see Admission; the
+    rest queue until they fit. Clients learn slots and mem through INFO
+    instead of trusting a hostfile. A command cancelled while it queues is
+    never started, and reports the status of one killed by SIGTERM.
+
+    With metrics_port, counters of requests, bytes on the wire and
+    running subprocesses are served at http://<host>:<metrics_port>/metrics
     """
 
-    def __init__(self, host='0.0.0.0', port=11451):
+    def __init__(self, host='0.0.0.0', port=11451, metrics_port=None, slots=None, mem=None):
+        """slots: cores commands may use at once, all cpus of the server by default
+        mem: bytes of declared memory commands may use at once, None for no limit
+        """
         self._host = host
         self._port = port
         self._server = None
+        self._admission = AdmissionQueue(slots if slots is not None else os.cpu_count(), mem)
         # Prevent from multiple handlers writing simutaenously
         # - (In theory no await => no reschedule, but who knows?)
-        self._write_lock = None
+        # One lock per connection, held across drain(): a client reading
+        # slowly then only holds up its own responses, not everyone's PONGs
+        # key: writer of a connection, value: its asyncio.Lock
+        self._write_locks = {}
+
+        self._metrics_port = metrics_port
+        self.metrics = MetricsRegistry()
+        self._requests = self.metrics.counter('executor_server_requests_total', "Requests received", ['type'])
+        self._bytes_received = self.metrics.counter('executor_server_bytes_received_total', "Bytes received from clients")
+        self._bytes_sent = self.metrics.counter('executor_server_bytes_sent_total', "Bytes sent to clients")
+        self._clients = self.metrics.gauge('executor_server_clients', "Connected clients")
+        self._subprocesses = self.metrics.gauge('executor_server_subprocesses_in_flight', "Commands running")
+        self._command_seconds = self.metrics.histogram('executor_server_command_seconds', "Run time of commands", ['tool'])
+        self._queue_seconds = self.metrics.histogram('executor_server_queue_seconds', "Time commands waited for admission")
+        self.metrics.gauge('executor_server_queued_commands', "Commands waiting for admission",
+                           function=lambda: len(self._admission))
+        self.metrics.gauge('executor_server_slots_in_use', "Cores admitted commands take",
+                           function=lambda: self._admission.used_slots)
+        self.metrics.gauge('executor_server_memory_in_use_bytes', "Memory admitted commands declared",
+                           function=lambda: self._admission.used_mem)
     
     def serve_forever(self):
         asyncio.get_event_loop().run_until_complete(self.__run())
@@ -198,67 +910,268 @@ class ExecutorServer:
     async def __run(self):
         self._server = await asyncio.start_server(
             self.request_handler, self._host, self._port)
-        self._write_lock = asyncio.Lock()
 
         addr = self._server.sockets[0].getsockname()
-        logger.info(f'Serving on {addr}')
+        logger.info(f'Serving on {addr}, admitting {self._admission.slots} slots, mem={self._admission.mem}')
+
+        if self._metrics_port is not None:
+            await MetricsServer(self.metrics, self._host, self._metrics_port).start()
 
         async with self._server:
             await self._server.serve_forever()
 
+    async def _send(self, writer, resp):
+        if writer.is_closing():
+            # the client left, its commands were killed
+            return
+        try:
+            async with self._write_locks[writer]:
+                writer.write(resp)
+                await writer.drain()
+        except ConnectionError as e:
+            # it left while this was being sent; request_handler cleans up
+            logger.debug(f"Response to a client that left dropped: {e}")
+            return
+        self._bytes_sent.inc(len(resp))
+
+    async def _run_command(self, commands, msgID, cmd, run, not_run, cores=None, mem=0):
+        """await run(started) of a subprocess running cmd, accounted for
+        and killable through commands, where it's expected under msgID;
+        run calls started(proc) once it spawned the subprocess. It waits
+        for its turn to start, for cores (1 if unpinned) and mem.
+        not_run: returned instead if it's cancelled before its turn
+        returns (what run returned, whether it ran out of time)
+        """
+        loop = asyncio.get_running_loop()
+        share = (len(cores) if cores else 1, mem)
+        queued_at = loop.time()
+        admission = self._admission.admit(*share)
+        commands.waiting(msgID, admission)
+        try:
+            await admission
+        except asyncio.CancelledError:
+            if not admission.cancelled():
+                raise
+            commands.finished(msgID)
+            return not_run, False
+        finally:
+            self._queue_seconds.observe(loop.time() - queued_at)
+
+        start_time = loop.time()
+        self._subprocesses.inc()
+        try:
+            result = await run(lambda proc: commands.started(msgID, proc))
+        except asyncio.CancelledError:
+            commands.cancel(msgID)
+            await commands.wait_killed(msgID)
+            raise
+        finally:
+            reason = commands.finished(msgID)
+            self._admission.release(*share)
+            self._subprocesses.dec()
+            self._command_seconds.observe(loop.time() - start_time, tool=task_tool([cmd]))
+        return result, reason == 'timeout'
+
     async def ping_handler(self, writer, msgID):
         resp = struct.pack('!IHI', 4 + 2 + 4, PONG, msgID)
 
         # Uncomment to see the true power of async (x)
         # await asyncio.sleep(1)
 
-        async with self._write_lock:
-            writer.write(resp)
-            await writer.drain()
+        await self._send(writer, resp)
 
         #writer.close()
         #await writer.wait_closed()
 
-    async def execute_handler(self, writer, msgID, cmd):
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=None
-        )
+    async def execute_handler(self, writer, commands, msgID, cmd, cores=None):
+        async def run(started):
+            proc = await asyncio.create_subprocess_shell(
+                pin_command(cmd, cores),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None,
+                start_new_session=True
+            )
+            started(proc)
+            stdout, _ = await proc.communicate()
+            return proc.returncode, stdout
 
-        stdout, _ = await proc.communicate()
+        (retcode, stdout), timed_out = await self._run_command(
+            commands, msgID, cmd, run, (NOT_STARTED_RETURNCODE, b''), cores)
 
         resp = struct.pack(
             '!IHIII',
             4 + 2 + 4 + 4 + 4 + len(stdout),
             EXECUTE_RESP,
             msgID,
-            proc.returncode,
+            TIMEOUT_STATUS if timed_out else exit_status(retcode),
             len(stdout)
         ) + stdout
 
-        async with self._write_lock:
-            writer.write(resp)
-            await writer.drain()
+        await self._send(writer, resp)
 
-    async def execute_no_output_handler(self, writer, msgID, cmd):
-        proc = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=None
-        )
+    async def execute_usage_handler(self, writer, commands, msgID, cmd, cores=None, mem=0, measure=True):
+        async def run(started):
+            if measure:
+                return await ProcessUsage.execute(pin_command(cmd, cores), started)
+            proc = await asyncio.create_subprocess_shell(
+                pin_command(cmd, cores),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=None,
+                start_new_session=True
+            )
+            started(proc)
+            stdout, _ = await proc.communicate()
+            return proc.returncode, stdout, None
+
+        (retcode, stdout, usage), timed_out = await self._run_command(
+            commands, msgID, cmd, run, (NOT_STARTED_RETURNCODE, b'', None), cores, mem)
+        retcode = TIMEOUT_STATUS if timed_out else exit_status(retcode)
+        usage = json.dumps(usage).encode('utf-8') if usage is not None else b''
+
+        resp = struct.pack(
+            '!IHIII',
+            4 + 2 + 4 + 4 + 4 + len(usage) + 4 + len(stdout),
+            EXECUTE_USAGE_RESP,
+            msgID,
+            retcode,
+            len(usage)
+        ) + usage + struct.pack('!I', len(stdout)) + stdout
+
+        await self._send(writer, resp)
 
-        await proc.wait()
+    async def execute_stream_handler(self, writer, commands, msgID, cmd, cores=None):
+        async def forward(streamID, data):
+            # drain() holds further reads of the pipes while the client lags
+            await self._send(writer, struct.pack(
+                '!IHIHI',
+                4 + 2 + 4 + 2 + 4 + len(data),
+                EXECUTE_CHUNK,
+                msgID,
+                streamID,
+                len(data)
+            ) + data)
+
+        retCode, timed_out = await self._run_command(
+            commands, msgID, cmd, lambda started: run_streamed(pin_command(cmd, cores), forward, started),
+            exit_status(NOT_STARTED_RETURNCODE), cores)
+        if timed_out:
+            retCode = TIMEOUT_STATUS
+
+        await self._send(writer, struct.pack('!IHII', 4 + 2 + 4 + 4, EXECUTE_END, msgID, retCode))
+
+    async def put_done_handler(self, writer, msgID, incoming):
+        status, message = await asyncio.to_thread(incoming.finish)
+        message = message.encode('utf-8')
+
+        resp = struct.pack(
+            '!IHIII',
+            4 + 2 + 4 + 4 + 4 + len(message),
+            PUT_RESP,
+            msgID,
+            status,
+            len(message)
+        ) + message
+
+        await self._send(writer, resp)
+
+    async def get_handler(self, writer, msgID, path, checksum):
+        def get_resp(status, size=0, digest=b'', message=''):
+            message = message.encode('utf-8')
+            return struct.pack(
+                '!IHIIQI',
+                4 + 2 + 4 + 4 + 8 + 4 + len(digest) + 4 + len(message),
+                GET_RESP,
+                msgID,
+                status,
+                size,
+                len(digest)
+            ) + digest + struct.pack('!I', len(message)) + message
+
+        try:
+            f = open(path, 'rb')
+        except OSError as e:
+            await self._send(writer, get_resp(error_status(e), message=str(e)))
+            return
+
+        loop = asyncio.get_running_loop()
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            digest = (await asyncio.to_thread(sha256_file, path)).encode('utf-8') if checksum else b''
+            await self._send(writer, get_resp(FILE_OK, size, digest))
+
+            offset = 0
+            while offset < size:
+                count = min(FILE_CHUNK_SIZE, size - offset)
+                if writer.is_closing():
+                    return
+                try:
+                    async with self._write_locks[writer]:
+                        writer.write(struct.pack('!IHII', 4 + 2 + 4 + 4 + count, GET_DATA, msgID, count))
+                        sent = await loop.sendfile(writer.transport, f, offset, count)
+                except ConnectionError as e:
+                    logger.debug(f"Sending {path} to a client that left stopped: {e}")
+                    return
+                self._bytes_sent.inc(4 + 2 + 4 + 4 + sent)
+                if sent != count:
+                    # the client can't tell where the next message starts
+                    logger.error(f"{path} shrank while being sent, dropping the client")
+                    writer.close()
+                    return
+                offset += count
+
+    async def stat_handler(self, writer, msgID, path, checksum):
+        try:
+            st = await asyncio.to_thread(stat_file, path, checksum)
+            status, message = (FILE_OK, '') if st is not None else (FILE_NOT_FOUND, f"No such file: {path}")
+        except OSError as e:
+            st = None
+            status, message = error_status(e), str(e)
+        digest = st['sha256'].encode('utf-8') if st is not None and st['sha256'] is not None else b''
+        message = message.encode('utf-8')
+
+        resp = struct.pack(
+            '!IHIIQQI',
+            4 + 2 + 4 + 4 + 8 + 8 + 4 + len(digest) + 4 + len(message),
+            STAT_RESP,
+            msgID,
+            status,
+            st['size'] if st is not None else 0,
+            st['mtime_ns'] if st is not None else 0,
+            len(digest)
+        ) + digest + struct.pack('!I', len(message)) + message
+
+        await self._send(writer, resp)
+
+    async def info_handler(self, writer, msgID):
+        info = self._admission.info()
+        info['cpus'] = os.cpu_count()
+        info = json.dumps(info).encode('utf-8')
+
+        resp = struct.pack('!IHII', 4 + 2 + 4 + 4 + len(info), INFO_RESP, msgID, len(info)) + info
+
+        await self._send(writer, resp)
+
+    async def execute_no_output_handler(self, writer, commands, msgID, cmd):
+        async def run(started):
+            proc = await asyncio.create_subprocess_shell(
+                cmd,
+                stdout=None,
+                start_new_session=True
+            )
+            started(proc)
+            return await proc.wait()
+
+        retcode, timed_out = await self._run_command(commands, msgID, cmd, run, NOT_STARTED_RETURNCODE)
     
         resp = struct.pack(
             '!IHII',
             4 + 2 + 4 + 4,
             EXECUTE_NO_OUTPUT_RESP,
             msgID,
-            proc.returncode
+            TIMEOUT_STATUS if timed_out else exit_status(retcode)
         )
 
-        async with self._write_lock:
-            writer.write(resp)
+        await self._send(writer, resp)
 
     # actually await is 33% faster in 10000 PING-PONG test, but we need duplex
     # so we use create_task
@@ -266,12 +1179,20 @@ class ExecutorServer:
         addr = writer.get_extra_info('peername')
         wblow, wbhigh = writer.transport.get_write_buffer_limits()
         logger.info(f"New clients from [{addr}]: wblimit=({wblow}, {wbhigh})")
+        self._clients.inc()
+        self._write_locks[writer] = asyncio.Lock()
+        # key: msgID of a PUT, value: its IncomingFile
+        uploads = {}
+        # commands of this client, by msgID of their request
+        commands = CommandSet()
 
         try:
             while True:
                 # (Read a message packet at once!)
                 header = await reader.readexactly(10)
                 msgSize, msgType, msgID = struct.unpack('!IHI', header)
+                self._requests.inc(type=REQUEST_NAMES.get(msgType, 'invalid'))
+                self._bytes_received.inc(msgSize)
                 if msgType == 1:    # PING
                     #await self.ping_handler(writer, msgID)
                     asyncio.create_task(self.ping_handler(writer, msgID))
@@ -279,24 +1200,125 @@ class ExecutorServer:
                 elif msgType == 2:  # EXECUTE
                     cmdLen, = struct.unpack('!I', await reader.readexactly(4))
                     cmd = await reader.readexactly(cmdLen)  # bytes are OK
-                    asyncio.create_task(self.execute_handler(writer, msgID, cmd))
+                    commands.expect(msgID)
+                    asyncio.create_task(self.execute_handler(writer, commands, msgID, cmd))
 
                 elif msgType == 3:  # EXECUTE_NO_OUTPUT
                     cmdLen, = struct.unpack('!I', await reader.readexactly(4))
                     cmd = (await reader.readexactly(cmdLen))
-                    asyncio.create_task(self.execute_no_output_handler(writer, msgID, cmd))
+                    commands.expect(msgID)
+                    asyncio.create_task(self.execute_no_output_handler(writer, commands, msgID, cmd))
+
+                elif msgType == 4:  # EXECUTE_PINNED
+                    coreCount, = struct.unpack('!I', await reader.readexactly(4))
+                    cores = list(struct.unpack(f'!{coreCount}I', await reader.readexactly(4 * coreCount)))
+                    cmdLen, = struct.unpack('!I', await reader.readexactly(4))
+                    cmd = await reader.readexactly(cmdLen)
+                    commands.expect(msgID)
+                    asyncio.create_task(self.execute_handler(writer, commands, msgID, cmd, cores))
+
+                elif msgType == 5:  # EXECUTE_USAGE
+                    coreCount, = struct.unpack('!I', await reader.readexactly(4))
+                    cores = list(struct.unpack(f'!{coreCount}I', await reader.readexactly(4 * coreCount)))
+                    cmdLen, = struct.unpack('!I', await reader.readexactly(4))
+                    cmd = await reader.readexactly(cmdLen)
+                    commands.expect(msgID)
+                    asyncio.create_task(self.execute_usage_handler(writer, commands, msgID, cmd, cores))
+
+                elif msgType == 6:  # EXECUTE_STREAM
+                    coreCount, = struct.unpack('!I', await reader.readexactly(4))
+                    cores = list(struct.unpack(f'!{coreCount}I', await reader.readexactly(4 * coreCount)))
+                    cmdLen, = struct.unpack('!I', await reader.readexactly(4))
+                    cmd = await reader.readexactly(cmdLen)
+                    commands.expect(msgID)
+                    asyncio.create_task(self.execute_stream_handler(writer, commands, msgID, cmd, cores))
+
+                elif msgType == 7:  # PUT
+                    pathLen, = struct.unpack('!I', await reader.readexactly(4))
+                    path = (await reader.readexactly(pathLen)).decode('utf-8')
+                    size, digestLen = struct.unpack('!QI', await reader.readexactly(12))
+                    digest = (await reader.readexactly(digestLen)).decode('utf-8')
+                    # file writes and hashing in a thread, the connection's
+                    # next frame is read once this one is written
+                    incoming = await asyncio.to_thread(IncomingFile, path, size, digest or None)
+                    if incoming.complete():
+                        asyncio.create_task(self.put_done_handler(writer, msgID, incoming))
+                    else:
+                        uploads[msgID] = incoming
+
+                elif msgType == 8:  # PUT_DATA
+                    dataLen, = struct.unpack('!I', await reader.readexactly(4))
+                    incoming = uploads[msgID]
+                    await asyncio.to_thread(incoming.write, await reader.readexactly(dataLen))
+                    if incoming.complete():
+                        del uploads[msgID]
+                        asyncio.create_task(self.put_done_handler(writer, msgID, incoming))
+
+                elif msgType == 9:  # GET
+                    pathLen, = struct.unpack('!I', await reader.readexactly(4))
+                    path = (await reader.readexactly(pathLen)).decode('utf-8')
+                    checksum, = struct.unpack('!H', await reader.readexactly(2))
+                    asyncio.create_task(self.get_handler(writer, msgID, path, checksum))
+
+                elif msgType == 10: # STAT
+                    pathLen, = struct.unpack('!I', await reader.readexactly(4))
+                    path = (await reader.readexactly(pathLen)).decode('utf-8')
+                    checksum, = struct.unpack('!H', await reader.readexactly(2))
+                    asyncio.create_task(self.stat_handler(writer, msgID, path, checksum))
+
+                elif msgType == 11: # CANCEL
+                    timeout, = struct.unpack('!d', await reader.readexactly(8))
+                    if timeout > 0:
+                        commands.set_timeout(msgID, timeout)
+                    else:
+                        commands.cancel(msgID)
+
+                elif msgType == 12: # EXECUTE_USAGE_MEM
+                    coreCount, = struct.unpack('!I', await reader.readexactly(4))
+                    cores = list(struct.unpack(f'!{coreCount}I', await reader.readexactly(4 * coreCount)))
+                    mem, measure, cmdLen = struct.unpack('!QHI', await reader.readexactly(14))
+                    cmd = await reader.readexactly(cmdLen)
+                    commands.expect(msgID)
+                    asyncio.create_task(self.execute_usage_handler(writer, commands, msgID, cmd, cores, mem, measure))
+
+                elif msgType == 13: # INFO
+                    asyncio.create_task(self.info_handler(writer, msgID))
 
                 else:
                     raise Exception("Invalid Message Type")
-        except asyncio.exceptions.IncompleteReadError as e:
+        except (asyncio.exceptions.IncompleteReadError, ConnectionError) as e:
             logger.info(f"Client [{addr}] have left.")
-            # TODO: cleanup spawned subprocesses?
+        finally:
+            if len(commands) > 0:
+                logger.info(f"Killing {len(commands)} commands of [{addr}]")
+                commands.kill_all()
+            # handlers still running see it closing and send nothing more
+            writer.close()
+            del self._write_locks[writer]
+            for incoming in uploads.values():
+                incoming.discard(FILE_ERROR, "Client left during upload")
+            self._clients.dec()
         
 
+def parse_server_options(args):
+    """[metrics_port] [slots=<n>] [mem=<size>] -> dict of ExecutorServer arguments"""
+    positional = [arg for arg in args if '=' not in arg]
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+
+    kwargs = {'metrics_port': int(positional[0]) if len(positional) > 0 else None}
+    if 'slots' in options:
+        kwargs['slots'] = int(options.pop('slots'))
+    if 'mem' in options:
+        kwargs['mem'] = int(parse_size(options.pop('mem')))
+    if len(options) > 0 or len(positional) > 1:
+        raise Exception(f"Unknown server options: {args}")
+    return kwargs
+
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} mode, mode := server | client")
+    if len(sys.argv) < 2 or (sys.argv[1] != "server" and len(sys.argv) > 2):
+        print(f"Usage: {sys.argv[0]} mode, mode := server [metrics_port] [slots=<n>] [mem=<size>] | client")
         print(f"When in client mode, this program connects to localhost")
+        print(f"A server admits commands for slots cores (default: all cpus) and mem bytes they declare (default: no limit)")
         sys.exit(1)
     
     if sys.argv[1] == "server":
@@ -305,14 +1327,15 @@ if __name__ == '__main__':
             level=logging.INFO
         )
 
-        server = ExecutorServer()
+        server = ExecutorServer(**parse_server_options(sys.argv[2:]))
         server.serve_forever()
     elif sys.argv[1] == "client":
         async def run_ping():
-            client = ExecutorClient('localhost')
+            client = ExecutorClient('localhost', measure_usage=True)
             await client.connect()
             call_time = await client.ping()
             print(f"PING-PONG time: {call_time * 1000} msec.")
+            print(f"Server info: {await client.info()}")
 
             call_time = 0
             for i in range(0, 10000):
@@ -345,6 +1368,36 @@ if __name__ == '__main__':
             retCode = await client.execute_no_output(cmd)
             print(f"Remote execute test for [{cmd}]: retcode={retCode}")
 
+            cmd = 'head -c 10000000 /dev/zero | md5sum'
+            retCode, retStr, usage = await client.execute_with_usage(cmd)
+            print(f"Remote execute with usage for [{cmd}]: retcode={retCode}, out='''{retStr}''', usage={usage}")
+
+            cmd = 'for i in 1 2 3; do echo "line $i"; echo "err $i" >&2; sleep 0.2; done; exit 7'
+            stream = await client.execute_stream(cmd)
+            async for streamID, data in stream:
+                print(f"Remote stream of [{cmd}]: {'stdout' if streamID == 1 else 'stderr'} '''{data.decode('utf-8')}'''")
+            print(f"Remote stream of [{cmd}]: retcode={stream.returncode}")
+
+            cmd = 'head -c 100000000 /dev/zero'
+            start_time = time.perf_counter()
+            retCode, stdout, stderr = await (await client.execute_stream(cmd)).read_all()
+            end_time = time.perf_counter()
+            print(f"Remote stream of [{cmd}]: retcode={retCode}, {len(stdout)} bytes in {(end_time - start_time) * 1000} msec.")
+
+            with open("executor_demo.bin", "wb") as f:
+                f.write(os.urandom(10000000))
+            start_time = time.perf_counter()
+            size = await client.put_file("executor_demo.bin", "executor_demo/uploaded.bin", checksum=True)
+            await client.get_file("executor_demo/uploaded.bin", "executor_demo.got.bin", checksum=True)
+            end_time = time.perf_counter()
+            print(f"PUT and GET of {size} bytes with checksums: {(end_time - start_time) * 1000} msec.")
+            print(f"Remote stat: {await client.stat_file('executor_demo/uploaded.bin', checksum=True)}")
+            print(f"Round trip intact: {sha256_file('executor_demo.bin') == sha256_file('executor_demo.got.bin')}")
+            print(f"Remote stat of a missing file: {await client.stat_file('executor_demo/missing.bin')}")
+            os.remove("executor_demo.bin")
+            os.remove("executor_demo.got.bin")
+            await client.execute("rm -r executor_demo")
+
             cmd = '/bin/true'
             retCode = await client.execute_no_output(cmd)
             print(f"Remote execute test for [{cmd}]: retcode={retCode}")
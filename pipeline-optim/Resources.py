@@ -0,0 +1,56 @@
+"""Multi-dimensional resource vectors for tasks and hosts
+
+A task asks for a ResourceVector and a host advertises one as its
+capacity; the scheduler only places a task where every dimension fits.
+Dimensions left unspecified on a host are unlimited, on a task they are 0.
+"""
+
+UNLIMITED = float('inf')
+
+UNITS = {
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4
+}
+
+def parse_size(text):
+    """'512M' / '64G' / '1048576' -> bytes"""
+    text = text.strip().upper().rstrip('B')
+    if len(text) > 0 and text[-1] in UNITS:
+        return float(text[:-1]) * UNITS[text[-1]]
+    return float(text)
+
+class ResourceVector:
+    """cores: cpu cores (the former slot count)
+    mem: resident memory in bytes
+    io: relative disk / NFS bandwidth weight, e.g. 1 per streaming reader
+    """
+    def __init__(self, cores=0, mem=0.0, io=0.0):
+        self.cores = cores
+        self.mem = mem
+        self.io = io
+
+    def __repr__(self):
+        return f"ResourceVector(cores={self.cores}, mem={self.mem}, io={self.io})"
+
+    def __add__(self, other):
+        return ResourceVector(self.cores + other.cores, self.mem + other.mem, self.io + other.io)
+
+    def __sub__(self, other):
+        return ResourceVector(self.cores - other.cores, self.mem - other.mem, self.io - other.io)
+
+    def fits(self, capacity):
+        """Whether a request of self fits into capacity"""
+        return self.cores <= capacity.cores \
+            and self.mem <= capacity.mem \
+            and self.io <= capacity.io
+
+    @staticmethod
+    def capacity(cores, mem=None, io=None):
+        """Host capacity, None meaning the dimension isn't limited"""
+        return ResourceVector(
+            cores,
+            UNLIMITED if mem is None else mem,
+            UNLIMITED if io is None else io
+        )
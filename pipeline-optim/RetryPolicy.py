@@ -0,0 +1,31 @@
+"""When and where ParallelTaskExecutor runs a failed task again
+
+A task fails when one of its actions exits non-zero or its executor
+raises (e.g. the connection to a remote host broke). Once its policy
+gives up, the task and every task depending on it are dropped.
+"""
+
+class RetryPolicy:
+    """max_attempts: runs in total, 1 meaning no retry
+    backoff: seconds to wait before the first retry
+    backoff_factor: the wait is multiplied by this after every retry
+    other_host: retry on a host the task has not failed on yet, if any
+    """
+    def __init__(self, max_attempts=1, backoff=0.0, backoff_factor=2.0, other_host=False):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_factor = backoff_factor
+        self.other_host = other_host
+
+    def __repr__(self):
+        return f"RetryPolicy(max_attempts={self.max_attempts}, backoff={self.backoff}, other_host={self.other_host})"
+
+    def should_retry(self, attempts):
+        """attempts: runs done so far"""
+        return attempts < self.max_attempts
+
+    def delay(self, attempts):
+        """Seconds to wait before run attempts + 1"""
+        return self.backoff * self.backoff_factor ** max(attempts - 1, 0)
+
+NO_RETRY = RetryPolicy()
@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+"""Scheduler service sharing one cluster between concurrent pipelines
+
+A PrestoPipeline.py run on its own builds a HostManager and takes every
+slot of the hostfile for itself, so two observations at once oversubscribe
+the nodes. SchedulerDaemon holds the executor connections and runs one
+ParallelTaskExecutor for everybody; pipelines connect to its Unix socket
+through SchedulerClient, each connection being one job, and submit their
+task graphs. FairSharePriority hands the cores out by job priority, then
+by weight, and the executor keeps every core of the cluster busy.
+
+Protocol: one JSON object per line, in both directions.
+    client -> daemon
+    {"op": "open", "name", "weight", "priority", "policy"}    once, first
+        policy: a TaskPriority name, or {stage: name} for a staged one
+    {"op": "submit", "tasks": [task, ...]}
+        task: {"key", "name", "deps": [keys], "actions", "slots", "cost",
+               "resources": [cores, mem, io],
+               "retry": [max_attempts, backoff, backoff_factor, other_host],
+               "max_slots", "widen": a WIDEN name, "coalesce", "stage"}
+    {"op": "close"}     no more tasks, answered once every task settled
+    {"op": "status"}    may be sent without opening a job
+    daemon -> client
+    {"event": "opened", "job"}
+    {"event": "task", "key", "status": "finished" | "failed" | "cancelled",
+     "outputs" (finished) or "error" and "retcode"}
+    {"event": "closed", "finished", "failed", "cancelled"}
+    {"event": "status", "slots", "jobs": [...]}
+    {"event": "error", "message"}, after which the daemon hangs up
+Tasks of a job whose client went away still run, their results are dropped.
+
+Commands run in the working directory of the daemon (local executors) and
+of the executor servers, so start the daemon where the pipelines would
+have run. Journals and stage caches are per run and stay with the
+pipelines' own executors; the task history is the daemon's.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import stat
+import sys
+from HostManager import HostManager
+from ParallelTaskExecutor import ParallelTask, ParallelTaskExecutor, TaskFailed
+from TaskPriority import FairSharePriority, StagedPriority, get_policy
+from TaskHistory import TaskHistory, DEFAULT_HISTORY_FILE, set_ncpus
+from Resources import ResourceVector
+from RetryPolicy import RetryPolicy, NO_RETRY
+from Metrics import MetricsRegistry, MetricsServer, parse_metrics_port
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "presto_scheduler.sock"
+# longest message line, a whole graph or the stdout of a task
+MAX_MESSAGE = 256 * 1024 * 1024
+
+# widen functions of malleable tasks, by the name they go by on the wire
+WIDEN = {
+    'ncpus': set_ncpus
+}
+
+def parse_socket(args):
+    """Remove "--socket <path>" from args, returns the path or None"""
+    if '--socket' not in args:
+        return None
+    i = args.index('--socket')
+    if i + 1 >= len(args):
+        raise Exception("--socket needs the path of the scheduler's socket")
+    socket_path = args[i + 1]
+    del args[i:i + 2]
+    return socket_path
+
+def send_message(writer, message):
+    writer.write((json.dumps(message) + "\n").encode('utf-8'))
+
+class SchedulerJob:
+    def __init__(self, job_id, name, writer):
+        self.id = job_id
+        self.name = name
+        # None once the client went away
+        self.writer = writer
+        # key: the client's task key, value: task uuid
+        self.tasks = {}
+        self.unsettled = 0
+        # the client sent close, or went away
+        self.closing = False
+        self.counts = {'finished': 0, 'failed': 0, 'cancelled': 0}
+
+    def __repr__(self):
+        return f"Job #{self.id} ({self.name})"
+
+class SchedulerDaemon:
+    def __init__(self, host_manager, socket_path=DEFAULT_SOCKET, history=None, metrics=None, speculation=False):
+        """host_manager: HostManager of the whole cluster, not connected yet
+        history: TaskHistory shared by all jobs
+        metrics: a Metrics.MetricsRegistry, also given to the executor
+        """
+        self.host_manager = host_manager
+        self.socket_path = socket_path
+        self.server = None
+
+        self.jobs = {}
+        self.next_job_id = 1
+        # key: the executor's task name, value: (job id, stage)
+        self.task_info = {}
+        # uuids of settled tasks of finished jobs still running a losing copy
+        self.lingering_tasks = []
+
+        # tasks of a job already let go of have none
+        self.policy = FairSharePriority(lambda task: self.task_info.get(task.name, (None, None))[0])
+        self.executor = ParallelTaskExecutor(self.policy, history, metrics=metrics, speculation=speculation)
+
+        if metrics is not None:
+            metrics.gauge('scheduler_job_cores', "Cores in use by each job", ['job'], lambda: {
+                (str(job),): self.policy.jobs[job.id]['cores'] for job in self.jobs.values()
+            })
+            metrics.gauge('scheduler_job_tasks', "Tasks of each job not settled yet", ['job'], lambda: {
+                (str(job),): job.unsettled for job in self.jobs.values()
+            })
+
+    async def start(self):
+        """Connect the executors, start the runners and listen"""
+        await self.host_manager.connect_remote()
+        for executor in self.host_manager.all_executors():
+            self.executor.add_runner(
+                self.host_manager.get_dispatch_hint(executor),
+                executor,
+                self.host_manager.get_slot(executor)
+            )
+        self.executor.start_runners()
+
+        # left over by a daemon which didn't shut down cleanly
+        if os.path.exists(self.socket_path) and stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+            os.remove(self.socket_path)
+        self.server = await asyncio.start_unix_server(self.handle, self.socket_path, limit=MAX_MESSAGE)
+        logger.info(f"Scheduling for {self.host_manager.total_slots()} slots on {self.socket_path}")
+
+    async def shutdown(self):
+        """Stop listening, let the submitted tasks finish and disconnect"""
+        self.server.close()
+        await self.server.wait_closed()
+        os.remove(self.socket_path)
+        await self.executor.wait_until_finish()
+        await self.host_manager.close_remote()
+
+    async def handle(self, reader, writer):
+        job = None
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                request = json.loads(line)
+                op = request.get('op')
+                if op == 'status':
+                    send_message(writer, self.status())
+                elif op == 'open':
+                    if job is not None:
+                        raise Exception(f"{job} is open already")
+                    job = self.open_job(request, writer)
+                    send_message(writer, {'event': 'opened', 'job': job.id})
+                elif job is None:
+                    raise Exception(f"'{op}' before 'open'")
+                elif op == 'submit':
+                    if job.closing:
+                        raise Exception(f"'submit' after 'close'")
+                    self.submit_tasks(job, request['tasks'])
+                elif op == 'close':
+                    job.closing = True
+                    self.check_closed(job)
+                else:
+                    raise Exception(f"Unknown op '{op}'")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.warning(f"Bad request from {job if job is not None else 'a client'}: {type(e).__name__}: {e}")
+            send_message(writer, {'event': 'error', 'message': f"{type(e).__name__}: {e}"})
+        finally:
+            if job is not None:
+                job.writer = None
+                if not job.closing:
+                    logger.warning(f"{job} disconnected with {job.unsettled} tasks to go, they run on unattended")
+                    job.closing = True
+                self.check_closed(job)
+            writer.close()
+
+    def open_job(self, request, writer):
+        job = SchedulerJob(self.next_job_id, request.get('name', 'job'), writer)
+        self.next_job_id += 1
+
+        policy = request.get('policy')
+        if isinstance(policy, dict):
+            policy = StagedPriority(policy, lambda task: self.task_info[task.name][1])
+        self.policy.add_job(job.id, request.get('weight', 1.0), request.get('priority', 0), get_policy(policy))
+        self.jobs[job.id] = job
+        logger.info(f"Opened {job}: weight={request.get('weight', 1.0)}, priority={request.get('priority', 0)}")
+        return job
+
+    def submit_tasks(self, job, specs):
+        """Check the whole batch first: a bad spec registers none of it"""
+        keys = set()
+        names = set()
+        checked = []
+        for spec in specs:
+            key = spec['key']
+            if key in job.tasks or key in keys:
+                raise Exception(f"Task key {key} submitted twice")
+            # names are the executor's handle on a task's job
+            name = f"{job.id}/{spec['name']}"
+            if name in self.task_info or name in names:
+                raise Exception(f"Task name '{spec['name']}' submitted twice")
+            for dep in spec.get('deps', []):
+                if dep not in job.tasks and dep not in keys:
+                    raise Exception(f"Task key {key} depends on unknown key {dep}")
+            if not isinstance(spec.get('actions'), list) or len(spec['actions']) == 0:
+                raise Exception(f"Task key {key} has no actions")
+            if spec.get('widen') is not None and spec['widen'] not in WIDEN:
+                raise Exception(f"Task key {key} has unknown widen '{spec['widen']}'")
+            keys.add(key)
+            names.add(name)
+            checked.append((key, name, spec, (
+                ResourceVector(*spec['resources']) if spec.get('resources') is not None else None,
+                RetryPolicy(*spec['retry']) if spec.get('retry') is not None else None
+            )))
+
+        for key, name, spec, (resources, retry_policy) in checked:
+            self.task_info[name] = (job.id, spec.get('stage'))
+            future = self.executor.submit(
+                name,
+                [job.tasks[dep] for dep in spec.get('deps', [])],
+                spec['actions'],
+                spec.get('slots', 1),
+                spec.get('cost', 1.0),
+                resources,
+                retry_policy=retry_policy,
+                max_slots=spec.get('max_slots'),
+                widen=WIDEN[spec['widen']] if spec.get('widen') is not None else None,
+                coalesce=spec.get('coalesce', False),
+                timeout=spec.get('timeout'),
+                update=False
+            )
+            job.tasks[key] = self.executor.future_tasks[future]
+            job.unsettled += 1
+            future.add_done_callback(lambda future, key=key: self.task_settled(job, key, future))
+        self.executor.update_alloc()
+
+    def task_settled(self, job, key, future):
+        task = self.executor.get_task_by_uuid(job.tasks[key])
+        job.unsettled -= 1
+        if task.status == ParallelTask.FINISHED:
+            event = {'event': 'task', 'key': key, 'status': 'finished', 'outputs': future.result()}
+        else:
+            error = future.exception()
+            event = {
+                'event': 'task', 'key': key,
+                'status': 'failed' if task.status == ParallelTask.FAILED else 'cancelled',
+                'error': str(error), 'retcode': error.retcode
+            }
+        job.counts[event['status']] += 1
+        if job.writer is not None:
+            send_message(job.writer, event)
+        self.check_closed(job)
+
+    def check_closed(self, job):
+        """Answer close once every task of job settled, and let go of them"""
+        if not job.closing or job.unsettled > 0 or job.id not in self.jobs:
+            return
+        if job.writer is not None:
+            send_message(job.writer, dict({'event': 'closed'}, **job.counts))
+        logger.info(f"{job} done: {job.counts}")
+
+        del self.jobs[job.id]
+        self.policy.remove_job(job.id)
+        self.lingering_tasks = self.executor.forget_tasks(self.lingering_tasks + list(job.tasks.values()))
+        # a lingering copy still needs its job looked up when it ends
+        kept = set(self.executor.get_task_by_uuid(uuid).name for uuid in self.lingering_tasks)
+        self.task_info = {name: info for name, info in self.task_info.items() if info[0] in self.jobs or name in kept}
+
+    def status(self):
+        return {
+            'event': 'status',
+            'slots': self.host_manager.total_slots(),
+            'jobs': [{
+                'job': job.id,
+                'name': job.name,
+                'weight': self.policy.jobs[job.id]['weight'],
+                'priority': self.policy.jobs[job.id]['priority'],
+                'cores': self.policy.jobs[job.id]['cores'],
+                'unsettled': job.unsettled,
+                'counts': job.counts
+            } for job in self.jobs.values()]
+        }
+
+class SchedulerClient:
+    """A job of a SchedulerDaemon, standing in for both the
+    ParallelTaskExecutor (add_task, submit, update_alloc, start_runners,
+    wait_until_finish) and the base executor (execute) of a pipeline
+
+    Usage:
+    client = SchedulerClient(name='obs1', policy='upward_rank')
+    await client.connect()
+    a = client.add_task("a", [], ['echo A'], 1)
+    client.add_task("b", [a], ['echo B'], 1)
+    client.update_alloc()
+    await client.wait_until_finish()
+
+    weight: share of the cluster relative to other jobs of the same priority
+    priority: jobs of a higher priority are served first
+    policy: TaskPriority name or StagedPriority ordering the job's own tasks
+    retry_policy: RetryPolicy of tasks added without one, no retries by default
+    """
+    host = 'scheduler'
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, name='pipeline', weight=1.0, priority=0, policy=None,
+                 retry_policy=NO_RETRY):
+        self.socket_path = socket_path
+        self.name = name
+        self.weight = weight
+        self.priority = priority
+        self.policy = policy
+        self.retry_policy = retry_policy
+        self.job_id = None
+        self._reader = None
+        self._writer = None
+        self._event_task = None
+
+        self.next_key = 1
+        # key: task key, value: dict of name, on_complete and future
+        self.tasks = {}
+        # task specs not sent yet, see update_alloc()
+        self.unsent = []
+        self.unsettled = 0
+        self.drained = asyncio.Event()
+        self.closed = None
+        # key: task key, value: the task's name
+        self.finished_tasks = {}
+        self.failed_tasks = {}
+        self.cancelled_tasks = {}
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path, limit=MAX_MESSAGE)
+        policy = self.policy
+        if isinstance(policy, StagedPriority):
+            policy = {stage: stage_policy.name for stage, stage_policy in policy.policies.items()}
+        elif policy is not None and not isinstance(policy, str):
+            policy = policy.name
+        send_message(self._writer, {
+            'op': 'open', 'name': self.name, 'weight': self.weight, 'priority': self.priority, 'policy': policy
+        })
+        opened = json.loads(await self._reader.readline())
+        if opened['event'] != 'opened':
+            raise Exception(f"Scheduler refused the job: {opened.get('message')}")
+        self.job_id = opened['job']
+        self.closed = asyncio.get_running_loop().create_future()
+        self._event_task = asyncio.create_task(self._event_handler())
+        logger.info(f"Connected to the scheduler at {self.socket_path} as job #{self.job_id}")
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._event_task
+
+    def add_task(self, name, deps, actions, slots_required, cost=1.0, resources=None, on_complete=None,
+                 retry_policy=None, input_files=None, output_files=None, max_slots=None, widen=None,
+                 coalesce=False, timeout=None):
+        """As ParallelTaskExecutor.add_task(); sent by the next update_alloc()
+        input_files and output_files are not used by the daemon
+        returns the task key
+        """
+        key = self.next_key
+        self.next_key += 1
+
+        spec = {
+            'key': key,
+            'name': name,
+            'deps': [self.future_key(dep) for dep in deps],
+            'actions': actions,
+            'slots': slots_required,
+            'cost': cost,
+            'max_slots': max_slots,
+            'coalesce': coalesce,
+            'timeout': timeout
+        }
+        if resources is not None:
+            spec['resources'] = [resources.cores, resources.mem, resources.io]
+        if retry_policy is None:
+            retry_policy = self.retry_policy
+        if retry_policy is not NO_RETRY:
+            spec['retry'] = [retry_policy.max_attempts, retry_policy.backoff, retry_policy.backoff_factor,
+                             retry_policy.other_host]
+        if widen is not None:
+            spec['widen'] = next((widen_name for widen_name, function in WIDEN.items() if function is widen), None)
+            if spec['widen'] is None:
+                raise Exception(f"{widen} is not one of the scheduler's widen functions {list(WIDEN.keys())}")
+        if isinstance(self.policy, StagedPriority):
+            # the stage function sees the task as the executor would
+            spec['stage'] = self.policy.stage_of(
+                ParallelTask(key, name, deps, actions, slots_required, cost, resources))
+
+        self.tasks[key] = {'name': name, 'on_complete': on_complete, 'future': None}
+        self.unsent.append(spec)
+        self.unsettled += 1
+        self.drained.clear()
+        return key
+
+    def future_key(self, dep):
+        if isinstance(dep, asyncio.Future):
+            return next(key for key, task in self.tasks.items() if task['future'] is dep)
+        return dep
+
+    def submit(self, name, deps, actions, slots_required, cost=1.0, resources=None, on_complete=None,
+               retry_policy=None, input_files=None, output_files=None, max_slots=None, widen=None,
+               coalesce=False, timeout=None):
+        """As ParallelTaskExecutor.submit(), from the client's loop only
+        returns an asyncio.Future of the task's outputs
+        """
+        key = self.add_task(name, deps, actions, slots_required, cost, resources, on_complete, retry_policy,
+                            input_files, output_files, max_slots, widen, coalesce, timeout)
+        future = asyncio.get_running_loop().create_future()
+        if self.closed.done():
+            # the job is closed, the daemon won't take it
+            future.set_exception(TaskFailed(f"Job #{self.job_id} is closed"))
+            return future
+        self.tasks[key]['future'] = future
+        self.update_alloc()
+        return future
+
+    def update_alloc(self):
+        """Send the tasks added since"""
+        if len(self.unsent) > 0:
+            send_message(self._writer, {'op': 'submit', 'tasks': self.unsent})
+            self.unsent = []
+
+    def start_runners(self):
+        # the daemon's runners are running already
+        pass
+
+    async def execute(self, cmd, cores=None, timeout=None):
+        """Run cmd as a one-off task of the job, like an executor would
+        returns (retcode, stdout)
+        """
+        try:
+            outputs = await self.submit(f"execute_{self.next_key}", [], [cmd], 1, timeout=timeout)
+        except TaskFailed as e:
+            return (e.retcode if e.retcode is not None else -1, "")
+        return (0, outputs[0])
+
+    async def wait_until_finish(self):
+        """Wait until every task settled, the ones added by on_complete
+        callbacks included, then close the job
+        """
+        self.update_alloc()
+        while self.unsettled > 0:
+            await self.drained.wait()
+        send_message(self._writer, {'op': 'close'})
+        counts = await self.closed
+        logger.info(f"Job #{self.job_id} done: {counts}")
+
+    async def _event_handler(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if len(line) == 0:
+                    break
+                event = json.loads(line)
+                if event['event'] == 'task':
+                    self.task_settled(event)
+                elif event['event'] == 'closed':
+                    del event['event']
+                    self.closed.set_result(event)
+                elif event['event'] == 'error':
+                    raise Exception(f"Scheduler error: {event['message']}")
+        except Exception as e:
+            logger.error(f"Lost the scheduler: {e}")
+            if not self.closed.done():
+                self.closed.set_exception(e)
+        else:
+            if not self.closed.done():
+                self.closed.set_exception(Exception("The scheduler closed the connection"))
+        finally:
+            # nobody waits for tasks which won't settle any more
+            for task in self.tasks.values():
+                if task['future'] is not None and not task['future'].done():
+                    task['future'].set_exception(TaskFailed("Lost the scheduler"))
+            self.unsettled = 0
+            self.drained.set()
+
+    def task_settled(self, event):
+        key = event['key']
+        task = self.tasks[key]
+        self.unsettled -= 1
+        if event['status'] == 'finished':
+            self.finished_tasks[key] = task['name']
+            if task['on_complete'] is not None:
+                task['on_complete'](key, event['outputs'])
+                # tasks it added
+                self.update_alloc()
+            if task['future'] is not None:
+                task['future'].set_result(event['outputs'])
+        else:
+            if event['status'] == 'failed':
+                self.failed_tasks[key] = task['name']
+                logger.error(f"Task {task['name']} failed: {event['error']}")
+            else:
+                self.cancelled_tasks[key] = task['name']
+            if task['future'] is not None:
+                task['future'].set_exception(TaskFailed(event['error'], event['retcode']))
+        if self.unsettled == 0:
+            self.drained.set()
+
+async def serve(hostfile, socket_path, metrics_port=None, history_file=DEFAULT_HISTORY_FILE):
+    metrics = None
+    metrics_server = None
+    if metrics_port is not None:
+        metrics = MetricsRegistry()
+        metrics_server = MetricsServer(metrics, port=metrics_port)
+        await metrics_server.start()
+
+    daemon = SchedulerDaemon(
+        HostManager.from_hostfile(hostfile, metrics=metrics), socket_path, TaskHistory(history_file), metrics
+    )
+    await daemon.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    logger.info("Shutting down once the submitted tasks finished")
+    await daemon.shutdown()
+    if metrics_server is not None:
+        await metrics_server.close()
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    socket_path = parse_socket(args) or DEFAULT_SOCKET
+    metrics_port = parse_metrics_port(args)
+    if len(args) != 1:
+        print("Usage: SchedulerDaemon.py [--socket path] [--metrics-port port] hostfile")
+        sys.exit(1)
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.INFO
+    )
+    asyncio.run(serve(args[0], socket_path, metrics_port))
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""Discrete-event simulation of ParallelTaskExecutor on a virtual clock
+
+SimulatedExecutor has the interface of LocalExecutor / ExecutorClient,
+but a command only sleeps for its modelled duration. The event loop's
+clock is virtual: whenever nothing is ready to run it jumps straight to
+the next timer, so a pipeline taking hours replays in seconds, with the
+real scheduler code (priorities, locality, stealing, speculation).
+
+Usage: Simulator.py [--history file] [--speed host=factor ...] [--speculation] [--rigid] [--trace dir] [hostfile ...]
+Simulates the PrestoPipeline, PrestoPipelineDMMaximize and
+PrestoAccelsearchContest graphs on every hostfile (configurations/* by
+default) with every priority policy, and prints makespan, utilization and
+tail length of each combination.
+With --rigid, accelsearch always runs single-threaded instead of taking
+idle cores at the tail. With --trace, a Chrome trace of each simulation
+is written into dir.
+"""
+
+import asyncio, selectors, random, logging, json
+import sys, os, glob
+from ParallelTaskExecutor import ParallelTaskExecutor
+from HostManager import HostManager
+from TaskPriority import POLICIES
+from TaskHistory import TaskHistory, CostModel, parse_command, set_ncpus
+from Resources import ResourceVector
+from TaskTrace import write_chrome_trace
+from ProcessGroup import TIMEOUT_STATUS
+
+logger = logging.getLogger(__name__)
+
+# seconds per command when the history doesn't know the tool;
+# prepsubband is per DM it writes
+DEFAULT_DURATIONS = {
+    'prepsubband': 4.0,
+    'realfft': 5.0,
+    'accelsearch': 30.0,
+    'prepfold': 40.0
+}
+DEFAULT_DURATION = 1.0
+# Amdahl serial fraction of multi-threaded (-ncpus) runs
+SERIAL_FRACTION = 0.15
+MAX_THREADS = 8
+
+class VirtualClockSelector:
+    """Selector which, instead of blocking for timeout, advances the clock"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise Exception("Simulation stuck: no timer pending and nothing ready to run")
+        self.loop.virtual_time += timeout
+        return self.selector.select(0)
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self.virtual_time = 0.0
+        super().__init__(VirtualClockSelector(self))
+
+    def time(self):
+        return self.virtual_time
+
+class DurationModel:
+    """Seconds a command takes: predicted from a TaskHistory where it knows
+    the tool, DEFAULT_DURATIONS otherwise, times lognormal noise
+
+    The noise is drawn per command and seed, so whatever order a policy
+    runs them in, the same commands take the same time.
+    """
+    def __init__(self, history=None, jitter=0.2, seed=0):
+        self.cost_model = CostModel(history) if history is not None else None
+        self.jitter = jitter
+        self.seed = seed
+
+    def expected(self, cmd):
+        if self.cost_model is not None:
+            estimate = self.cost_model.predict_command(cmd)
+            if estimate is not None:
+                return estimate
+
+        parsed = parse_command(cmd)
+        if parsed is None:
+            return DEFAULT_DURATION
+        tool, params, _ = parsed
+        if tool == 'prepsubband':
+            return DEFAULT_DURATIONS[tool] * int(params.get('numdms', 1))
+        ncpus = int(params.get('ncpus', 1))
+        return DEFAULT_DURATIONS[tool] * (SERIAL_FRACTION + (1 - SERIAL_FRACTION) / ncpus)
+
+    def __call__(self, cmd):
+        return self.expected(cmd) * random.Random(f"{self.seed}:{cmd}").lognormvariate(0.0, self.jitter)
+
+class SimulatedExecutor:
+    """Runs nothing, every command takes duration_model(cmd) / speed
+    virtual seconds and succeeds; outputs(cmd) gives its stdout
+    """
+    def __init__(self, host, duration_model, speed=1.0, outputs=None):
+        self.host = host
+        self.duration_model = duration_model
+        self.speed = speed
+        self.outputs = outputs
+
+    async def execute(self, cmd, cores=None, timeout=None):
+        duration = self.duration_model(cmd) / self.speed
+        if timeout is not None and duration > timeout:
+            await asyncio.sleep(timeout)
+            return TIMEOUT_STATUS, ""
+        await asyncio.sleep(duration)
+        return 0, self.outputs(cmd) if self.outputs is not None else ""
+
+    async def execute_no_output(self, cmd, cores=None):
+        retcode, _ = await self.execute(cmd, cores)
+        return retcode
+
+def sifting_output(ncands):
+    """Stdout of PrestoSifting.py finding ncands candidates"""
+    def outputs(cmd):
+        if 'PrestoSifting.py' not in cmd:
+            return ""
+        cands = [{'DM': 10.0 + i, 'DMstr': f"{10.0 + i:.2f}", 'p': 0.001 * (i + 1)} for i in range(0, ncands)]
+        return "JSON_BEGIN" + json.dumps(cands) + "JSON_END"
+    return outputs
+
+def accel_threads(malleable):
+    """add_task() arguments of accelsearch tasks"""
+    if not malleable:
+        return {}
+    return {'max_slots': MAX_THREADS, 'widen': set_ncpus}
+
+def presto_graph(task_executor, model, ndms=96, calls=4, ncands=20, zmax=0, malleable=True):
+    """The graph of PrestoPipeline: one prepsubband per `calls` batch of
+    DMs, realfft and accelsearch per DM, sifting, then a prepfold per
+    candidate once sifting found them
+    """
+    dms_per_call = ndms // calls
+    accel_tasks = []
+    for i in range(0, calls):
+        prepcmd = f"cd sim && prepsubband -nsub 32 -numdms {dms_per_call} -numout 1000000 -downsamp 1 -o Sband ../sim.fil"
+        prep_task = task_executor.add_task(f"prep_batch_{i}", [], [prepcmd], 1, model.expected(prepcmd))
+        for j in range(0, dms_per_call):
+            dm = (i * dms_per_call + j) * 0.5
+            fftcmd = f"cd sim && realfft Sband_DM{dm:.2f}.dat"
+            fft_task = task_executor.add_task(f"realfft_dm{dm}", [prep_task], [fftcmd], 1, model.expected(fftcmd))
+            accelcmd = f"cd sim && accelsearch -zmax {zmax} Sband_DM{dm:.2f}.fft"
+            accel_tasks.append(
+                task_executor.add_task(f"accelsearch_dm{dm}", [fft_task], [accelcmd], 1, model.expected(accelcmd),
+                                       **accel_threads(malleable))
+            )
+
+    def add_fold_tasks(sift_task, outputs):
+        for i in range(0, ncands):
+            foldcmd = f"cd sim && prepfold -n 64 -nsub 32 -dm {10.0 + i} ../sim.fil -noxwin -nodmsearch"
+            task_executor.add_task(f"cand_{i}", [sift_task], [foldcmd], 1, model.expected(foldcmd))
+
+    siftcmd = f"cd sim && python3 PrestoSifting.py {zmax}"
+    task_executor.add_task("sifting", accel_tasks, [siftcmd], 1, model.expected(siftcmd), on_complete=add_fold_tasks)
+
+def dmmaximize_graph(task_executor, model, ndms=96, ncands=20, zmax=0, malleable=True):
+    """The graph of PrestoPipelineDMMaximize: one prepsubband per DM"""
+    presto_graph(task_executor, model, ndms, ndms, ncands, zmax, malleable)
+
+def accelsearch_graph(task_executor, model, nffts=70, malleable=True):
+    """The graph of PrestoAccelsearchContest: independent searches"""
+    for i in range(0, nffts):
+        accelcmd = f"cd sim && accelsearch -zmax 200 -wmax 100 Sband_DM{i * 0.5:.2f}.fft"
+        task_executor.add_task(f"accel_{i}", [], [accelcmd], 1, model.expected(accelcmd), **accel_threads(malleable))
+
+GRAPHS = {
+    'PrestoPipeline': presto_graph,
+    'PrestoPipelineDMMaximize': dmmaximize_graph,
+    'PrestoAccelsearchContest': accelsearch_graph
+}
+
+def cluster_from_hostfile(filename, speeds=None):
+    """[(host, slots, speed, capacity)] of a hostfile
+    speeds: key: host, value: speed factor, 1.0 if not given
+    """
+    speeds = speeds or {}
+    cluster = []
+    for entry in HostManager.parse_hostfile(filename):
+        capacity = ResourceVector.capacity(entry['slots'], entry['capacity'].get('mem'), entry['capacity'].get('io'))
+        cluster.append((entry['host'], entry['slots'], speeds.get(entry['host'], 1.0), capacity))
+    return cluster
+
+async def run_simulation(graph, cluster, policy, model, speculation=False, trace_file=None, malleable=True):
+    # the model's durations are seconds
+    task_executor = ParallelTaskExecutor(policy, speculation=speculation, cost_in_seconds=True)
+    for host, slots, speed, capacity in cluster:
+        task_executor.add_runner(
+            {"affinity_priority": list(range(0, slots)), "bind_core": False, "capacity": capacity},
+            SimulatedExecutor(host, model, speed, sifting_output(20)),
+            slots
+        )
+    graph(task_executor, model, malleable=malleable)
+
+    task_executor.update_alloc()
+    task_executor.start_runners()
+    await task_executor.wait_until_finish()
+
+    if trace_file is not None:
+        write_chrome_trace(task_executor, trace_file)
+    return report(task_executor)
+
+def report(task_executor):
+    """makespan: from start_runners() to the last completion
+    utilization: busy core-seconds over available core-seconds
+    tail: from the last task start to the end, when the cluster drains
+    """
+    start = task_executor.start_time
+    ran = [task for task in task_executor.finished_tasks.values() if task.finish_time is not None]
+    end_time = max((task.finish_time for task in ran), default=start)
+    makespan = end_time - start
+    busy = sum(task.slots_required * (task.finish_time - task.start_time) for task in ran)
+    total_slots = sum(runner.num_slots for runner in task_executor.registered_runners.values())
+    last_start = max((task.start_time for task in ran), default=start)
+    return {
+        'tasks': len(ran),
+        'makespan': makespan,
+        'utilization': busy / (total_slots * makespan) if makespan > 0 else 0.0,
+        'tail': end_time - last_start
+    }
+
+def simulate(graph, cluster, policy, model, speculation=False, trace_file=None, malleable=True):
+    """Replay graph on cluster under policy, on a fresh virtual clock"""
+    loop = VirtualClockLoop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(run_simulation(graph, cluster, policy, model, speculation, trace_file, malleable))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+def main():
+    args = sys.argv[1:]
+    history = None
+    speeds = {}
+    speculation = False
+    malleable = True
+    trace_dir = None
+    hostfiles = []
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--history':
+            history = TaskHistory(args.pop(0))
+        elif arg == '--speed':
+            host, factor = args.pop(0).split('=')
+            speeds[host] = float(factor)
+        elif arg == '--speculation':
+            speculation = True
+        elif arg == '--rigid':
+            malleable = False
+        elif arg == '--trace':
+            trace_dir = args.pop(0)
+            os.makedirs(trace_dir, exist_ok=True)
+        else:
+            hostfiles.append(arg)
+    if len(hostfiles) == 0:
+        hostfiles = sorted(glob.glob("./configurations/*"))
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.WARNING
+    )
+
+    print(f"{'cluster':<20} {'graph':<26} {'policy':<14} {'tasks':>6} {'makespan':>10} {'util':>7} {'tail':>9}")
+    for hostfile in hostfiles:
+        cluster = cluster_from_hostfile(hostfile, speeds)
+        for graph_name, graph in GRAPHS.items():
+            for policy in POLICIES.keys():
+                trace_file = None
+                if trace_dir is not None:
+                    trace_file = os.path.join(trace_dir, f"{os.path.basename(hostfile)}_{graph_name}_{policy}.json")
+                result = simulate(graph, cluster, policy, DurationModel(history), speculation, trace_file, malleable)
+                print(f"{os.path.basename(hostfile):<20} {graph_name:<26} {policy:<14} {result['tasks']:>6} "
+                      f"{result['makespan']:>9.1f}s {result['utilization'] * 100:>6.1f}% {result['tail']:>8.1f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""Content-addressed cache of task outputs, shared between runs
+
+A task's key hashes its commands (with the run's workdir masked out),
+the keys of its deps (and of the tasks which produced its other inputs)
+and the contents of the input files no task produced. So
+re-running a filterbank with e.g. only accelsearch options changed finds
+prepsubband and realfft under the same keys and reuses their .dat, .inf
+and .fft files, only the changed suffix of the graph runs.
+
+Layout: cache_dir/<key>/meta.json plus the output files, by their path
+relative to the workdir. Files are hard-linked in and out of the cache,
+copied only where a link isn't possible (another filesystem).
+
+The cache is opt-in (--cache <dir>) and bounded: evict() drops the least
+recently used entries beyond max_bytes, counting linked files at their
+full size. Hashing a multi-GB filterbank takes a while, so prime() hashes
+a run's external inputs in a thread before its tasks are added.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+from Resources import parse_size
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = "stage_cache"
+DEFAULT_CACHE_SIZE = 100 * 1024 ** 3
+DIGESTS_FILE = "digests.json"
+
+def parse_cache(args):
+    """Remove "--cache <dir>" and "--cache-size <size>" from args
+    returns (the cache dir or None, its size in bytes)
+    """
+    options = {'--cache': None, '--cache-size': None}
+    for option in options.keys():
+        if option not in args:
+            continue
+        i = args.index(option)
+        if i + 1 >= len(args):
+            raise Exception(f"{option} needs a value")
+        options[option] = args[i + 1]
+        del args[i:i + 2]
+    cache_size = options['--cache-size']
+    return options['--cache'], parse_size(cache_size) if cache_size is not None else DEFAULT_CACHE_SIZE
+
+def link_or_copy(src, dst):
+    os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+class StageCache:
+    def __init__(self, cache_dir, workdir, max_bytes=None):
+        """workdir: the run's working directory, masked out of commands
+        max_bytes: size evict() shrinks the cache to, None for no bound
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workdir = os.path.join(workdir, "")
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # hashing a filterbank takes a while, so digests are kept per
+        # (path, size, mtime); key: realpath, value: [size, mtime_ns, digest]
+        # Only those of files outside the workdir are saved, the workdir's
+        # are a run's intermediates, their producers' keys cover them.
+        self.real_workdir = os.path.join(os.path.realpath(workdir), "")
+        self.digests_file = os.path.join(cache_dir, DIGESTS_FILE)
+        self.digests = {}
+        if os.path.exists(self.digests_file):
+            with open(self.digests_file, "r") as f:
+                self.digests = json.load(f)
+
+        self.hits = 0
+        self.stores = 0
+        self.evicted = 0
+
+    async def prime(self, paths):
+        """Hash paths in a thread, so key() later finds their digests
+        instead of hashing them on the event loop; missing ones are skipped
+        """
+        for path in paths:
+            try:
+                await asyncio.to_thread(self.file_digest, path)
+            except OSError:
+                continue
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        into max_bytes; restore() counts as a use
+        """
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            meta_file = os.path.join(entry_dir, "meta.json")
+            if not os.path.exists(meta_file):
+                continue
+            size = 0
+            for root, _, files in os.walk(entry_dir):
+                size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+            entries.append((os.stat(meta_file).st_mtime, size, entry_dir))
+            total += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            self.evicted += 1
+        if self.evicted > 0:
+            logger.info(f"Stage cache: evicted {self.evicted} entries, {total} bytes left")
+
+        # digests of files since removed or changed
+        stale = []
+        for path, (size, mtime_ns, _) in self.digests.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if st.st_size != size or st.st_mtime_ns != mtime_ns:
+                stale.append(path)
+        for path in stale:
+            del self.digests[path]
+        if len(stale) > 0:
+            self.save_digests()
+
+    def save_digests(self):
+        # runs sharing the cache each write their own temp file
+        tmp_file = f"{self.digests_file}.tmp{os.getpid()}"
+        with open(tmp_file, "w") as f:
+            json.dump(self.digests, f)
+        os.replace(tmp_file, self.digests_file)
+
+    def file_digest(self, path):
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        known = self.digests.get(path)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+
+        if path.startswith(self.real_workdir):
+            return digest
+        self.digests[path] = [st.st_size, st.st_mtime_ns, digest]
+        self.save_digests()
+        return digest
+
+    def key(self, actions, dep_keys, input_files):
+        """dep_keys: cache keys of the task's deps and of the tasks producing its inputs
+        input_files: inputs no task produced, hashed by content
+        returns None if an input is missing
+        """
+        h = hashlib.sha256()
+        for action in actions:
+            action = action.decode('utf-8') if isinstance(action, bytes) else action
+            h.update(action.replace(self.workdir.rstrip("/"), "<workdir>").encode('utf-8'))
+            h.update(b'\0')
+        for dep_key in sorted(dep_keys):
+            h.update(dep_key.encode('utf-8'))
+            h.update(b'\0')
+        for path in sorted(input_files):
+            try:
+                h.update(self.file_digest(path).encode('utf-8'))
+            except OSError:
+                return None
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def relative(self, path):
+        rel = os.path.relpath(path, self.workdir)
+        if rel.startswith(".."):
+            raise Exception(f"Cached output {path} is outside of {self.workdir}")
+        return rel
+
+    def restore(self, key, output_files):
+        """Link the cached outputs of key into the workdir
+        returns the task's stdout outputs, or None on a miss
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta_file = os.path.join(entry_dir, "meta.json")
+        if not os.path.exists(meta_file):
+            return None
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+
+        rel_files = [self.relative(path) for path in output_files]
+        if sorted(rel_files) != sorted(meta['files']):
+            return None
+        for rel in rel_files:
+            link_or_copy(os.path.join(entry_dir, rel), os.path.join(self.workdir, rel))
+        # recently used, evicted last
+        os.utime(meta_file)
+
+        self.hits += 1
+        return meta['outputs']
+
+    def detach(self, output_files):
+        """Unlink outputs that are hard links into the cache, before the
+        task writes them again and would overwrite the cached copy in place
+        """
+        for path in output_files:
+            try:
+                if os.stat(path).st_nlink > 1:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def store(self, key, output_files, outputs):
+        """Add a task's outputs under key, unless some output is missing"""
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+
+        rel_files = [self.relative(path) for path in output_files]
+        missing = [path for path in output_files if not os.path.exists(path)]
+        if len(missing) > 0:
+            logger.warning(f"Not caching {key[:12]}, outputs missing: {missing}")
+            return
+
+        # complete entries only: build aside, then rename into place
+        tmp_dir = f"{entry_dir}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for rel in rel_files:
+            link_or_copy(os.path.join(self.workdir, rel), os.path.join(tmp_dir, rel))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump({'files': rel_files, 'outputs': outputs}, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # stored meanwhile by another run
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.stores += 1
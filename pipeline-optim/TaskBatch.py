@@ -0,0 +1,38 @@
+"""Several short commands run as one shell command
+
+Each command of a batch costs a shell spawn and, on a remote host, a
+request / response round trip. batch_command() joins them into one POSIX
+sh script which starts them all in the background, waits for each and
+prints every command's stdout behind a marker line carrying its return
+code; parse_batch_output() splits that again.
+"""
+
+import shlex
+import uuid
+
+def batch_command(cmds):
+    """returns (script, marker) running cmds concurrently"""
+    marker = f"@@batch-{uuid.uuid4().hex}@@"
+    lines = ['d=$(mktemp -d) || exit 1']
+    for i, cmd in enumerate(cmds):
+        cmd = cmd.decode('utf-8') if isinstance(cmd, bytes) else cmd
+        lines.append(f'( {cmd}\n) > "$d/{i}" & p{i}=$!')
+    for i in range(0, len(cmds)):
+        lines.append(f'wait $p{i}; r{i}=$?')
+    for i in range(0, len(cmds)):
+        # the newline after the output keeps the next marker on its own line
+        lines.append(f'printf "%s {i} %d\\n" {shlex.quote(marker)} $r{i}; cat "$d/{i}"; echo')
+    lines.append('rm -rf "$d"')
+    return "\n".join(lines), marker
+
+def parse_batch_output(stdout, marker, count):
+    """returns [(retcode, stdout)] per command, None for the commands the
+    batch never reported (e.g. mktemp failed)
+    """
+    results = [None] * count
+    for section in stdout.split(marker + " ")[1:]:
+        header, _, output = section.partition("\n")
+        index, retcode = header.split(" ")
+        # drop the newline added after the output
+        results[int(index)] = (int(retcode), output[:-1])
+    return results
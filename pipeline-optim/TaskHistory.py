@@ -0,0 +1,208 @@
+"""Task duration history and the cost model built on top of it
+
+Every command run by a ParallelRunner is appended to a JSON-lines file
+together with its wall/CPU time, so that later runs can estimate how long
+prepsubband, realfft, accelsearch and prepfold will take before they start.
+"""
+
+import os, re, json, time, shlex
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_FILE = "task_history.jsonl"
+
+# tools worth modelling, and the options which change their run time
+KNOWN_TOOLS = ['prepsubband', 'realfft', 'accelsearch', 'prepfold']
+KEY_PARAMS = ['-zmax', '-wmax', '-numdms', '-numout', '-downsamp', '-nsub', '-n', '-ncpus']
+
+def parse_command(cmd):
+    """Find the PRESTO tool invoked by a shell command
+    e.g. "cd ./workdir/ && accelsearch -zmax 0 Sband_DM1.00.fft >> log"
+
+    returns (tool, params, input_path) or None if no known tool is found;
+    input_path is resolved against a leading "cd <dir>" if there is one.
+    """
+    cwd = None
+    for segment in cmd.split('&&'):
+        try:
+            tokens = shlex.split(segment)
+        except ValueError:
+            continue
+        if len(tokens) == 0:
+            continue
+
+        tool = os.path.basename(tokens[0])
+        if tool == 'cd' and len(tokens) > 1:
+            cwd = tokens[1]
+            continue
+        if tool not in KNOWN_TOOLS:
+            continue
+
+        params = {}
+        input_path = None
+        idx = 1
+        while idx < len(tokens):
+            token = tokens[idx]
+            if token.startswith('>') or token in ['|', ';', '2>&1']:
+                break
+            if token in KEY_PARAMS and idx + 1 < len(tokens):
+                params[token.lstrip('-')] = tokens[idx + 1]
+                idx += 2
+                continue
+            if not token.startswith('-'):
+                # the input file is the last positional argument
+                input_path = token
+            idx += 1
+
+        if input_path is not None and cwd is not None:
+            input_path = os.path.join(cwd, input_path)
+        return tool, params, input_path
+
+    return None
+
+def set_ncpus(cmd, ncpus):
+    """cmd with its accelsearch run on ncpus threads (-ncpus), e.g. as
+    the widen function of a malleable task
+    """
+    if re.search(r'-ncpus\s+\d+', cmd):
+        return re.sub(r'-ncpus\s+\d+', f'-ncpus {ncpus}', cmd, count=1)
+    # the command word, not e.g. accelsearch.log
+    return re.sub(r'(^|\s)accelsearch(\s)', rf'\1accelsearch -ncpus {ncpus}\2', cmd, count=1)
+
+def task_tool(actions):
+    """The first known tool run by actions, 'other' if there is none"""
+    for action in actions:
+        parsed = parse_command(action.decode('utf-8') if isinstance(action, bytes) else action)
+        if parsed is not None:
+            return parsed[0]
+    return 'other'
+
+def input_size(input_path):
+    """Size of input_path in bytes, None if it doesn't exist (yet)"""
+    if input_path is None:
+        return None
+    try:
+        return os.path.getsize(input_path)
+    except OSError:
+        return None
+
+def history_key(tool, params):
+    return tool + " " + " ".join(f"-{k} {params[k]}" for k in sorted(params.keys()))
+
+class TaskHistory:
+    """Append-only store of per-command run times"""
+    def __init__(self, filename=DEFAULT_HISTORY_FILE):
+        self.filename = filename
+        # key: history_key(); value: List[record]
+        self.records = {}
+
+        if os.path.exists(filename):
+            with open(filename, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+                    try:
+                        self._index(json.loads(line))
+                    except ValueError:
+                        logger.warning(f"Skipped corrupted history line: {line}")
+
+        logger.info(f"Loaded {sum(map(len, self.records.values()))} history records from {filename}")
+
+    def _index(self, record):
+        key = history_key(record['tool'], record['params'])
+        self.records.setdefault(key, []).append(record)
+
+    def record(self, cmd, wall_time, cpu_time=None, host=None, usage=None):
+        """Add one command's run time; commands of unknown tools are ignored
+        usage: ProcessUsage figures (max RSS, I/O bytes, ...) if measured
+        """
+        parsed = parse_command(cmd)
+        if parsed is None:
+            return None
+        tool, params, input_path = parsed
+
+        record = {
+            'tool': tool,
+            'params': params,
+            'input_size': input_size(input_path),
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'host': host,
+            'usage': usage,
+            'timestamp': time.time()
+        }
+        self._index(record)
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+        return record
+
+    def lookup(self, tool, params=None):
+        """Records of tool, restricted to exactly these params if given"""
+        if params is not None:
+            return self.records.get(history_key(tool, params), [])
+        return [r for key, records in self.records.items()
+                    if key.split(' ')[0] == tool for r in records]
+
+class CostModel:
+    """Predict command durations (in seconds) from a TaskHistory
+
+    Looks for the most specific history available:
+    1. same tool & params: mean seconds per input byte, or mean seconds
+       if the input size is unknown
+    2. same tool, any params: the same, over all runs of the tool
+    3. nothing known: None, callers fall back to their own estimate
+    """
+    def __init__(self, history):
+        self.history = history
+
+    @staticmethod
+    def _estimate(records, size):
+        if len(records) == 0:
+            return None
+
+        sized = [r for r in records if r['input_size']]
+        if size is not None and len(sized) > 0:
+            rate = sum(r['wall_time'] / r['input_size'] for r in sized) / len(sized)
+            return rate * size
+        return sum(r['wall_time'] for r in records) / len(records)
+
+    def predict_command(self, cmd):
+        parsed = parse_command(cmd)
+        if parsed is None:
+            return None
+        tool, params, input_path = parsed
+        size = input_size(input_path)
+
+        estimate = self._estimate(self.history.lookup(tool, params), size)
+        if estimate is None:
+            estimate = self._estimate(self.history.lookup(tool), size)
+        return estimate
+
+    def unit_seconds(self, relative_costs):
+        """Seconds per unit of relative_costs (tool -> rough relative run
+        time of one of its commands), from the mean run times of the tools
+        the history has seen; None if it has seen none of them
+        """
+        ratios = []
+        for tool, cost in relative_costs.items():
+            records = self.history.lookup(tool)
+            if len(records) > 0:
+                ratios.append(sum(r['wall_time'] for r in records) / len(records) / cost)
+        if len(ratios) == 0:
+            return None
+        return sum(ratios) / len(ratios)
+
+    def predict(self, actions, default=None):
+        """Predicted duration of a task running actions in sequence
+        returns default if any of the actions can't be predicted
+        """
+        total = 0.0
+        for action in actions:
+            estimate = self.predict_command(action)
+            if estimate is None:
+                return default
+            total += estimate
+        return total
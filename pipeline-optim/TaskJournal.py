@@ -0,0 +1,103 @@
+"""Append-only journal of completed tasks, to resume an interrupted run
+
+Each line is a JSON object:
+    {"name": ..., "fingerprint": ..., "outputs": [stdout, ...],
+     "files": {output path: [size, mtime_ns], ...}, "time": ...}
+
+The fingerprint covers a task's commands and the size and mtime of its
+input files, so a task whose inputs were rewritten since is not skipped.
+Hashing the contents would mean reading every .dat again on resume.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = "journal.jsonl"
+
+def file_state(path):
+    """[size, mtime_ns] of path, None if it doesn't exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+def fingerprint(actions, input_files):
+    h = hashlib.sha256()
+    for action in actions:
+        h.update(action.encode('utf-8') if isinstance(action, str) else action)
+        h.update(b'\0')
+    for path in sorted(input_files):
+        h.update(f"{path}={file_state(path)}".encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+def parse_resume(args):
+    """Remove "--resume <workdir>" from args, returns the workdir or None"""
+    if '--resume' not in args:
+        return None
+    i = args.index('--resume')
+    if i + 1 >= len(args):
+        raise Exception("--resume needs the working directory of the run to continue")
+    resume_workdir = args[i + 1]
+    del args[i:i + 2]
+    return resume_workdir
+
+class TaskJournal:
+    def __init__(self, filename):
+        self.filename = filename
+        # key: task name, value: its last journal entry
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # torn last line of a run that died mid-write
+                    logger.warning(f"Skipped a broken journal line in {self.filename}")
+                    continue
+                self.entries[entry['name']] = entry
+        logger.info(f"Loaded {len(self.entries)} completed tasks from {self.filename}")
+
+    def record(self, name, actions, input_files, output_files, outputs):
+        """Append the completion of a task, flushed to disk right away"""
+        entry = {
+            'name': name,
+            'fingerprint': fingerprint(actions, input_files),
+            'outputs': outputs,
+            'files': {path: file_state(path) for path in output_files},
+            'time': time.time()
+        }
+        self.entries[name] = entry
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def lookup(self, name, actions, input_files, output_files):
+        """The entry of a completed task which may be skipped, or None
+        if the task must run: never completed, a different command or
+        changed inputs, or an output file missing or changed since
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        if entry['fingerprint'] != fingerprint(actions, input_files):
+            logger.info(f"{name}: command or inputs changed, running it again")
+            return None
+        for path in output_files:
+            state = file_state(path)
+            if state is None or state != entry['files'].get(path):
+                logger.info(f"{name}: output {path} missing or changed, running it again")
+                return None
+        return entry
@@ -0,0 +1,148 @@
+"""Priority policies deciding which ready task a runner gets first
+
+A policy hands out sort keys for ready tasks; the smallest key is
+dispatched first. Policies that look at the whole graph (e.g. upward
+rank) are re-prepared by ParallelTaskExecutor whenever tasks are added.
+Dynamic policies (dynamic = True) are told about every task run started
+and ended, and the ready queue re-checks their keys as they change.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class FifoPriority:
+    """Dispatch tasks in the order they became ready"""
+    name = "fifo"
+
+    def prepare(self, task_insts):
+        pass
+
+    def key(self, task):
+        return 0
+
+class UpwardRankPriority:
+    """Critical-path first (HEFT-style upward rank)
+
+    rank(t) = cost(t) + max(rank(s) for s in successors of t)
+
+    i.e. the estimated length of the longest chain from t to an exit task.
+    Tasks on the critical path, like early prep_batch_* tasks that gate a
+    whole realfft -> accelsearch chain, are dispatched first.
+    """
+    name = "upward_rank"
+
+    def __init__(self):
+        self.ranks = {}
+
+    def prepare(self, task_insts):
+        # deps must exist when a task is added, so reversed uuid order
+        # visits every successor before its predecessors
+        self.ranks = {}
+        for uuid in sorted(task_insts.keys(), reverse=True):
+            task = task_insts[uuid]
+            succ_rank = max((self.ranks[s.uuid] for s in task.successors), default=0.0)
+            self.ranks[uuid] = task.cost + succ_rank
+
+    def key(self, task):
+        return -self.ranks.get(task.uuid, task.cost)
+
+class LongestFirstPriority:
+    """Largest estimated cost first, ignoring the graph (LPT)"""
+    name = "longest_first"
+
+    def prepare(self, task_insts):
+        pass
+
+    def key(self, task):
+        return -task.cost
+
+class StagedPriority:
+    """Different policies for different parts of one graph
+
+    policies: key: stage name, value: policy or its name
+    stage_of: function mapping a task to its stage name
+    """
+    name = "staged"
+
+    def __init__(self, policies, stage_of):
+        self.policies = {stage: get_policy(policy) for stage, policy in policies.items()}
+        self.stage_of = stage_of
+
+    def prepare(self, task_insts):
+        for policy in self.policies.values():
+            policy.prepare(task_insts)
+
+    def key(self, task):
+        return self.policies[self.stage_of(task)].key(task)
+
+class FairSharePriority:
+    """Share the cluster between jobs, e.g. the pipelines submitted to
+    SchedulerDaemon
+
+    Jobs of a higher priority go first; among equal ones, the job with the
+    fewest cores in use per unit of weight does. Within a job, the job's
+    own policy orders its tasks.
+
+    job_of: function mapping a task to its job, None if it has none
+    (any more); such tasks go last
+    The executor reports cores taken and given back through dispatched()
+    and released(); keys change with them, so the policy is dynamic.
+    """
+    name = "fair_share"
+    dynamic = True
+
+    def __init__(self, job_of):
+        self.job_of = job_of
+        # key: job, value: dict of weight, priority, policy, cores
+        self.jobs = {}
+
+    def add_job(self, job, weight=1.0, priority=0, policy=None):
+        if weight <= 0:
+            raise Exception(f"Job {job} needs a positive weight, got {weight}")
+        self.jobs[job] = {'weight': weight, 'priority': priority, 'policy': get_policy(policy), 'cores': 0}
+
+    def remove_job(self, job):
+        del self.jobs[job]
+
+    def share(self, job):
+        """Cores in use per unit of weight"""
+        return self.jobs[job]['cores'] / self.jobs[job]['weight']
+
+    def prepare(self, task_insts):
+        by_job = {}
+        for uuid, task in task_insts.items():
+            by_job.setdefault(self.job_of(task), {})[uuid] = task
+        for job, tasks in by_job.items():
+            if job in self.jobs:
+                self.jobs[job]['policy'].prepare(tasks)
+
+    def key(self, task):
+        job = self.jobs.get(self.job_of(task))
+        if job is None:
+            return (float('inf'), 0.0, ())
+        return (-job['priority'], job['cores'] / job['weight'], job['policy'].key(task))
+
+    def dispatched(self, task):
+        job = self.jobs.get(self.job_of(task))
+        if job is not None:
+            job['cores'] += task.resources.cores
+
+    def released(self, task):
+        job = self.jobs.get(self.job_of(task))
+        if job is not None:
+            job['cores'] -= task.resources.cores
+
+POLICIES = {
+    policy.name: policy for policy in [FifoPriority, UpwardRankPriority, LongestFirstPriority]
+}
+
+def get_policy(policy):
+    """Accept a policy instance or one of the names in POLICIES"""
+    if policy is None:
+        return FifoPriority()
+    if isinstance(policy, str):
+        if policy not in POLICIES:
+            raise Exception(f"Unknown priority policy: '{policy}'")
+        return POLICIES[policy]()
+    return policy
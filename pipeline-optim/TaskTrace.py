@@ -0,0 +1,114 @@
+"""Chrome trace (chrome://tracing, ui.perfetto.dev) export of a run
+
+One process per runner, one thread per core (or per slot when tasks are
+not pinned), with a slice for every run of a task and nested slices for
+its commands. Time spent in the ready queue (queued -> dispatched) and
+waiting for the runner to pick a task up (dispatched -> started) shows
+as async slices under the "scheduler" process.
+Timestamps are microseconds since start_runners(), or since the first
+task was queued if that was earlier.
+"""
+
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_PID = 0
+
+def assign_lanes(runs):
+    """Lane (thread id) for each unpinned run, so overlapping runs of one
+    runner never share a lane; key: id(run), value: list of lanes
+    """
+    lanes_end = []
+    lanes = {}
+    for run in sorted(runs, key=lambda run: run['start']):
+        for lane, end in enumerate(lanes_end):
+            if end <= run['start']:
+                break
+        else:
+            lane = len(lanes_end)
+            lanes_end.append(0.0)
+        lanes_end[lane] = run['end']
+        lanes[id(run)] = [lane]
+    return lanes
+
+def chrome_trace(task_executor):
+    """Trace events of every task of task_executor, as a JSON-able dict"""
+    start = min(
+        [task_executor.start_time] + [run['queued'] for task in task_executor.task_insts.values()
+                                      for run in task.runs if run['queued'] is not None]
+    )
+    def us(t):
+        return round((t - start) * 1e6, 3)
+    def dur(begin, end):
+        return round((end - begin) * 1e6, 3)
+
+    events = [{'ph': 'M', 'name': 'process_name', 'pid': SCHEDULER_PID, 'args': {'name': 'scheduler'}}]
+    for runner in list(task_executor.registered_runners.values()) + list(task_executor.lost_runners.values()):
+        events.append({
+            'ph': 'M', 'name': 'process_name', 'pid': runner.uuid + 1,
+            'args': {'name': f"{runner.host} (Runner #{runner.uuid}, {runner.num_slots} slots)"}
+        })
+
+    runs_by_runner = {}
+    for task in task_executor.task_insts.values():
+        for run in task.runs:
+            if run['end'] is not None:
+                runs_by_runner.setdefault(run['runner'], []).append((task, run))
+
+    for runner_uuid, task_runs in runs_by_runner.items():
+        pid = runner_uuid + 1
+        pinned = all(run['cores'] for _, run in task_runs)
+        lanes = None if pinned else assign_lanes([run for _, run in task_runs])
+
+        for task, run in task_runs:
+            args = {
+                'uuid': task.uuid,
+                'host': run['host'],
+                'cores': run['cores'],
+                'commands': [action[0] for action in run['actions']],
+                'retcodes': [action[3] for action in run['actions']],
+                'status': task.status,
+                'copy_won': task.runner_uuid == runner_uuid and task.finish_time == run['end'],
+                'usage': run['usage']
+            }
+            for key in ['queued', 'dispatched', 'start', 'end']:
+                if run[key] is not None:
+                    args[key + '_us'] = us(run[key])
+
+            tids = run['cores'] if pinned else lanes[id(run)]
+            for tid in tids:
+                events.append({
+                    'ph': 'X', 'cat': 'task', 'name': task.name, 'pid': pid, 'tid': tid,
+                    'ts': us(run['start']), 'dur': dur(run['start'], run['end']), 'args': args
+                })
+                for cmd, cmd_start, cmd_end, retcode, usage in run['actions']:
+                    events.append({
+                        'ph': 'X', 'cat': 'command', 'name': cmd.split('&&')[-1].strip()[:60], 'pid': pid, 'tid': tid,
+                        'ts': us(cmd_start), 'dur': dur(cmd_start, cmd_end),
+                        'args': {'command': cmd, 'retcode': retcode, 'usage': usage}
+                    })
+
+            # scheduling delays, async slices may overlap freely
+            run_id = f"{task.uuid}.{id(run)}"
+            for phase, begin, end in [('queued', run['queued'], run['dispatched']),
+                                      ('dispatched', run['dispatched'], run['start'])]:
+                if begin is None or end is None:
+                    continue
+                common = {'cat': phase, 'name': f"{task.name} {phase}", 'pid': SCHEDULER_PID, 'tid': 0, 'id': run_id}
+                events.append(dict(common, ph='b', ts=us(begin)))
+                events.append(dict(common, ph='e', ts=us(end)))
+
+    return {
+        'traceEvents': events,
+        'displayTimeUnit': 'ms',
+        # for lining up traces of different runs
+        'otherData': {'wall_clock_start': time.time() - (task_executor.loop.time() - start)}
+    }
+
+def write_chrome_trace(task_executor, filename):
+    with open(filename, "w") as f:
+        json.dump(chrome_trace(task_executor), f)
+    logger.info(f"Wrote the task timeline to {filename}")
@@ -59,6 +59,23 @@ def prepsubband_normal_gbt(hostfile):
     print(f"VALIDATION: {dname}")
     os.system(f"python3 ./pipeline-optim/PrestoReferencePipeline.py ./TestData/GBT_Lband_PSR.fil REALFFT {dname}")
 
+def affinity_gbt(hostfile):
+    hname = pretty_name(hostfile)
+    dname = f"./workdir_affinity_{hname}"
+    if os.path.exists(dname):
+        import shutil
+        shutil.rmtree(dname)
+    os.mkdir(dname)
+    os.system(f"cp ./TestData/accelsearch-bench/gbt/* {dname}")
+    for mode in ['bind', 'nobind']:
+        show_time(os.system, f"affinity_{mode}_{hname}", f"python3 ./pipeline-optim/PrestoAffinityBench.py {dname} {hostfile} {mode} 4")
+
+def occupancy(hostfile):
+    # time for each runner to fill its slots, with commands and scheduler-only
+    hname = pretty_name(hostfile)
+    show_time(os.system, f"occupancy_{hname}", f"python3 ./pipeline-optim/PrestoOccupancyBench.py {hostfile} 5")
+    show_time(os.system, f"occupancy_fake_{hname}", f"python3 ./pipeline-optim/PrestoOccupancyBench.py {hostfile} 5 0.5 fake")
+
 def pretty_name(path):
     return os.path.split(path)[-1].replace(".", "_")
 
@@ -69,6 +86,8 @@ def run():
         #realfft_normal_gbt(host)
         #accelsearch_normal_gbt(host)
         prepsubband_normal_gbt(host)
+        #affinity_gbt(host)
+        #occupancy(host)
 
 if __name__ == '__main__':
     run()
\ No newline at end of file